@@ -4,4 +4,7 @@ This python package includes the code for the distributed microblogging peer app
 
 from .posts import Post
 from .users import User
-from .client import AppInstance, MicroblogCommandLineInterface
\ No newline at end of file
+from .client import AppInstance, MicroblogCommandLineInterface
+from .aio import AsyncAppInstance
+from .address_feed import AddressFeed
+from .mirror import PeerMirror
\ No newline at end of file
@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+
+class AddressCache:
+    """
+    This class represents a client-side cache of the peer addresses returned by the User Directory Service. Addresses
+    expire after ttl seconds, and users that the UDS reported as unknown are remembered for negative_ttl seconds so
+    that repeated lookups of a missing user do not reach the UDS. When the cache holds max_size users, the least
+    recently used user is evicted. Hit, miss, and eviction counters are kept for monitoring.
+    """
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 5.0, max_size: int = 1024):
+        """
+        Instantiates a new, empty AddressCache.
+        :param ttl: the number of seconds for which an address is cached
+        :param negative_ttl: the number of seconds for which an unknown user is cached
+        :param max_size: the maximum number of users in the cache
+        """
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1.")
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.lock = Lock()
+
+        # Maps each username to its address (None for unknown users) and the time at which the entry expires
+        self._entries: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, username: str) -> Tuple[bool, Optional[str]]:
+        """
+        Looks up the address of the user with the provided username.
+        :param username: the username of the user whose address to look up
+        :return: whether the user was found in the cache, and the user's address, which is None if the user is known
+        not to be registered with the UDS
+        """
+        with self.lock:
+            entry = self._entries.get(username)
+
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(username, None)
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(username)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def __contains__(self, username: str) -> bool:
+        """
+        Returns whether the user with the provided username has an unexpired entry in the cache, without counting a hit
+        or a miss or making the user the most recently used one.
+        :param username: the username of the user to check
+        :return: True if the user's address, or the fact that the user is not registered, is cached
+        """
+        with self.lock:
+            entry = self._entries.get(username)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def put(self, username: str, address: Optional[str]):
+        """
+        Caches the address of the user with the provided username, evicting the least recently used user if the cache
+        is full.
+        :param username: the username of the user whose address to cache
+        :param address: the address of the user of the form host:port, or None if the user is not registered
+        """
+        ttl = self.ttl if address is not None else self.negative_ttl
+
+        with self.lock:
+            self._entries[username] = (address, time.monotonic() + ttl)
+            self._entries.move_to_end(username)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username: str):
+        """
+        Removes the user with the provided username from the cache, for example because the cached address refused a
+        connection.
+        :param username: the username of the user to remove
+        """
+        with self.lock:
+            if self._entries.pop(username, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Removes all users from the cache."""
+        with self.lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters and current size of this cache."""
+        with self.lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,120 @@
+import requests
+from threading import Event, Lock, Thread
+from typing import Dict, Optional
+
+
+class AddressFeed:
+    """
+    This class represents a subscription to the change feed of the User Directory Service. A background thread
+    long-polls the UDS watch endpoint and applies every committed registration to a local map of usernames to
+    addresses, so that once the feed has synced, looking up a peer is a dict access rather than a request to the UDS.
+    If the UDS is unreachable, the thread keeps the last known addresses and retries every retry_interval seconds from
+    the last version it received. If the UDS cannot serve a consistent feed, as when it is partitioned or writes to
+    quorums of replicas, the feed disables itself and lookups fall back to the address cache and the UDS.
+    """
+
+    def __init__(self, gateway_address: str, timeout: float = 30.0, retry_interval: float = 1.0):
+        """
+        Instantiates a new AddressFeed. The feed does not contact the UDS until it is started.
+        :param gateway_address: the URL of the store endpoint of the UDS gateway
+        :param timeout: the number of seconds for which the UDS may hold each poll open
+        :param retry_interval: the number of seconds to wait before polling again after a failed poll
+        """
+        self.gateway_address = gateway_address
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.lock = Lock()
+
+        self._addresses: Dict[str, str] = {}
+        self._versions: Dict[str, int] = {}
+        self.version = -1
+        self.synced = Event()
+        self.disabled = False
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+        self.updates = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    def start(self):
+        """Starts following the change feed in a background thread, unless it has already been started."""
+        if self._thread.ident is None:
+            self._thread.start()
+
+    def stop(self):
+        """Stops following the change feed after the current poll completes."""
+        self._stopped.set()
+
+    def get(self, username: str) -> Optional[str]:
+        """
+        Looks up the address of the user with the provided username in the local map.
+        :param username: the username of the user whose address to look up
+        :return: the address of the user of the form host:port, or None if the feed has not seen the user
+        """
+        return self._addresses.get(username)
+
+    def invalidate(self, username: str):
+        """
+        Removes the user with the provided username from the local map, for example because the address refused a
+        connection. The user is added again when the feed delivers a newer registration.
+        :param username: the username of the user to remove
+        """
+        with self.lock:
+            if username in self._addresses:
+                addresses = dict(self._addresses)
+                del addresses[username]
+                self._addresses = addresses
+                self.invalidations += 1
+
+    def _run(self):
+        """Polls the change feed until stopped, applying each batch of changes to the local map."""
+        with requests.Session() as session:
+            while not self._stopped.is_set():
+                try:
+                    response = session.get(f"{self.gateway_address}/watch",
+                                           params={'since': self.version, 'timeout': self.timeout},
+                                           timeout=self.timeout + 5)
+                    if response.status_code == 501:
+                        self._disable()
+                        return
+                    response.raise_for_status()
+                    response = response.json()
+                except (requests.RequestException, ValueError):
+                    self.errors += 1
+                    self._stopped.wait(self.retry_interval)
+                    continue
+
+                self._apply(response.get('data', {}), response.get('version', self.version))
+                self.synced.set()
+
+    def _disable(self):
+        """Stops following the change feed and forgets every address, since they could be missing registrations."""
+        with self.lock:
+            self._addresses = {}
+            self.disabled = True
+        self._stopped.set()
+
+    def _apply(self, changes: Dict[str, Dict], version: int):
+        """
+        Applies changes received from the feed to the local map, keeping the newest address of each user.
+        :param changes: a dict mapping each changed username to its entry, holding its address and version
+        :param version: the cursor from which to request the next changes
+        """
+        with self.lock:
+            addresses = dict(self._addresses)
+            for username, entry in changes.items():
+                if entry.get('version', -1) > self._versions.get(username, -1):
+                    addresses[username] = entry['value']
+                    self._versions[username] = entry.get('version', -1)
+                    self.updates += 1
+
+            # Replace the map rather than updating it in place so that lookups need no lock
+            self._addresses = addresses
+            self.version = max(self.version, version)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters, current size, and version of this feed."""
+        with self.lock:
+            return {'size': len(self._addresses), 'version': self.version, 'updates': self.updates,
+                    'invalidations': self.invalidations, 'errors': self.errors, 'disabled': int(self.disabled)}
@@ -0,0 +1,443 @@
+from .users import User
+from .posts import Post
+from .address_cache import AddressCache
+from .address_feed import AddressFeed
+from .timeline import Page
+from .page_cache import PageCache
+from .peer_reader import PeerReader
+
+import asyncio
+import heapq
+import json
+from concurrent.futures import Future
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class HTTPResponse:
+    """
+    This class represents an HTTP response received by an AsyncConnectionPool.
+    """
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        """
+        Instantiates a new HTTPResponse.
+        :param status: the HTTP status code of the response
+        :param headers: the headers of the response, with lower-case names
+        :param body: the body of the response
+        """
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def text(self) -> str:
+        """Returns the body of this response decoded as utf-8."""
+        return self.body.decode()
+
+    def json(self):
+        """Returns the body of this response decoded as JSON."""
+        return json.loads(self.body)
+
+
+class AsyncConnectionPool:
+    """
+    This class represents a pool of persistent HTTP/1.1 connections to a single host and port, for use from an asyncio
+    event loop. At most size requests are in flight to the host at once; idle connections are kept open and reused by
+    later requests.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 10, connect_timeout: float = 3.05, read_timeout: float = 5.0):
+        """
+        Instantiates a new AsyncConnectionPool. No connections are opened until the first request.
+        :param host: the host to connect to
+        :param port: the port to connect to
+        :param size: the maximum number of concurrent connections to the host
+        :param connect_timeout: the number of seconds to wait for a connection to be established
+        :param read_timeout: the number of seconds to wait for a response
+        """
+        if size < 1:
+            raise ValueError("Pool size must be at least 1.")
+
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """
+        Returns an idle connection from the pool, or opens a new one if there are none.
+        :return: the reader and writer of the connection, and whether the connection was reused from the pool
+        :raises ConnectionError: if the connection could not be established
+        """
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                    self.connect_timeout)
+            return reader, writer, False
+        except OSError as e:
+            raise ConnectionError(f"Could not connect to {self.host}:{self.port}.") from e
+
+    async def request(self, method: str, path: str, body: bytes = b"",
+                      headers: Optional[Dict[str, str]] = None) -> HTTPResponse:
+        """
+        Issues an HTTP request to the host of this pool over a pooled connection. If a reused connection turns out to
+        have been closed by the host, the request is retried over another connection.
+        :param method: the request method
+        :param path: the request path, including any query string
+        :param body: the request body
+        :param headers: any additional request headers
+        :return: the response
+        :raises ConnectionError: if the connection could not be established or was closed before a response was read
+        :raises asyncio.TimeoutError: if the connection or response timed out
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        if body or method.upper() in ('POST', 'PUT'):
+            head += f"Content-Length: {len(body)}\r\n"
+        message = head.encode('latin-1') + b"\r\n" + body
+
+        async with self._slots:
+            while True:
+                reader, writer, reused = await self._connect()
+
+                try:
+                    writer.write(message)
+                    await writer.drain()
+                    response, keep_alive = await asyncio.wait_for(self._read_response(reader), self.read_timeout)
+                    break
+                except ConnectionError:
+                    writer.close()
+                    if not reused:
+                        raise
+                except BaseException:
+                    writer.close()
+                    raise
+
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+
+            return response
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> Tuple[HTTPResponse, bool]:
+        """
+        Reads one HTTP response, framed by Content-Length, chunked transfer encoding, or the end of the connection.
+        :param reader: the reader of the connection
+        :return: the response and whether the connection can be reused
+        :raises ConnectionError: if the connection was closed before a complete response was read
+        """
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionError("Connection closed before a response was received.") from e
+
+        lines = head.decode('latin-1').split("\r\n")
+        version, status = lines[0].split(' ')[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version.upper() == 'HTTP/1.1'
+
+        try:
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                body = b""
+                while True:
+                    size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                    chunk = await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+                    body += chunk[:-2]
+            elif 'content-length' in headers:
+                body = await reader.readexactly(int(headers['content-length']))
+            else:
+                body = await reader.read()
+                keep_alive = False
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionError("Connection closed before the response was complete.") from e
+
+        return HTTPResponse(int(status), headers, body), keep_alive
+
+    async def close(self):
+        """Closes all idle connections in this pool."""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+class AsyncAppInstance(PeerReader):
+    """
+    This class represents an asyncio-native variant of the AppInstance. Its read methods are coroutines that issue
+    requests to peers over pooled, persistent connections, one AsyncConnectionPool per peer address and one for the User
+    Directory Service gateway, so that a single thread can issue many peer reads concurrently.
+    """
+
+    # Address of the User Directory Service gateway
+    uds_gateway_address = "http://localhost:8080/store"
+
+    def __init__(self, user: User, pool_size: int = 10, connect_timeout: float = 3.05, read_timeout: float = 5.0,
+                 address_cache: AddressCache = None, page_cache: PageCache = None, address_feed: AddressFeed = None):
+        """
+        Instantiates a new AsyncAppInstance with the provided user. Call start() to also serve this user's data to
+        peers.
+        :param user: the user of this AsyncAppInstance
+        :param pool_size: the maximum number of concurrent connections to each peer and to the UDS gateway
+        :param connect_timeout: the number of seconds to wait for a connection to a peer to be established
+        :param read_timeout: the number of seconds to wait for a response from a peer
+        :param address_cache: the cache of peer addresses obtained from the UDS, defaults to an AddressCache
+        :param page_cache: the cache of pages received from peers, defaults to a PageCache
+        :param address_feed: a subscription to the UDS change feed from which peer addresses are looked up before
+        falling back to the address cache, or None to look up every address in the cache or the UDS
+        """
+        self.user = user
+        self.address_cache = address_cache if address_cache is not None else AddressCache()
+        self.page_cache = page_cache if page_cache is not None else PageCache()
+        self.address_feed = address_feed
+        if address_feed is not None:
+            address_feed.start()
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.server = None
+
+        self._pools: Dict[str, AsyncConnectionPool] = {}
+
+    def _pool(self, address: str) -> AsyncConnectionPool:
+        """
+        Returns the connection pool for the provided address, creating it if necessary.
+        :param address: the address of the form host:port
+        :return: the connection pool for the address
+        """
+        if address not in self._pools:
+            host, _, port = address.rpartition(':')
+            self._pools[address] = AsyncConnectionPool(host, int(port), self.pool_size, self.connect_timeout,
+                                                       self.read_timeout)
+        return self._pools[address]
+
+    async def _uds_request(self, method: str, body: Dict, endpoint: str = "") -> HTTPResponse:
+        """
+        Issues a request to the User Directory Service gateway.
+        :param method: the request method
+        :param body: the JSON request body
+        :param endpoint: the path of the endpoint relative to the gateway address
+        :return: the response from the gateway
+        """
+        url = urlsplit(self.uds_gateway_address)
+        return await self._pool(url.netloc).request(method, url.path + endpoint, json.dumps(body).encode(),
+                                                    {"Content-Type": "application/json"})
+
+    async def start(self, port: int):
+        """
+        Starts an AppRequestServer for this user in a new thread and registers it with the User Directory Service.
+        :param port: the port on which to run the server
+        """
+        from .client import AppRequestServer
+
+        self.server = AppRequestServer(port, self.user)
+        await self._uds_request('PUT', {"key": self.user.username, "value": f"localhost:{port}"})
+        self.server.start()
+
+    async def _get_user_address(self, username: str) -> str:
+        """
+        Contacts the User Directory Service to obtain the IP address and port of the peer microblogging server
+        associated with the user with the provided username. The result is stored in the address cache.
+        :param username: username of the user to get an address for
+        :return: the URL of the user's app server of the form host:port
+        :raises KeyError: if the user is not registered with the User Directory Service
+        """
+        return self._store_address(username, (await self._uds_request('GET', {'key': username})).json())
+
+    async def _get_user_addresses(self, usernames: Iterable[str]) -> Dict[str, str]:
+        """
+        Contacts the User Directory Service once to obtain the addresses of the peer microblogging servers associated
+        with all of the provided usernames. The results, including unknown users, are stored in the address cache.
+        :param usernames: the usernames of the users to get addresses for
+        :return: a dict mapping the username of each registered user to the URL of its app server of the form host:port
+        """
+        usernames = list(usernames)
+        data = (await self._uds_request('POST', {'keys': usernames}, '/batch_get')).json()['data']
+        return self._store_addresses(usernames, data)
+
+    async def _resolve(self, username: str) -> Tuple[str, bool]:
+        """
+        Returns the address of the app server associated with the provided username, from the address feed or the
+        address cache if possible and from the User Directory Service otherwise.
+        :param username: username of the user to get an address for
+        :return: the URL of the user's app server of the form host:port, and whether it came from the cache
+        :raises KeyError: if the user is not registered with the User Directory Service
+        """
+        address = self._cached_address(username)
+        if address is None:
+            return await self._get_user_address(username), False
+        return address, True
+
+    async def _issue_request(self, username: str, request: str,
+                             headers: Optional[Dict[str, str]] = None) -> HTTPResponse:
+        """
+        Issues the provided GET request to the app server associated with the provided username over a pooled
+        connection. If an address from the address feed or the address cache refuses the connection, it is dropped from
+        both and the request is retried once with a fresh address from the UDS.
+        :param username: the username of the user whose app server to send the request to
+        :param request: the request to issue
+        :param headers: any additional request headers
+        :return: the HTTP response from the app server
+        """
+        address, cached = await self._resolve(username)
+
+        try:
+            return await self._pool(address).request('GET', f"/{request}", headers=headers)
+        except ConnectionError:
+            if not cached:
+                raise
+
+        self._forget_address(username)
+        return await self._pool(await self._get_user_address(username)).request('GET', f"/{request}", headers=headers)
+
+    async def get_page(self, username: str, entity: str, n: int, before: Optional[int] = None,
+                       since: Optional[int] = None) -> Page:
+        """
+        Returns a page of at most n posts, likes, or reposts by the user with the specified username, ordered from
+        newest to oldest. Pass the before cursor of a page to get older entries, or the since cursor of a page to get
+        only entries added after it. Pages received from peers are cached and revalidated with the peer's ETag, so an
+        unchanged page is not transferred again.
+        :param username: the username of the user whose entries to get
+        :param entity: the entity to get: posts, likes, or reposts
+        :param n: the maximum number of entries to get
+        :param before: the cursor before which to get entries
+        :param since: the cursor at or after which to get entries
+        :return: a page of Post objects (for posts) or post ids (for likes and reposts) and its cursors
+        """
+        if username == self.user.username:
+            return self.user.page(entity, n, before, since)
+
+        key, cached, request, headers = self._page_request(username, entity, n, before, since)
+        response = await self._issue_request(username, request, headers=headers)
+        return self._read_page(entity, key, cached, response.status, response.headers, response.body)
+
+    async def get_posts(self, username: str, n: int) -> Iterable[Post]:
+        """
+        Returns an iterable of the n most recent posts by the user with the specified username.
+        :param username: the username of the user whose posts to get
+        :param n: the number of posts to get
+        :return: an iterable of the n most recent posts by the user with the specified username
+        """
+        return (await self.get_page(username, 'posts', n)).entries
+
+    async def get_likes(self, username: str, n: int) -> Iterable[str]:
+        """
+        Returns an iterable of the n most recent likes by the user with the specified username.
+        :param username: the username of the user whose likes to get
+        :param n: the number of likes to get
+        :return: an iterable of the n most recent likes by the user with the specified username
+        """
+        return (await self.get_page(username, 'likes', n)).entries
+
+    async def get_reposts(self, username: str, n: int) -> Iterable[str]:
+        """
+        Returns an iterable of the n most recent reposts by the user with the specified username.
+        :param username: the username of the user whose reposts to get
+        :param n: the number of reposts to get
+        :return: an iterable of the n most recent reposts by the user with the specified username
+        """
+        return (await self.get_page(username, 'reposts', n)).entries
+
+    async def get_timeline(self, usernames: Iterable[str], n: int,
+                           timeout: float = 2.0) -> Tuple[List[Post], List[str]]:
+        """
+        Returns the n most recent posts across all of the users with the provided usernames, such as the users followed
+        by the current user. The posts of all users are requested concurrently and merged by the time at which they
+        were created. Users whose posts cannot be retrieved within timeout seconds, because their app server is slow,
+        offline, or not registered, are left out of the merge and reported instead.
+        :param usernames: the usernames of the users whose posts to merge
+        :param n: the number of posts to get
+        :param timeout: the number of seconds to wait in total, for the UDS and for all users' app servers to respond
+        :return: a list of the n most recent posts across all of the users, ordered from newest to oldest, and a list
+        of the usernames of the users whose posts could not be retrieved in time
+        """
+        usernames = list(dict.fromkeys(usernames))
+
+        # Every stage only gets the time left before the deadline, so that the whole call takes at most timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        # Resolve the addresses of all peers missing from the address cache with a single UDS request
+        uncached = [username for username in usernames
+                    if username != self.user.username and not self._is_known(username)]
+        if uncached:
+            try:
+                await asyncio.wait_for(self._get_user_addresses(uncached), max(deadline - loop.time(), 0))
+            except (ConnectionError, asyncio.TimeoutError, ValueError, KeyError):
+                # Fall back to resolving each peer individually
+                pass
+
+        remaining = max(deadline - loop.time(), 0)
+        results = await asyncio.gather(*[asyncio.wait_for(self.get_posts(username, n), remaining)
+                                         for username in usernames], return_exceptions=True)
+
+        timelines, timed_out = [], []
+        for username, result in zip(usernames, results):
+            if isinstance(result, BaseException):
+                timed_out.append(username)
+            else:
+                timelines.append(result)
+
+        # Each timeline is ordered from newest to oldest, so a k-way merge yields the n most recent posts overall
+        merged = heapq.merge(*timelines, key=lambda post: post.time, reverse=True)
+        return list(islice(merged, n)), timed_out
+
+    def post(self, message: str) -> Future:
+        """
+        Adds a new post to the user currently logged into this AsyncAppInstance.
+        :param message: the message to include in the post
+        :return: a Future which is resolved once the post has been written to storage
+        :raises OSError: if the post could not be written by a synchronous writer
+        """
+        return self.user.post(message)
+
+    def like(self, post_id: str) -> Future:
+        """
+        Adds a new post to the list of posts liked by the user currently logged into this AsyncAppInstance.
+        :param post_id: the id of the post to like
+        :return: a Future which is resolved once the like has been written to storage
+        :raises OSError: if the like could not be written by a synchronous writer
+        """
+        return self.user.like(post_id)
+
+    def repost(self, post_id: str) -> Future:
+        """
+        Adds a new post to the list of posts reposted by the user currently logged into this AsyncAppInstance.
+        :param post_id: the id of the post to repost
+        :return: a Future which is resolved once the repost has been written to storage
+        :raises OSError: if the repost could not be written by a synchronous writer
+        """
+        return self.user.repost(post_id)
+
+    async def close(self):
+        """Closes all pooled connections and stops this instance's server, if it was started."""
+        for pool in self._pools.values():
+            await pool.close()
+        if self.server is not None:
+            self.server.shutdown()
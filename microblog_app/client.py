@@ -1,11 +1,36 @@
 from .users import User
-from .posts import Post
+from .posts import POSTS_CONTENT_TYPE, Post, encode_posts
+from .address_cache import AddressCache
+from .address_feed import AddressFeed
+from .timeline import Page
+from .page_cache import PageCache
+from .response_cache import ResponseCache
+from .mirror import PeerMirror
+from .peer_reader import PeerReader
+from .metrics import Counter, Histogram, metrics
 
+import os
 import requests
 import socket
+import selectors
+import time
 import json
-from typing import Iterable, Tuple
-from threading import Thread
+import heapq
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import islice
+from queue import Queue, Full
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from threading import Lock, Thread
+
+REQUESTS = Counter('microblog_requests_total', "Requests answered by the app server, by entity and status.")
+REQUEST_SECONDS = Histogram('microblog_request_duration_seconds',
+                            "Time spent handling and answering requests, by entity.")
+QUEUE_SECONDS = Histogram('microblog_request_queue_seconds', "Time readable connections waited for a worker.")
+REQUEST_ERRORS = Counter('microblog_request_errors_total',
+                         "Requests which failed with an unexpected exception, by exception type.")
+REJECTED = Counter('microblog_rejected_requests_total', "Requests rejected because too many were waiting for a worker.")
 
 
 class BadRequestError(Exception):
@@ -16,91 +41,475 @@ class BadRequestError(Exception):
     pass
 
 
+class NotModifiedError(Exception):
+    """
+    This error indicates that the client already holds the current version of the requested data, as identified by the
+    ETag in its If-None-Match header, and will result in an HTTP 304 Not Modified response with an empty body.
+    """
+
+    def __init__(self, etag: str):
+        super().__init__("Not modified.")
+        self.etag = etag
+
+
+class PeerConnection:
+    """
+    This class represents a single, possibly persistent, connection from a peer to an AppRequestServer. It buffers
+    bytes received from the peer so that requests can be framed regardless of how they were split across reads.
+    """
+
+    def __init__(self, sock: socket.socket):
+        """
+        Instantiates a new PeerConnection wrapping the provided socket.
+        :param sock: the connected peer socket
+        """
+        self.sock = sock
+        self.buffer = b""
+        self.last_active = time.monotonic()
+        self.queued_at = self.last_active
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self):
+        """Closes the connection to the peer."""
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
 class AppRequestServer(Thread):
     """
-    This class represents a lightweight application TCP server to handle incoming requests from peers in the distributed
-    microblogging application. This server can be set to run ina new thread by calling its start() method. It can
-    handle GET requests of the following form:
+    This class represents a lightweight application HTTP/1.1 server to handle incoming requests from peers in the
+    distributed microblogging application. This server can be set to run in a new thread by calling its start() method.
+    It can handle GET requests of the following form:
         GET /posts?n=<number_of_posts_to_get>
         GET /likes?n=<number_of_likes_to_get>
         GET /reposts?n=<number_of_reposts_to_get>
+        GET /metrics
 
-    All other requests will result in a 400 Bad Request Error.
+    The /metrics endpoint returns request counts, latency histograms, lock wait times, and storage times in the
+    Prometheus text exposition format. All other requests will result in a 400 Bad Request Error.
+
+    The server thread only accepts connections and waits for them to become readable; requests are handled by a bounded
+    pool of worker threads. Connections are kept alive between requests unless the peer asks for them to be closed, and
+    idle connections do not occupy a worker. When more than queue_depth requests are waiting for a worker, new requests
+    are rejected with a 503 Service Unavailable error.
+
+    Encoded pages are kept in a ResponseCache, which is invalidated whenever the user posts, likes, or reposts, so that
+    repeated requests for an unchanged page are answered without rebuilding it.
     """
 
-    def __init__(self, port: int, user: User):
+    # Maximum size of a request head (request line and headers) and body
+    max_head_bytes = 64 * 1024
+    max_body_bytes = 1024 * 1024
+
+    def __init__(self, port: int, user: User, max_workers: int = 16, queue_depth: int = 256, backlog: int = 128,
+                 keep_alive_timeout: float = 15.0, read_timeout: float = 5.0, response_cache: ResponseCache = None):
         """
         Instantiates a new AppRequestServer.
 
         :param port: the port on which to run the server
         :param user: the username of the user whose data this server is responsible for managing
+        :param max_workers: the number of worker threads handling requests concurrently
+        :param queue_depth: the maximum number of requests waiting for a worker before requests are rejected
+        :param backlog: the maximum number of connections waiting to be accepted by the operating system
+        :param keep_alive_timeout: the number of seconds after which an idle connection is closed
+        :param read_timeout: the number of seconds a worker waits for the rest of a partially received request
+        :param response_cache: the cache of encoded pages served by this server, defaults to a ResponseCache
         """
         super().__init__()
 
         if not 0 < port < 65536:
             raise ValueError("Port number must be between 1 and 65535.")
+        if max_workers < 1 or queue_depth < 1 or backlog < 1:
+            raise ValueError("Worker count, queue depth, and backlog must all be at least 1.")
 
         self.port = port
         self.user = user
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.backlog = backlog
+        self.keep_alive_timeout = keep_alive_timeout
+        self.read_timeout = read_timeout
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        user.subscribe(self.response_cache.invalidate)
+
+        # ETags carry an epoch chosen by each process, since writes which were lost in a crash can leave the user with
+        # the same versions but different entries after a restart
+        self.epoch = os.urandom(4).hex()
+
+        self._requests: Queue = Queue(maxsize=queue_depth)
+        self._returned: deque = deque()
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._stopped = False
 
     def run(self):
         """
-        Runs this AppRequestServer.
+        Runs this AppRequestServer until shutdown() is called.
         """
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind(('', self.port))
-        server_socket.listen(5)
+        server_socket.listen(self.backlog)
+        server_socket.setblocking(False)
 
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(server_socket, selectors.EVENT_READ, 'accept')
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, 'wakeup')
+
+        workers = [Thread(target=self._work, daemon=True) for _ in range(self.max_workers)]
+        for worker in workers:
+            worker.start()
+
+        while not self._stopped:
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.data == 'accept':
+                    self._accept(server_socket)
+                elif key.data == 'wakeup':
+                    self._reregister()
+                else:
+                    # Hand the readable connection over to a worker
+                    self._selector.unregister(key.fileobj)
+                    self._dispatch(key.fileobj)
+
+            self._expire_idle_connections()
+
+        # Stop the workers and close all remaining connections
+        for _ in workers:
+            self._requests.put(None)
+        for key in list(self._selector.get_map().values()):
+            if isinstance(key.fileobj, PeerConnection):
+                key.fileobj.close()
+        self._selector.close()
+        server_socket.close()
+
+    def shutdown(self):
+        """
+        Stops this AppRequestServer. Requests already being handled by a worker are allowed to complete.
+        """
+        self._stopped = True
+        self._wake()
+
+    def _wake(self):
+        """Wakes up the server thread if it is waiting for connections to become readable."""
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _accept(self, server_socket: socket.socket):
+        """
+        Accepts all pending peer connections and waits for them to become readable.
+        :param server_socket: the listening server socket
+        """
         while True:
+            try:
+                (peer_socket, peer_address) = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
 
-            # Accept a peer connection
-            (peer_socket, peer_address) = server_socket.accept()
-            request = peer_socket.recv(1024).decode()
+            peer_socket.setblocking(True)
+            peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = PeerConnection(peer_socket)
+            self._selector.register(connection, selectors.EVENT_READ, connection)
+
+    def _reregister(self):
+        """Waits for the connections handed back by the workers to become readable again."""
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
 
-            # print(request)
+        while self._returned:
+            connection = self._returned.popleft()
+            connection.last_active = time.monotonic()
+            self._selector.register(connection, selectors.EVENT_READ, connection)
+
+    def _dispatch(self, connection: PeerConnection):
+        """
+        Queues a readable connection for a worker, or rejects it with a 503 Service Unavailable error if too many
+        requests are already waiting.
+        :param connection: the readable connection
+        """
+        connection.queued_at = time.monotonic()
+        try:
+            self._requests.put_nowait(connection)
+        except Full:
+            REJECTED.inc()
+            try:
+                connection.sock.sendall(self.package_response("", "503 Service Unavailable", keep_alive=False))
+            except OSError:
+                pass
+            connection.close()
+
+    def _expire_idle_connections(self):
+        """Closes connections which have been idle for longer than the keep-alive timeout."""
+        deadline = time.monotonic() - self.keep_alive_timeout
+        for key in list(self._selector.get_map().values()):
+            connection = key.fileobj
+            if isinstance(connection, PeerConnection) and connection.last_active < deadline:
+                self._selector.unregister(connection)
+                connection.close()
+
+    def _work(self):
+        """
+        Handles readable connections from the request queue until a None sentinel is received. Connections which are
+        to be kept alive are handed back to the server thread; any other connection, including one whose request failed
+        unexpectedly, is closed.
+        """
+        while True:
+            connection = self._requests.get()
+            if connection is None:
+                return
+            QUEUE_SECONDS.observe(time.monotonic() - connection.queued_at)
+
+            try:
+                keep_alive = self._serve(connection)
+            except OSError:
+                keep_alive = False
+            except Exception:
+                # A single bad request must never cost the pool a worker
+                traceback.print_exc()
+                keep_alive = False
+
+            if keep_alive and not self._stopped:
+                self._returned.append(connection)
+                self._wake()
+            else:
+                connection.close()
+
+    def _serve(self, connection: PeerConnection) -> bool:
+        """
+        Reads and responds to every complete request available on the provided connection.
+        :param connection: the connection to serve
+        :return: True if the connection should be kept alive, False if it should be closed
+        """
+        connection.sock.settimeout(self.read_timeout)
+
+        while True:
+            try:
+                request, keep_alive = self._read_request(connection)
+            except BadRequestError:
+                REQUESTS.inc(entity='other', status='400')
+                connection.sock.sendall(self.package_response("", "400 Bad Request", keep_alive=False))
+                return False
+            except socket.timeout:
+                return False
+
+            if request is None:
+                return False
+
+            started = time.perf_counter()
+            entity = self._get_entity(request)
+            if entity not in ('posts', 'likes', 'reposts', 'metrics'):
+                entity = 'other'
 
             try:
                 # Handle the peer request and send a response to the peer
-                response = self.handle_request(request)
-                peer_socket.send(self.package_response(response))
+                body, headers = self.handle_request(request)
+                status = "200 OK"
+                response = self.package_response(body, keep_alive=keep_alive, headers=headers)
+            except NotModifiedError as e:
+                status = "304 Not Modified"
+                response = self.package_response("", status, keep_alive=keep_alive, headers={'ETag': e.etag})
             except BadRequestError:
-                peer_socket.send(f"HTTP/1.1 400 Bad Request\n\n".encode())
-            except Exception:
-                peer_socket.send(f"HTTP/1.1 500 Internal Server Error\n\n".encode())
+                status = "400 Bad Request"
+                response = self.package_response("", status, keep_alive=keep_alive)
+            except Exception as e:
+                # Report the failure instead of hiding it behind the 500 response
+                traceback.print_exc()
+                REQUEST_ERRORS.inc(exception=type(e).__name__)
+                status = "500 Internal Server Error"
+                response = self.package_response(json.dumps({'error': type(e).__name__}), status,
+                                                 keep_alive=keep_alive)
+
+            connection.sock.sendall(response)
+            REQUESTS.inc(entity=entity, status=status[:3])
+            REQUEST_SECONDS.observe(time.perf_counter() - started, entity=entity)
+
+            # Serve pipelined requests that have already arrived before returning the connection
+            if not keep_alive or not self._has_complete_head(connection.buffer):
+                return keep_alive
 
-            peer_socket.close()
+    @staticmethod
+    def _has_complete_head(buffer: bytes) -> bool:
+        return b"\r\n\r\n" in buffer or b"\n\n" in buffer
+
+    @classmethod
+    def _split_head(cls, buffer: bytes) -> Tuple[bytes, bytes]:
+        """
+        Splits a buffer containing a complete request head into the head and the remaining bytes.
+        :param buffer: the buffered bytes
+        :return: the request head and the remaining bytes
+        """
+        ends = [(buffer.find(sep), sep) for sep in (b"\r\n\r\n", b"\n\n") if sep in buffer]
+        index, sep = min(ends)
+        return buffer[:index], buffer[index + len(sep):]
+
+    def _read_request(self, connection: PeerConnection) -> Tuple[Optional[str], bool]:
+        """
+        Reads one complete request from the provided connection, including any body announced by a Content-Length
+        header. Bytes received after the end of the request are left in the connection's buffer.
+        :param connection: the connection to read from
+        :return: the request as a string, or None if the peer closed the connection, and whether to keep the
+        connection alive after responding
+        :raises BadRequestError: if the request is malformed or too large
+        """
+        while not self._has_complete_head(connection.buffer):
+            if len(connection.buffer) > self.max_head_bytes:
+                raise BadRequestError("Request head too large.")
+
+            data = connection.sock.recv(65536)
+            if not data:
+                return None, False
+            connection.buffer += data
+
+        head, rest = self._split_head(connection.buffer)
+        lines = head.decode('latin-1').splitlines()
+        if not lines or len(lines[0].split(' ')) != 3:
+            raise BadRequestError("Malformed request line.")
+
+        headers = self._get_headers(lines[1:])
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequestError("Malformed Content-Length header.")
+        if not 0 <= length <= self.max_body_bytes:
+            raise BadRequestError("Request body too large.")
+
+        while len(rest) < length:
+            data = connection.sock.recv(65536)
+            if not data:
+                return None, False
+            rest += data
+
+        connection.buffer = rest[length:]
+
+        # HTTP/1.1 connections are persistent by default, HTTP/1.0 connections are not
+        version = lines[0].split(' ')[2].upper()
+        connection_header = headers.get('connection', '').lower()
+        keep_alive = connection_header == 'keep-alive' if version == 'HTTP/1.0' else connection_header != 'close'
+
+        try:
+            body = rest[:length].decode()
+        except UnicodeDecodeError:
+            raise BadRequestError("Request body is not valid utf-8.")
+
+        return head.decode('latin-1') + "\r\n\r\n" + body, keep_alive
+
+    @staticmethod
+    def _get_headers(lines: Iterable[str]) -> Dict[str, str]:
+        """
+        Parses HTTP header lines into a dict with lower-case header names.
+        :param lines: the header lines of the request
+        :return: a dict mapping lower-case header names to their values
+        """
+        headers = {}
+        for line in lines:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequestError("Malformed header.")
+            headers[name.strip().lower()] = value.strip()
+        return headers
 
     @staticmethod
-    def package_response(response: str) -> bytes:
+    def package_response(response: Union[str, bytes], status: str = "200 OK", keep_alive: bool = False,
+                         headers: Optional[Dict[str, str]] = None) -> bytes:
         """
         Packages up a response as a properly formatted and utf-8 encoded HTTP response.
-        :param response: the response body
+        :param response: the response body, which is utf-8 encoded if it is a string
+        :param status: the HTTP status code and reason phrase of the response
+        :param keep_alive: whether the connection will be kept alive after the response
+        :param headers: any additional response headers, including a Content-Type to use instead of application/json
         :return: a properly formatted and utf-8 encoded HTTP response
         """
-        return f"HTTP/1.1 200 OK\n\n{response}".encode()
+        body = response.encode() if isinstance(response, str) else response
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+        extra = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        return (f"HTTP/1.1 {status}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"{extra}"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body
 
-    def handle_request(self, request: str) -> str:
+    def handle_request(self, request: str) -> Tuple[Union[str, bytes], Dict[str, str]]:
         """
-        Handles the peer request and returns a string containing the response body.
+        Handles the peer request and returns a string containing the response body along with any response headers.
+        Requests may page through an entity with the before and since query parameters; the cursors needed to continue
+        paging are returned in the X-Before-Cursor and X-Since-Cursor response headers. Every response carries an ETag
+        derived from the epoch of this server and the version of the entity, and requests whose If-None-Match header
+        matches it are answered with 304 Not Modified.
         :param request: the peer request
-        :return: a string containing the response body
+        :return: the response body, as a string or as bytes for binary responses, and a dict of response headers
         :raises BadRequestError: if the peer request is illegal or malformed
+        :raises NotModifiedError: if the client already holds the current version of the response
         """
 
         method = self._get_method(request)
         entity = self._get_entity(request)
 
-        if method.lower() == 'get':
+        if method.lower() == 'get' and entity == 'metrics':
+            return metrics.render(), {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+        if method.lower() == 'get' and entity in ('posts', 'likes', 'reposts'):
+            params = self._get_query_params(request)
+            if not set(params) <= {'n', 'before', 'since'} or ('before' in params and 'since' in params):
+                raise BadRequestError("Bad query parameters.")
+
+            # Posts are sent in their compact binary encoding to peers which accept it, and as JSON otherwise
+            request_headers = self._get_request_headers(request)
+            binary = entity == 'posts' and POSTS_CONTENT_TYPE in request_headers.get('accept', '')
 
+            # The version is read before the page so that the ETag can never be newer than the data it describes
+            version = self.user.version(entity)
+            etag = f'"{self.epoch}-{version}{"-b" if binary else ""}"'
+            if self._etag_matches(request_headers.get('if-none-match', ''), etag):
+                raise NotModifiedError(etag)
+
+            key = (entity, params.get('n'), params.get('before'), params.get('since'), binary)
+            cached = self.response_cache.get(key, version)
+            if cached is not None:
+                return cached
+
+            page = self.user.page(entity, **params)
+            headers = {'ETag': etag, 'X-Before-Cursor': str(page.before), 'X-Since-Cursor': str(page.since)}
             if entity == 'posts':
-                return json.dumps([post.serialize() for post in self.user.get_posts(**self._get_query_params(request))])
-            elif entity == 'reposts':
-                return json.dumps(self.user.get_reposts(**self._get_query_params(request)))
-            elif entity == 'likes':
-                return json.dumps(self.user.get_likes(**self._get_query_params(request)))
+                headers['Vary'] = 'Accept'
+            if binary:
+                headers['Content-Type'] = POSTS_CONTENT_TYPE
+                body = encode_posts(page.entries)
+            elif entity == 'posts':
+                body = json.dumps([post.serialize() for post in page.entries]).encode()
+            else:
+                body = json.dumps(page.entries).encode()
+
+            self.response_cache.put(key, version, body, headers)
+            return body, headers
 
         raise BadRequestError("Bad request.")
 
+    @staticmethod
+    def _etag_matches(if_none_match: str, etag: str) -> bool:
+        """
+        Returns whether the value of an If-None-Match header matches the provided ETag. The value is either * or a
+        comma-separated list of ETags, any of which may be weak; If-None-Match uses the weak comparison, which ignores
+        the W/ prefix.
+        :param if_none_match: the value of the If-None-Match header, which is empty if the header is absent
+        :param etag: the current ETag of the response
+        :return: True if the client already holds the current version of the response
+        """
+        for candidate in if_none_match.split(','):
+            candidate = candidate.strip()
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == '*' or candidate == etag:
+                return True
+        return False
+
     @staticmethod
     def _get_method(request: str) -> str:
         """
@@ -110,17 +519,40 @@ class AppRequestServer(Thread):
         """
         return request.split(' ')[0]
 
+    @classmethod
+    def _get_request_headers(cls, request: str) -> Dict[str, str]:
+        """
+        Extracts the headers from the provided peer request.
+        :param request: the peer request
+        :return: a dict mapping lower-case header names to their values
+        """
+        head = request.replace("\r\n", "\n").split("\n\n", 1)[0]
+        return cls._get_headers(line for line in head.split("\n")[1:] if line)
+
     @staticmethod
     def _get_entity(request: str) -> str:
         return request.split(' ')[1][1:].split('?')[0]
 
     @staticmethod
-    def _get_query_params(request: str) -> dict[str: str]:
-        params = request.split(' ')[1][1:].split('?')[1]
-        return {s.split('=')[0]: int(s.split('=')[1]) for s in params.split('&')}
+    def _get_query_params(request: str) -> Dict[str, int]:
+        """
+        Extracts the integer query parameters from the provided peer request.
+        :param request: the peer request
+        :return: a dict mapping query parameter names to their values, which is empty if there is no query string
+        :raises BadRequestError: if the query string is malformed
+        """
+        target = request.split(' ')[1]
+        if '?' not in target:
+            return {}
+
+        try:
+            params = target.split('?', 1)[1]
+            return {s.split('=')[0]: int(s.split('=')[1]) for s in params.split('&')}
+        except (IndexError, ValueError):
+            raise BadRequestError("Malformed query string.")
 
 
-class AppInstance:
+class AppInstance(PeerReader):
     """
     This class represents an application instance which acts as a peer in the peer-to-peer microblogging application.
     It constitutes the "model" in the MVC design pattern.
@@ -129,15 +561,36 @@ class AppInstance:
     # Address of the User Directory Service gateway
     uds_gateway_address = "http://localhost:8080/store"
 
-    def __init__(self, user: User, port: int):
+    # Number of seconds to wait for a peer when refreshing the mirror in the background
+    mirror_refresh_timeout = 5.0
+
+    def __init__(self, user: User, port: int, address_cache: AddressCache = None, page_cache: PageCache = None,
+                 address_feed: AddressFeed = None, mirror: PeerMirror = None):
         """
         Instantiates a new AppInstance with the provided user and port number.
         :param user: the user of this AppInstance
         :param port: the port on which to run this
+        :param address_cache: the cache of peer addresses obtained from the UDS, defaults to an AddressCache
+        :param page_cache: the cache of pages received from peers, defaults to a PageCache
+        :param address_feed: a subscription to the UDS change feed from which peer addresses are looked up before
+        falling back to the address cache, or None to look up every address in the cache or the UDS
+        :param mirror: a local mirror of other users' most recent entries from which their pages are served and which is
+        refreshed in the background, or None to request every page from its peer
         """
 
         # Load user data
         self.user = user
+        self.address_cache = address_cache if address_cache is not None else AddressCache()
+        self.page_cache = page_cache if page_cache is not None else PageCache()
+        self.address_feed = address_feed
+        if address_feed is not None:
+            address_feed.start()
+
+        # Mirrored entities are refreshed by a small pool of threads, at most once at a time each
+        self.mirror = mirror
+        self._refresher = ThreadPoolExecutor(max_workers=4) if mirror is not None else None
+        self._refreshing = set()
+        self._refreshing_lock = Lock()
 
         # Start app server & register with UDS
         self.server = AppRequestServer(port, user)
@@ -154,24 +607,166 @@ class AppInstance:
         ip = f"localhost:{self.server.port}"
         requests.put(self.uds_gateway_address, json.dumps({"key": username, "value": ip}))
 
-    def _get_user_address(self, username: str) -> User:
+    def _get_user_address(self, username: str) -> str:
         """
         Contacts the User Directory Service to obtain the IP address and port of the peer microblogging server
-        associated with the user with the provided username.
+        associated with the user with the provided username. The result is stored in the address cache.
         :param username: username of the user to get an address for
         :return: the URL of the user's app server of the form host:port
+        :raises KeyError: if the user is not registered with the User Directory Service
         """
-        return json.loads(requests.get(self.uds_gateway_address, json={'key': username}).text.strip())['value']
+        return self._store_address(username, json.loads(requests.get(self.uds_gateway_address,
+                                                                     json={'key': username}).text.strip()))
 
-    def _issue_request(self, username: str, request: str) -> requests.Response:
+    def _get_user_addresses(self, usernames: Iterable[str], timeout: Optional[float] = None) -> Dict[str, str]:
         """
-        Issues the provided GET request to the app server associated with the provided username. The UDS is queried to
-        obtain the IP address and port of the user's app server and the request is then submitted to that request.
+        Contacts the User Directory Service once to obtain the addresses of the peer microblogging servers associated
+        with all of the provided usernames. The results, including unknown users, are stored in the address cache.
+        :param usernames: the usernames of the users to get addresses for
+        :param timeout: the number of seconds to wait for the UDS, or None to wait indefinitely
+        :return: a dict mapping the username of each registered user to the URL of its app server of the form host:port
+        """
+        usernames = list(usernames)
+        data = requests.post(f"{self.uds_gateway_address}/batch_get", json={'keys': usernames},
+                             timeout=timeout).json()['data']
+        return self._store_addresses(usernames, data)
+
+    def _resolve(self, username: str) -> Tuple[str, bool]:
+        """
+        Returns the address of the app server associated with the provided username, from the address feed or the
+        address cache if possible and from the User Directory Service otherwise.
+        :param username: username of the user to get an address for
+        :return: the URL of the user's app server of the form host:port, and whether it came from the cache
+        :raises KeyError: if the user is not registered with the User Directory Service
+        """
+        address = self._cached_address(username)
+        if address is None:
+            return self._get_user_address(username), False
+        return address, True
+
+    def _issue_request(self, username: str, request: str, timeout: Optional[float] = None,
+                       headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        """
+        Issues the provided GET request to the app server associated with the provided username. The address of the
+        user's app server is obtained from the address feed, the address cache, or the UDS and the request is then
+        submitted to that server. If an address from the feed or the cache refuses the connection, it is dropped from
+        both and the request is retried once with a fresh address from the UDS.
         :param username: the username of the user whose app server to send the request to
         :param request: the request to issue
+        :param timeout: the number of seconds to wait for the app server, or None to wait indefinitely
+        :param headers: any additional request headers
         :return: the HTTP response from the app server
         """
-        return requests.get(f"http://{self._get_user_address(username)}/{request}")
+        address, cached = self._resolve(username)
+
+        try:
+            return requests.get(f"http://{address}/{request}", timeout=timeout, headers=headers)
+        except requests.ConnectionError:
+            if not cached:
+                raise
+
+        self._forget_address(username)
+        return requests.get(f"http://{self._get_user_address(username)}/{request}", timeout=timeout, headers=headers)
+
+    def get_page(self, username: str, entity: str, n: int, before: Optional[int] = None,
+                 since: Optional[int] = None, timeout: Optional[float] = None) -> Page:
+        """
+        Returns a page of at most n posts, likes, or reposts by the user with the specified username, ordered from
+        newest to oldest. Pass the before cursor of a page to get older entries, or the since cursor of a page to get
+        only entries added after it. Pages received from peers are cached and revalidated with the peer's ETag, so an
+        unchanged page is not transferred again.
+
+        If this AppInstance has a mirror, pages of the most recent entries are served from it whenever it holds enough
+        entries, even if the user's app server is offline, and are refreshed in the background once they are older
+        than the mirror's max_age.
+        :param username: the username of the user whose entries to get
+        :param entity: the entity to get: posts, likes, or reposts
+        :param n: the maximum number of entries to get
+        :param before: the cursor before which to get entries
+        :param since: the cursor at or after which to get entries
+        :param timeout: the number of seconds to wait for the user's app server, or None to wait indefinitely
+        :return: a page of Post objects (for posts) or post ids (for likes and reposts) and its cursors
+        """
+        if username == self.user.username:
+            return self.user.page(entity, n, before, since)
+        if self.mirror is not None and before is None and since is None:
+            return self._get_mirrored_page(username, entity, n, timeout)
+        return self._fetch_page(username, entity, n, before, since, timeout)
+
+    def _get_mirrored_page(self, username: str, entity: str, n: int, timeout: Optional[float] = None) -> Page:
+        """
+        Returns a page of the n most recent entries of the user with the specified username from the mirror. If the
+        mirror holds fewer than n of the user's entries, the page is requested from the user's app server and added to
+        the mirror; if the app server cannot be reached, the entries which are mirrored are returned instead.
+        :param username: the username of the user whose entries to get
+        :param entity: the entity to get: posts, likes, or reposts
+        :param n: the maximum number of entries to get
+        :param timeout: the number of seconds to wait for the user's app server, or None to wait indefinitely
+        :return: a page of Post objects (for posts) or post ids (for likes and reposts) and its cursors
+        :raises requests.RequestException: if the user's app server cannot be reached and nothing is mirrored
+        """
+        mirrored = self.mirror.page(username, entity, n)
+        if mirrored is not None:
+            page, stale = mirrored
+
+            # The page is complete if it holds n entries or reaches back to the user's first entry
+            if len(page.entries) >= n or page.before == 0:
+                if stale:
+                    self._refresh_mirror(username, entity)
+                return page
+
+        try:
+            page = self._fetch_page(username, entity, n, timeout=timeout)
+        except (requests.RequestException, KeyError):
+            if mirrored is None:
+                raise
+            return mirrored[0]
+
+        self.mirror.merge(username, entity, page)
+        return page
+
+    def _refresh_mirror(self, username: str, entity: str):
+        """
+        Requests the entries of the user with the specified username which are newer than the mirror in the background,
+        unless they are already being requested.
+        :param username: the username of the user whose entries to refresh
+        :param entity: the entity to refresh: posts, likes, or reposts
+        """
+        with self._refreshing_lock:
+            if (username, entity) in self._refreshing:
+                return
+            self._refreshing.add((username, entity))
+
+        def refresh():
+            try:
+                cursor = self.mirror.cursor(username, entity)
+                page = self._fetch_page(username, entity, self.mirror.max_entries, since=cursor,
+                                        timeout=self.mirror_refresh_timeout)
+
+                # Only the most recent entries are mirrored, so if the mirror fell too far behind, skip to them
+                if len(page.entries) == self.mirror.max_entries:
+                    page = self._fetch_page(username, entity, self.mirror.max_entries,
+                                            timeout=self.mirror_refresh_timeout)
+                self.mirror.merge(username, entity, page)
+            except (requests.RequestException, KeyError, ValueError):
+                # Keep serving the mirrored entries, and try again once they are older than max_age
+                self.mirror.touch(username, entity)
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard((username, entity))
+
+        self._refresher.submit(refresh)
+
+    def _fetch_page(self, username: str, entity: str, n: int, before: Optional[int] = None,
+                    since: Optional[int] = None, timeout: Optional[float] = None) -> Page:
+        """
+        Requests a page of at most n entries from the app server of the user with the specified username, revalidating
+        any cached copy of the page with its ETag. See get_page for the meaning of the parameters.
+        :return: a page of Post objects (for posts) or post ids (for likes and reposts) and its cursors
+        """
+        key, cached, request, headers = self._page_request(username, entity, n, before, since)
+        response = self._issue_request(username, request, timeout, headers=headers)
+        return self._read_page(entity, key, cached, response.status_code, response.headers, response.content)
 
     def get_posts(self, username: str, n: int) -> Iterable[Post]:
         """
@@ -180,11 +775,7 @@ class AppInstance:
         :param n: the number of posts to get
         :return: an iterable of the n most recent posts by the user with the specified username
         """
-        if username == self.user.username:
-            return self.user.get_posts(n)
-        else:
-            response = self._issue_request(username, f"posts?n={n}")
-            return [Post.deserialize(post) for post in json.loads(response.text)]
+        return self.get_page(username, 'posts', n).entries
 
     def get_likes(self, username: str, n: int) -> Iterable[str]:
         """
@@ -193,11 +784,7 @@ class AppInstance:
         :param n: the number of likes to get
         :return: an iterable of the n most recent likes by the user with the specified username
         """
-        if username == self.user.username:
-            return self.user.get_likes(n)
-        else:
-            response = self._issue_request(username, f"likes?n={n}")
-            return json.loads(response.text)
+        return self.get_page(username, 'likes', n).entries
 
     def get_reposts(self, username: str, n: int) -> Iterable[str]:
         """
@@ -206,32 +793,93 @@ class AppInstance:
         :param n: the number of reposts to get
         :return: an iterable of the n most recent reposts by the user with the specified username
         """
-        if username == self.user.username:
-            return self.user.get_reposts(n)
-        else:
-            response = self._issue_request(username, f"reposts?n={n}")
-            return json.loads(response.text)
+        return self.get_page(username, 'reposts', n).entries
 
-    def post(self, message: str):
+    def _get_peer_posts(self, username: str, n: int, timeout: float) -> List[Post]:
+        """
+        Returns the n most recent posts by the user with the specified username, waiting at most timeout seconds for
+        each request to the user's app server.
+        :param username: the username of the user whose posts to get
+        :param n: the number of posts to get
+        :param timeout: the number of seconds to wait for the user's app server
+        :return: a list of the n most recent posts by the user, ordered from newest to oldest
+        """
+        return self.get_page(username, 'posts', n, timeout=timeout).entries
+
+    def get_timeline(self, usernames: Iterable[str], n: int, timeout: float = 2.0,
+                     max_workers: int = 32) -> Tuple[List[Post], List[str]]:
+        """
+        Returns the n most recent posts across all of the users with the provided usernames, such as the users followed
+        by the current user. The posts of all users are requested concurrently and merged by the time at which they
+        were created. Users whose posts cannot be retrieved within timeout seconds, because their app server is slow,
+        offline, or not registered, are left out of the merge and reported instead.
+        :param usernames: the usernames of the users whose posts to merge
+        :param n: the number of posts to get
+        :param timeout: the number of seconds to wait in total, for the UDS and for all users' app servers to respond
+        :param max_workers: the maximum number of app servers to query at once
+        :return: a list of the n most recent posts across all of the users, ordered from newest to oldest, and a list
+        of the usernames of the users whose posts could not be retrieved in time
+        """
+        usernames = list(dict.fromkeys(usernames))
+        if not usernames:
+            return [], []
+
+        # Every stage only gets the time left before the deadline, so that the whole call takes at most timeout
+        deadline = time.monotonic() + timeout
+
+        # Resolve the addresses of all peers missing from the address cache with a single UDS request
+        uncached = [username for username in usernames
+                    if username != self.user.username and not self._is_known(username)]
+        if uncached:
+            try:
+                self._get_user_addresses(uncached, max(deadline - time.monotonic(), 0.001))
+            except (requests.RequestException, ValueError, KeyError):
+                # Fall back to resolving each peer individually
+                pass
+
+        remaining = max(deadline - time.monotonic(), 0.001)
+        executor = ThreadPoolExecutor(max_workers=min(len(usernames), max_workers))
+        futures = {executor.submit(self._get_peer_posts, username, n, remaining): username for username in usernames}
+        done, _ = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        timelines, timed_out = [], []
+        for future, username in futures.items():
+            if future in done and future.exception() is None:
+                timelines.append(future.result())
+            else:
+                timed_out.append(username)
+
+        # Each timeline is ordered from newest to oldest, so a k-way merge yields the n most recent posts overall
+        merged = heapq.merge(*timelines, key=lambda post: post.time, reverse=True)
+        return list(islice(merged, n)), timed_out
+
+    def post(self, message: str) -> Future:
         """
         Adds a new post to the user currently logged into this microblogging AppInstance.
         :param message: the message to include in the post
+        :return: a Future which is resolved once the post has been written to storage
+        :raises OSError: if the post could not be written by a synchronous writer
         """
-        self.user.post(message)
+        return self.user.post(message)
 
-    def like(self, post_id: str):
+    def like(self, post_id: str) -> Future:
         """
         Adds a new post to the list of posts liked by the user currently logged into this microblogging AppInstance.
         :param post_id: the id of the post to like
+        :return: a Future which is resolved once the like has been written to storage
+        :raises OSError: if the like could not be written by a synchronous writer
         """
-        self.user.like(post_id)
+        return self.user.like(post_id)
 
-    def repost(self, post_id: str):
+    def repost(self, post_id: str) -> Future:
         """
         Adds a new post to the list of posts reposted by the user currently logged into this microblogging AppInstance.
         :param post_id: the id of the post to repost
+        :return: a Future which is resolved once the repost has been written to storage
+        :raises OSError: if the repost could not be written by a synchronous writer
         """
-        self.user.repost(post_id)
+        return self.user.repost(post_id)
 
 
 class MicroblogCommandLineInterface:
@@ -251,6 +899,7 @@ class MicroblogCommandLineInterface:
           4. Create a post
           5. Like a post
           6. Repost a post
+          7. Get a timeline of several users' posts
     """
 
     def __init__(self, app_instance: AppInstance):
@@ -286,12 +935,17 @@ class MicroblogCommandLineInterface:
                     self.like_post()
                 elif option == 6:
                     self.repost_post()
+                elif option == 7:
+                    self.get_timeline()
                 else:
                     print("Invalid option, please try again.")
 
             except requests.ConnectionError as e:
                 print(f"Error: could not connect to user.")
 
+            except requests.HTTPError as e:
+                print(f"Error: {e}")
+
             except ValueError:
                 print("Please enter an integer!")
 
@@ -346,6 +1000,22 @@ class MicroblogCommandLineInterface:
         except KeyError:
             print("Error: User does not exist.")
 
+    def get_timeline(self):
+        """
+        This method handles the "Get a timeline of several users' posts" menu item by requesting a list of usernames
+        and the number of posts desired from the user and forwarding the request for a timeline to the AppInstance. The
+        most recent posts across all of the users will be printed to the command line, followed by a list of users who
+        could not be reached.
+        """
+        usernames = [username.strip() for username in input("Enter usernames separated by commas: ").split(',')]
+        n = int(input("How many posts would you like to see? "))
+
+        posts, timed_out = self.app_instance.get_timeline([username for username in usernames if username], n)
+        for post in posts:
+            print(post)
+        if timed_out:
+            print(f"Could not reach: {', '.join(timed_out)}")
+
     def create_post(self):
         """
         This method handles the "Create a post" menu item by requesting the required input from the user and
@@ -353,8 +1023,12 @@ class MicroblogCommandLineInterface:
         application. A success message will be displayed if the post is created successfully.
         """
         message = input("Enter message: ")
-        self.app_instance.post(message)
-        print("Message created!")
+        try:
+            self.app_instance.post(message).result()
+        except OSError as e:
+            print(f"Error: could not save the post: {e}")
+        else:
+            print("Message created!")
 
     def like_post(self):
         """
@@ -363,7 +1037,10 @@ class MicroblogCommandLineInterface:
         application.
         """
         id = input("Enter id of the post to like: ")
-        self.app_instance.like(id)
+        try:
+            self.app_instance.like(id).result()
+        except OSError as e:
+            print(f"Error: could not save the like: {e}")
 
     def repost_post(self):
         """
@@ -372,4 +1049,7 @@ class MicroblogCommandLineInterface:
         application.
         """
         id = input("Enter id of the post to repost: ")
-        self.app_instance.repost(id)
+        try:
+            self.app_instance.repost(id).result()
+        except OSError as e:
+            print(f"Error: could not save the repost: {e}")
@@ -0,0 +1,202 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Upper bounds in seconds of the buckets of every latency histogram
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """
+    Formats label pairs as a Prometheus label set, escaping their values.
+    :param labels: the (name, value) pairs of the labels, sorted by name
+    :return: the label set, such as {entity="posts",status="200"}, or an empty string if there are no labels
+    """
+    if not labels:
+        return ""
+    pairs = (name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+             for name, value in labels)
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """
+    This class represents a monotonically increasing count, kept separately for every set of label values.
+    """
+
+    def __init__(self, name: str, help: str, registry: "Metrics" = None):
+        """
+        Instantiates a new Counter and adds it to the provided registry.
+        :param name: the name of the metric
+        :param help: a description of the metric
+        :param registry: the registry from which the metric is rendered, defaults to the shared registry
+        """
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self._values: Dict[Tuple, float] = {}
+        (registry if registry is not None else metrics).register(self)
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        """
+        Increments the count of the provided label values.
+        :param amount: the amount by which to increment the count
+        :param labels: the label values of the count to increment
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        """Returns the lines of this counter in the Prometheus text exposition format."""
+        with self.lock:
+            values = list(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + \
+               [f"{self.name}{_format_labels(key)} {value}" for key, value in values]
+
+
+class Histogram:
+    """
+    This class represents the distribution of observed values, such as latencies in seconds, over a fixed set of
+    buckets, kept separately for every set of label values. An observation costs a bisection and a short critical
+    section; the bucket counts are only made cumulative when the histogram is rendered.
+    """
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS, registry: "Metrics" = None):
+        """
+        Instantiates a new Histogram and adds it to the provided registry.
+        :param name: the name of the metric
+        :param help: a description of the metric
+        :param buckets: the upper bounds of the buckets; a +Inf bucket is always added
+        :param registry: the registry from which the metric is rendered, defaults to the shared registry
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = Lock()
+
+        # Maps each set of label values to its count in every bucket (the last being +Inf), sum, and count
+        self._series: Dict[Tuple, list] = {}
+        (registry if registry is not None else metrics).register(self)
+
+    def observe(self, value: float, **labels: str):
+        """
+        Records an observed value.
+        :param value: the value to record
+        :param labels: the label values of the distribution to which the value belongs
+        """
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Records the number of seconds spent in a with block or, when used as a decorator, in each call of a function.
+        :param labels: the label values of the distribution to which the durations belong
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        """Returns the lines of this histogram in the Prometheus text exposition format."""
+        with self.lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Metrics:
+    """
+    This class represents a registry of metrics which are rendered together, such as on the /metrics endpoint of an
+    AppRequestServer.
+    """
+
+    def __init__(self):
+        """Instantiates a new, empty Metrics registry."""
+        self.lock = Lock()
+        self._metrics: List = []
+
+    def register(self, metric):
+        """
+        Adds a metric to this registry.
+        :param metric: the Counter or Histogram to add
+        """
+        with self.lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Returns every metric in this registry in the Prometheus text exposition format."""
+        with self.lock:
+            registered = list(self._metrics)
+        return "\n".join(line for metric in registered for line in metric.render()) + "\n"
+
+
+# The registry shared by every component of the peer application in this process
+metrics = Metrics()
+
+LOCK_WAIT_SECONDS = Histogram('microblog_lock_wait_seconds', "Time spent waiting to acquire a lock, by lock.")
+
+
+class TimedLock:
+    """
+    This class represents a drop-in replacement for threading.Lock which records how long every blocking acquisition
+    waited for the lock in the microblog_lock_wait_seconds histogram.
+    """
+
+    def __init__(self, name: str):
+        """
+        Instantiates a new, unlocked TimedLock.
+        :param name: the value of the lock label under which wait times are recorded
+        """
+        self.name = name
+        self._lock = Lock()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        """
+        Acquires the lock, recording how long it took if blocking.
+        :param blocking: whether to wait for the lock to be released
+        :param timeout: the maximum number of seconds to wait, or -1 to wait indefinitely
+        :return: True if the lock was acquired, False otherwise
+        """
+        if not blocking:
+            return self._lock.acquire(False)
+
+        started = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        if acquired:
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, lock=self.name)
+        return acquired
+
+    def release(self):
+        """Releases the lock."""
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,210 @@
+from .posts import Post
+from .timeline import Page
+
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote, unquote
+
+# The entities of a peer which are mirrored
+ENTITIES = ('posts', 'likes', 'reposts')
+
+
+class MirroredTimeline(NamedTuple):
+    """
+    This class represents the mirrored part of one entity of a peer's timeline: a run of consecutive entries, ordered
+    from oldest to newest, starting at position start of the peer's timeline, along with the time at which it was last
+    refreshed from the peer. Positions in a timeline never change, so the run always ends at the since cursor from which
+    to request newer entries.
+    """
+    start: int
+    entries: List
+    refreshed_at: float
+
+    @property
+    def cursor(self) -> int:
+        """Returns the position after the newest mirrored entry."""
+        return self.start + len(self.entries)
+
+
+class PeerMirror:
+    """
+    This class represents a local, disk-persisted mirror of the most recent posts, likes, and reposts of other users, so
+    that reading a followed user does not wait for, or depend on, that user's app server. The mirror only stores what it
+    is given; AppInstance serves pages from it, refreshes it from peers in the background once it is older than max_age
+    seconds, and falls back to it when a peer cannot be reached.
+
+    At most max_entries of the most recent entries of each entity are kept for each user. When more than max_users users
+    are mirrored, the least recently read user is evicted, both from memory and from disk. Each entity of a user is
+    stored as a JSON file in directory, which is loaded when the user is first read after a restart.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 1000, max_users: int = 128, max_age: float = 5.0):
+        """
+        Instantiates a new PeerMirror, indexing any users already mirrored in the provided directory.
+        :param directory: the directory in which to store the mirror
+        :param max_entries: the maximum number of entries mirrored per entity of each user
+        :param max_users: the maximum number of users mirrored
+        :param max_age: the number of seconds after which a mirrored entity should be refreshed from its peer
+        """
+        if max_entries < 1 or max_users < 1:
+            raise ValueError("Entry and user limits must both be at least 1.")
+
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_users = max_users
+        self.max_age = max_age
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Maps each mirrored username, least recently read first, to its loaded entities
+        self._users: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Index the users on disk from least to most recently written, so that the oldest are evicted first
+        files = [name for name in os.listdir(directory) if name.endswith('.json')]
+        for name in sorted(files, key=lambda name: os.path.getmtime(os.path.join(directory, name))):
+            username = unquote(name[:-len('.json')].rpartition('_')[0])
+            self._users[username] = {}
+            self._users.move_to_end(username)
+        with self.lock:
+            self._evict()
+
+    def _path(self, username: str, entity: str) -> str:
+        # Usernames are quoted so that they cannot name a path outside of the mirror directory
+        return os.path.join(self.directory, f"{quote(username, safe='')}_{entity}.json")
+
+    def _load(self, username: str, entity: str) -> Optional[MirroredTimeline]:
+        """
+        Returns the mirrored entity of a user, reading it from disk if it has not been read since a restart. Caller
+        holds the lock.
+        :param username: the username of the user
+        :param entity: the entity: posts, likes, or reposts
+        :return: the mirrored entity, or None if it is not mirrored
+        """
+        entities = self._users.get(username)
+        if entities is None:
+            return None
+        if entity not in entities:
+            try:
+                with open(self._path(username, entity), "r") as f:
+                    stored = json.load(f)
+            except (FileNotFoundError, ValueError):
+                entities[entity] = None
+            else:
+                entries = stored['entries']
+                if entity == 'posts':
+                    entries = [Post.deserialize(post) for post in entries]
+                entities[entity] = MirroredTimeline(stored['start'], entries, stored['refreshed_at'])
+        return entities[entity]
+
+    def _store(self, username: str, entity: str, mirrored: MirroredTimeline):
+        """
+        Replaces the mirrored entity of a user in memory and on disk. Caller holds the lock.
+        :param username: the username of the user
+        :param entity: the entity: posts, likes, or reposts
+        :param mirrored: the new mirrored entity
+        """
+        self._users.setdefault(username, {})[entity] = mirrored
+        self._users.move_to_end(username)
+
+        entries = [post.serialize() for post in mirrored.entries] if entity == 'posts' else mirrored.entries
+        path = self._path(username, entity)
+        with open(path + ".tmp", "w") as f:
+            json.dump({'start': mirrored.start, 'refreshed_at': mirrored.refreshed_at, 'entries': entries}, f)
+        os.replace(path + ".tmp", path)
+
+        self._evict()
+
+    def _evict(self):
+        """Evicts the least recently read users until at most max_users remain. Caller holds the lock."""
+        while len(self._users) > self.max_users:
+            username, _ = self._users.popitem(last=False)
+            for entity in ENTITIES:
+                try:
+                    os.remove(self._path(username, entity))
+                except FileNotFoundError:
+                    pass
+            self.evictions += 1
+
+    def page(self, username: str, entity: str, n: int) -> Optional[Tuple[Page, bool]]:
+        """
+        Returns a page of at most n of the most recent mirrored entries of a user, ordered from newest to oldest, with
+        the same cursors as the page the user's app server would return. The page holds fewer than n entries if fewer
+        are mirrored.
+        :param username: the username of the user
+        :param entity: the entity: posts, likes, or reposts
+        :param n: the maximum number of entries in the page
+        :return: the page and whether the mirrored entity is older than max_age, or None if it is not mirrored
+        """
+        with self.lock:
+            mirrored = self._load(username, entity)
+            if mirrored is None:
+                self.misses += 1
+                return None
+            self._users.move_to_end(username)
+            self.hits += 1
+
+        n = max(n, 0)
+        entries = mirrored.entries[len(mirrored.entries) - min(n, len(mirrored.entries)):][::-1]
+        page = Page(entries, mirrored.cursor - len(entries), mirrored.cursor)
+        return page, time.time() - mirrored.refreshed_at > self.max_age
+
+    def cursor(self, username: str, entity: str) -> Optional[int]:
+        """
+        Returns the since cursor from which to request the entries of a user which are newer than the mirror.
+        :param username: the username of the user
+        :param entity: the entity: posts, likes, or reposts
+        :return: the position after the newest mirrored entry, or None if the entity is not mirrored
+        """
+        with self.lock:
+            mirrored = self._load(username, entity)
+            return mirrored.cursor if mirrored is not None else None
+
+    def merge(self, username: str, entity: str, page: Page):
+        """
+        Adds a page received from a user's app server to the mirror and marks the entity as refreshed. A page which
+        overlaps or adjoins the newest mirrored entry is merged with the mirrored entries. Any other page replaces them:
+        either it leaves a gap after them, or it shows that the user's timeline is now shorter than the mirror, which
+        only happens if the user lost data.
+        :param username: the username of the user
+        :param entity: the entity: posts, likes, or reposts
+        :param page: a page of the newest entries, or of the entries since the mirror's cursor, ordered from newest to
+        oldest, with the cursors returned by the user's app server
+        """
+        received = page.entries[::-1]
+        with self.lock:
+            mirrored = self._load(username, entity)
+
+            if mirrored is None or page.before > mirrored.cursor or page.since < mirrored.cursor:
+                start, entries = page.before, received
+            else:
+                start = min(mirrored.start, page.before)
+                entries = mirrored.entries[:max(page.before - mirrored.start, 0)] + received
+
+            # Keep only the most recent entries
+            excess = max(len(entries) - self.max_entries, 0)
+            self._store(username, entity, MirroredTimeline(start + excess, entries[excess:], time.time()))
+
+    def touch(self, username: str, entity: str):
+        """
+        Marks a mirrored entity as refreshed without changing it, such as after failing to reach the user's app server,
+        so that it is not refreshed again until it is older than max_age.
+        :param username: the username of the user
+        :param entity: the entity: posts, likes, or reposts
+        """
+        with self.lock:
+            mirrored = self._load(username, entity)
+            if mirrored is not None:
+                self._users[username][entity] = mirrored._replace(refreshed_at=time.time())
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters and current size of this mirror."""
+        with self.lock:
+            return {'users': len(self._users), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,71 @@
+from .timeline import Page
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Hashable, Optional, Tuple
+
+
+class PageCache:
+    """
+    This class represents a client-side cache of pages received from peers, along with the ETag each page was served
+    with. Cached pages are not trusted blindly: the ETag is sent back to the peer in an If-None-Match header, and the
+    cached page is only reused when the peer answers 304 Not Modified. When the cache holds max_size pages, the least
+    recently used page is evicted.
+    """
+
+    def __init__(self, max_size: int = 256):
+        """
+        Instantiates a new, empty PageCache.
+        :param max_size: the maximum number of pages in the cache
+        """
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1.")
+
+        self.max_size = max_size
+        self.lock = Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+        self.revalidations = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[str, Page]]:
+        """
+        Looks up a cached page.
+        :param key: the key of the page, such as (username, entity, n, before, since)
+        :return: the ETag and the cached page, or None if the page is not cached
+        """
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, etag: str, page: Page):
+        """
+        Caches a page along with its ETag, evicting the least recently used page if the cache is full.
+        :param key: the key of the page
+        :param etag: the ETag the page was served with
+        :param page: the page
+        """
+        with self.lock:
+            self._entries[key] = (etag, page)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def record(self, revalidated: bool):
+        """
+        Records the outcome of a conditional request.
+        :param revalidated: True if the peer answered 304 Not Modified, False if it sent a new page
+        """
+        with self.lock:
+            if revalidated:
+                self.revalidations += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters and current size of this cache."""
+        with self.lock:
+            return {'size': len(self._entries), 'revalidations': self.revalidations, 'misses': self.misses}
@@ -0,0 +1,141 @@
+from .posts import POSTS_CONTENT_TYPE, Post, decode_posts
+from .timeline import Page
+
+import json
+import requests
+from typing import Dict, Hashable, Iterable, Mapping, Optional, Tuple
+
+
+class PeerReader:
+    """
+    This class holds the parts of reading from peers and the User Directory Service which do not depend on how requests
+    are sent: resolving addresses from the address feed and the address cache, building conditional page requests, and
+    turning responses into pages. It is shared by AppInstance, which sends requests with the requests library, and
+    AsyncAppInstance, which sends them over pooled asyncio connections. Subclasses set user, address_cache, page_cache,
+    and address_feed.
+    """
+
+    def _cached_address(self, username: str) -> Optional[str]:
+        """
+        Returns the address of the app server associated with the provided username if it can be resolved without the
+        UDS, from the address feed or the address cache.
+        :param username: username of the user to get an address for
+        :return: the URL of the user's app server of the form host:port, or None if the UDS must be asked
+        :raises KeyError: if the address cache knows that the user is not registered with the UDS
+        """
+        if self.address_feed is not None:
+            address = self.address_feed.get(username)
+            if address is not None:
+                return address
+
+        cached, address = self.address_cache.get(username)
+        if not cached:
+            return None
+        if address is None:
+            raise KeyError(username)
+        return address
+
+    def _is_known(self, username: str) -> bool:
+        """
+        Returns whether the address of the user with the provided username can be resolved without the UDS.
+        :param username: the username of the user to check
+        :return: True if the user is in the address feed or the address cache
+        """
+        if self.address_feed is not None and self.address_feed.get(username) is not None:
+            return True
+        return username in self.address_cache
+
+    def _forget_address(self, username: str):
+        """
+        Removes the user with the provided username from the address feed and the address cache, for example because
+        the address refused a connection, so that the next lookup asks the UDS.
+        :param username: the username of the user to remove
+        """
+        if self.address_feed is not None:
+            self.address_feed.invalidate(username)
+        self.address_cache.invalidate(username)
+
+    def _store_address(self, username: str, entry: Mapping) -> str:
+        """
+        Stores the address returned by the UDS for a single user in the address cache.
+        :param username: the username which was looked up
+        :param entry: the decoded UDS response
+        :return: the URL of the user's app server of the form host:port
+        :raises KeyError: if the user is not registered with the User Directory Service
+        """
+        address = entry.get('value')
+        self.address_cache.put(username, address)
+
+        if address is None:
+            raise KeyError(username)
+        return address
+
+    def _store_addresses(self, usernames: Iterable[str], data: Mapping[str, Mapping]) -> Dict[str, str]:
+        """
+        Stores the addresses returned by a UDS batch lookup in the address cache, including unknown users.
+        :param usernames: the usernames which were looked up
+        :param data: the entries of the registered users, as returned by the UDS
+        :return: a dict mapping the username of each registered user to the URL of its app server of the form host:port
+        """
+        addresses = {username: entry['value'] for username, entry in data.items()}
+        for username in usernames:
+            self.address_cache.put(username, addresses.get(username))
+        return addresses
+
+    def _page_request(self, username: str, entity: str, n: int, before: Optional[int] = None,
+                      since: Optional[int] = None) -> Tuple[Hashable, Optional[Tuple[str, Page]], str, Dict[str, str]]:
+        """
+        Builds the request for a page of a peer's entries, which revalidates any cached copy of the page with its ETag
+        and asks for posts in their binary encoding.
+        :param username: the username of the user whose entries to get
+        :param entity: the entity to get: posts, likes, or reposts
+        :param n: the maximum number of entries to get
+        :param before: the cursor before which to get entries
+        :param since: the cursor at or after which to get entries
+        :return: the page cache key, the cached ETag and page or None, the request path relative to the peer's address,
+        and the request headers
+        """
+        key = (username, entity, n, before, since)
+        cached = self.page_cache.get(key)
+
+        query = f"n={n}" + (f"&before={before}" if before is not None else "") + \
+            (f"&since={since}" if since is not None else "")
+        headers = {'Accept': f"{POSTS_CONTENT_TYPE}, application/json"} if entity == 'posts' else {}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        return key, cached, f"{entity}?{query}", headers
+
+    def _read_page(self, entity: str, key: Hashable, cached: Optional[Tuple[str, Page]], status: int,
+                   headers: Mapping[str, str], body: bytes) -> Page:
+        """
+        Turns a peer's response to a request built by _page_request into a page, and caches the page with its ETag.
+        :param entity: the entity which was requested: posts, likes, or reposts
+        :param key: the page cache key returned by _page_request
+        :param cached: the cached ETag and page returned by _page_request
+        :param status: the HTTP status code of the response
+        :param headers: the response headers, which must be looked up by lower-case name
+        :param body: the response body
+        :return: a page of Post objects (for posts) or post ids (for likes and reposts) and its cursors
+        :raises requests.HTTPError: if the peer did not answer with a page, such as when it failed or was overloaded
+        """
+        if status == 304 and cached:
+            self.page_cache.record(revalidated=True)
+            return cached[1]
+        self.page_cache.record(revalidated=False)
+
+        # Error responses carry no page, so they must not reach the decoder
+        if status != 200:
+            raise requests.HTTPError(f"Peer answered {entity} request with status {status}.")
+
+        # Peers which do not support the binary encoding of posts answer with JSON
+        if headers.get('content-type', '').startswith(POSTS_CONTENT_TYPE):
+            entries = decode_posts(body)
+        else:
+            entries = json.loads(body)
+            if entity == 'posts':
+                entries = [Post.deserialize(post) for post in entries]
+        page = Page(entries, int(headers['x-before-cursor']), int(headers['x-since-cursor']))
+
+        if 'etag' in headers:
+            self.page_cache.put(key, headers['etag'], page)
+        return page
@@ -1,13 +1,101 @@
+import os
+import time
 import uuid
 import json
-from typing import Tuple
+import struct
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# The media type of the compact binary encoding of a batch of posts, which peers may request instead of JSON
+POSTS_CONTENT_TYPE = 'application/x-microblog-posts'
+
+# Encoded batch of posts: magic, number of posts, and number of distinct usernames, followed by the columns
+_BATCH_MAGIC = b'MBP1'
+_BATCH_HEADER = struct.Struct('<4sIH')
+_LENGTH = struct.Struct('<H')
+
+# Posts are immutable, so their slots are only ever set through object
+_new = object.__new__
+_set = object.__setattr__
+
+# State of the post id generator: the millisecond timestamp and sequence number of the most recently generated id
+_id_lock = Lock()
+_last_id = [0, 0]
+
+
+def time_ordered_id() -> uuid.UUID:
+    """
+    Generates a new, time-ordered unique identifier in the UUID version 7 layout: a 48-bit millisecond Unix timestamp,
+    followed by a 12-bit sequence number and 62 random bits. Identifiers generated by the same process are strictly
+    increasing, so sorting identifiers (or their hex representations) sorts them by creation time.
+    :return: the new identifier
+    """
+    with _id_lock:
+        ms = time.time_ns() // 1_000_000
+        last_ms, last_seq = _last_id
+
+        if ms > last_ms:
+            # Start each millisecond at a random sequence number in the lower half of the range
+            seq = int.from_bytes(os.urandom(2), 'big') & 0x7FF
+        else:
+            # Clock has not advanced (or went backwards): keep incrementing, borrowing from the next millisecond
+            ms, seq = last_ms, last_seq + 1
+            if seq > 0xFFF:
+                ms, seq = ms + 1, 0
+
+        _last_id[:] = [ms, seq]
+
+    rand = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    return uuid.UUID(int=(ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | seq << 64 | 0b10 << 62 | rand)
+
+
+def id_time(post_id: uuid.UUID) -> float:
+    """
+    Returns the creation time embedded in the provided identifier, which may be a time-ordered (version 7) identifier
+    or a legacy time-based (version 1) identifier.
+    :param post_id: the identifier
+    :return: the creation time, in seconds since the epoch
+    """
+    if post_id.version == 7:
+        return (post_id.int >> 80) / 1000
+    return (post_id.time - 0x01b21dd213814000) / 1e7
+
+
+class Reaction(NamedTuple):
+    """
+    This class represents a like or repost of a post by a user, along with the time at which it was made. Likes and
+    reposts made before times were recorded have a time of None.
+    """
+    post_id: str
+    time: Optional[float] = None
+
+    def dumps(self) -> str:
+        """Serializes this Reaction into a string."""
+        return self.post_id if self.time is None else f"{self.post_id}\t{round(self.time * 1000)}"
+
+    @classmethod
+    def loads(cls, reaction: str):
+        """
+        Creates a new Reaction based on the serialized reaction in the provided string.
+        :param reaction: a string containing a serialized Reaction, or a bare post id
+        :return: the new Reaction object
+        """
+        post_id, sep, ms = reaction.strip().rpartition("\t")
+        return cls(post_id, int(ms) / 1000) if sep and ms.isdigit() else cls(reaction.strip())
 
 
 class Post:
     """
     This class represents a post within the microblogging application. A post can be uniquely identified by the tuple of
-    username, post_id. This tuple can be obtained using the id property.
+    username, post_id. This tuple can be obtained using the id property. New posts are given time-ordered post ids, so
+    the posts of a user sort by creation time when sorted by post id.
+
+    Posts are immutable and slotted, since a user's timeline may hold many thousands of them. The post id is kept as its
+    hex string and only parsed into a UUID when the post_id property is first read; the creation time of a time-ordered
+    post id is read straight from its hex string. The parsed id and creation time are cached in slots which are left
+    unset until they are first needed.
     """
+    __slots__ = ('message', 'username', '_hex', '_uuid', '_time')
 
     def __init__(self, message: str, username: str, post_id: str = None):
         """
@@ -15,26 +103,99 @@ class Post:
 
         :param message: the message in the post
         :param username: the username of the user who created the post
+        :param post_id: the hex string of the id of an existing post, or None to give the post a new id
+        :raises ValueError: if the message is longer than 160 characters or post_id is not a well-formed id
         """
 
         if len(message) > 160:
             raise ValueError("Messages must be 160 characters or less.")
 
-        self.message = message
-        self.username = username
-        self.post_id = uuid.UUID(hex=post_id) if post_id else uuid.uuid1()
+        generated = None
+        if not post_id:
+            generated = time_ordered_id()
+            post_id = generated.hex
+        elif len(post_id) != 32:
+            # Normalize ids given in any other format accepted by UUID, such as with hyphens
+            post_id = uuid.UUID(hex=post_id).hex
+        elif len(bytes.fromhex(post_id)) != 16:
+            # The id is only parsed into a UUID when first needed, so malformed ids must be rejected here; whitespace
+            # accepted by bytes.fromhex leaves fewer than 16 bytes
+            raise ValueError("Post ids must be 32 hexadecimal digits.")
+
+        _set(self, 'message', message)
+        _set(self, 'username', username)
+        _set(self, '_hex', post_id.lower())
+        if generated is not None:
+            _set(self, '_uuid', generated)
+
+    @classmethod
+    def _create(cls, message: str, username: str, post_id: str):
+        """
+        Creates a Post from fields which have already been validated, such as those checked by decode_posts, without
+        validating them again.
+        :param message: the message in the post
+        :param username: the username of the user who created the post
+        :param post_id: the lower-case, 32 character hex string of the id of the post
+        :return: the new Post object
+        """
+        post = _new(cls)
+        _set(post, 'message', message)
+        _set(post, 'username', username)
+        _set(post, '_hex', post_id)
+        return post
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Posts are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Posts are immutable.")
+
+    def __reduce__(self):
+        return Post, (self.message, self.username, self._hex)
+
+    def __eq__(self, other):
+        if not isinstance(other, Post):
+            return NotImplemented
+        return self._hex == other._hex and self.username == other.username and self.message == other.message
+
+    def __hash__(self):
+        return hash((self.username, self._hex))
+
+    @property
+    def post_id(self) -> uuid.UUID:
+        """Returns the id of this Post, parsing it on first use."""
+        try:
+            return self._uuid
+        except AttributeError:
+            _set(self, '_uuid', uuid.UUID(hex=self._hex))
+            return self._uuid
+
+    @property
+    def hex(self) -> str:
+        """Returns the id of this Post as a lower-case, 32 character hex string."""
+        return self._hex
 
     @property
     def id(self) -> Tuple[str, uuid.UUID]:
         """Returns the unique identifier of this Post."""
         return self.username, self.post_id
 
+    @property
+    def time(self) -> float:
+        """Returns the time at which this Post was created, in seconds since the epoch."""
+        try:
+            return self._time
+        except AttributeError:
+            # The version is the 13th hex digit; a time-ordered id starts with its millisecond timestamp
+            _set(self, '_time', int(self._hex[:12], 16) / 1000 if self._hex[12] == '7' else id_time(self.post_id))
+            return self._time
+
     def __str__(self):
-        return f"Post(id={self.post_id.hex}, user={self.username}, '{self.message}')"
+        return f"Post(id={self._hex}, user={self.username}, '{self.message}')"
 
     def serialize(self) -> dict:
         """Serializes this Post into a dictionary."""
-        return {'post_id': self.post_id.hex, 'username': self.username, 'message': self.message}
+        return {'post_id': self._hex, 'username': self.username, 'message': self.message}
 
     def dumps(self) -> str:
         """Serializes this Post into a string."""
@@ -57,3 +218,77 @@ class Post:
         :return: the new Post object
         """
         return cls.deserialize(json.loads(post))
+
+
+def encode_posts(posts: List[Post]) -> bytes:
+    """
+    Encodes a batch of posts in the compact binary format served to peers which accept POSTS_CONTENT_TYPE. The batch is
+    stored column by column: a header holding the number of posts and of distinct usernames, the length-prefixed
+    usernames, the 16 raw bytes of every post id, the index of every post's username, the length in characters of every
+    message, and finally all of the messages concatenated into a single utf-8 string. Usernames are stored only once,
+    and every column can be decoded with a single call rather than once per post.
+    :param posts: the posts to encode
+    :return: the encoded batch
+    """
+    usernames: Dict[str, int] = {}
+    indices = [usernames.setdefault(post.username, len(usernames)) for post in posts]
+
+    parts = [_BATCH_HEADER.pack(_BATCH_MAGIC, len(posts), len(usernames))]
+    for username in usernames:
+        encoded = username.encode()
+        parts.append(_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+
+    parts.append(bytes.fromhex("".join(post._hex for post in posts)))
+    parts.append(struct.pack(f"<{len(posts)}H", *indices))
+    parts.append(struct.pack(f"<{len(posts)}H", *(len(post.message) for post in posts)))
+    parts.append("".join(post.message for post in posts).encode())
+    return b"".join(parts)
+
+
+def decode_posts(data: bytes) -> List[Post]:
+    """
+    Decodes a batch of posts encoded by encode_posts.
+    :param data: the encoded batch
+    :return: the decoded posts, in the order in which they were encoded
+    :raises ValueError: if the data is not a well-formed batch of posts
+    """
+    try:
+        magic, count, n_usernames = _BATCH_HEADER.unpack_from(data)
+        if magic != _BATCH_MAGIC:
+            raise ValueError("Not an encoded batch of posts.")
+
+        offset = _BATCH_HEADER.size
+        usernames = []
+        for _ in range(n_usernames):
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            usernames.append(data[offset:offset + length].decode())
+            offset += length
+
+        ids = data[offset:offset + 16 * count].hex()
+        offset += 16 * count
+        indices = struct.unpack_from(f"<{count}H", data, offset)
+        offset += 2 * count
+        lengths = struct.unpack_from(f"<{count}H", data, offset)
+        offset += 2 * count
+        messages = data[offset:].decode()
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed batch of posts: {e}")
+
+    if len(ids) != 32 * count or len(messages) != sum(lengths):
+        raise ValueError("Malformed batch of posts: truncated columns.")
+
+    # Batches come from other peers, so check everything that Post would check before creating posts unvalidated
+    if count and max(indices) >= n_usernames:
+        raise ValueError("Malformed batch of posts: username index out of range.")
+    if count and max(lengths) > 160:
+        raise ValueError("Malformed batch of posts: messages must be 160 characters or less.")
+
+    posts = []
+    start = 0
+    for i in range(count):
+        end = start + lengths[i]
+        posts.append(Post._create(messages[start:end], usernames[indices[i]], ids[32 * i:32 * i + 32]))
+        start = end
+    return posts
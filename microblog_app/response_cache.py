@@ -0,0 +1,102 @@
+from .metrics import Counter
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+LOOKUPS = Counter('microblog_response_cache_lookups_total', "Response cache lookups, by result.")
+
+
+class ResponseCache:
+    """
+    This class represents a server-side cache of the encoded response bodies of an AppRequestServer, so that repeated
+    requests for the same page of an unchanged entity are answered without rebuilding or re-encoding the page. Each
+    response is keyed by its entity and query, and is stored along with the version of the entity it was built from and
+    its response headers. When the cached bodies exceed max_bytes in total, the least recently used responses are
+    evicted.
+
+    Writes to an entity invalidate its cached responses, leaving those of the user's other entities in place. The
+    version stored with each response also guards against a response built before a write being cached after it: a
+    response is only returned for the version it was built from, which its ETag is derived from.
+    """
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        """
+        Instantiates a new, empty ResponseCache.
+        :param max_bytes: the maximum total size in bytes of the cached response bodies
+        """
+        if max_bytes < 1:
+            raise ValueError("Cache size must be at least 1 byte.")
+
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+
+        # Maps each (entity, n, before, since, binary) key to the version, body, and headers of its response
+        self._entries: OrderedDict = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Tuple, version: int) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        """
+        Looks up a cached response.
+        :param key: the key of the response, whose first element is its entity
+        :param version: the current version of the entity
+        :return: the body and headers of the response, or None if no response was cached for this version
+        """
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                LOOKUPS.inc(result='miss')
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+        LOOKUPS.inc(result='hit')
+        return entry[1], entry[2]
+
+    def put(self, key: Tuple, version: int, body: bytes, headers: Dict[str, str]):
+        """
+        Caches a response, evicting the least recently used responses if the cache is full. Responses larger than the
+        whole cache are not cached.
+        :param key: the key of the response, whose first element is its entity
+        :param version: the version of the entity from which the response was built
+        :param body: the encoded response body
+        :param headers: the response headers
+        """
+        if len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+
+            self._entries[key] = (version, body, headers)
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, entity: str):
+        """
+        Removes the cached responses of the provided entity, which are out of date after a write to it.
+        :param entity: the entity which was written: posts, likes, or reposts
+        """
+        with self.lock:
+            stale = [key for key in self._entries if key[0] == entity]
+            for key in stale:
+                self.size -= len(self._entries.pop(key)[1])
+            self.invalidations += len(stale)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters and current size of this cache."""
+        with self.lock:
+            return {'size': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
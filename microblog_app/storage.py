@@ -0,0 +1,499 @@
+import os
+import sys
+import mmap
+import zlib
+import struct
+from array import array
+from bisect import bisect_right
+from threading import Lock
+from typing import Dict, Iterator, List, TextIO
+
+from .metrics import Histogram
+
+# The entities that make up a user's state
+ENTITIES = ('posts', 'likes', 'reposts')
+
+STORAGE_SECONDS = Histogram('microblog_storage_duration_seconds',
+                            "Time spent reading and writing user state, by backend and operation.")
+
+
+class CorruptRecordError(Exception):
+    """
+    This error indicates that a record read from a segment log does not match the checksum stored in its header.
+    """
+    pass
+
+
+class TextFileStorage:
+    """
+    This class represents the original storage backend of the microblogging application, in which each entity of a
+    user's state is stored in a newline-delimited text file at <state_dir>/<username>_<entity>.
+    """
+
+    def __init__(self, username: str, state_dir: str = "state"):
+        """
+        Instantiates a new TextFileStorage for the user with the provided username.
+        :param username: the username of the user whose state to store
+        :param state_dir: the directory in which the state files are stored
+        """
+        self.username = username
+        self.state_dir = state_dir
+
+        # Append handles are opened on first write and held open until the storage is closed
+        self._files: Dict[str, TextIO] = {}
+        self.lock = Lock()
+
+    def _path(self, entity: str) -> str:
+        return os.path.join(self.state_dir, f"{self.username}_{entity}")
+
+    @STORAGE_SECONDS.time(backend='text', operation='read_all')
+    def read_all(self, entity: str) -> List[str]:
+        """
+        Reads all of the records of the provided entity.
+        :param entity: the entity to read: posts, likes, or reposts
+        :return: a list of the records of the entity, ordered from oldest to newest
+        """
+        try:
+            with open(self._path(entity), "r") as f:
+                return [line.rstrip("\n") for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def append(self, entity: str, record: str):
+        """
+        Appends a record to the provided entity.
+        :param entity: the entity to append to: posts, likes, or reposts
+        :param record: the record to append, which must not contain a newline
+        """
+        self.append_many(entity, [record])
+
+    @STORAGE_SECONDS.time(backend='text', operation='write')
+    def append_many(self, entity: str, records: List[str]):
+        """
+        Appends records to the provided entity with a single write. The file is flushed to the operating system but
+        not synced to disk; call sync() for that.
+        :param entity: the entity to append to: posts, likes, or reposts
+        :param records: the records to append, none of which may contain a newline
+        """
+        with self.lock:
+            if entity not in self._files:
+                self._files[entity] = open(self._path(entity), "a")
+
+            f = self._files[entity]
+            f.write("".join(record + "\n" for record in records))
+            f.flush()
+
+    @STORAGE_SECONDS.time(backend='text', operation='sync')
+    def sync(self, entity: str):
+        """
+        Forces all records appended to the provided entity to be written to disk.
+        :param entity: the entity to sync: posts, likes, or reposts
+        """
+        with self.lock:
+            if entity in self._files:
+                os.fsync(self._files[entity].fileno())
+
+    def close(self):
+        """Closes all of the files held open by this storage backend."""
+        with self.lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+
+
+class SegmentLog:
+    """
+    This class represents an append-only log of binary records stored in a directory of rolling segment files. Every
+    record is written with a fixed-size header containing the length and CRC32 checksum of its payload. Each segment
+    file <base>.seg is accompanied by a sidecar index file <base>.idx holding the byte offset of every record in the
+    segment, where <base> is the log position of the first record in the segment. The index allows any record, and in
+    particular the last n records, to be read with a single seek, and allows the log to be recovered on startup by
+    memory-mapping the index files rather than scanning every record.
+    """
+
+    # Record header: payload length and CRC32 checksum of the payload
+    header = struct.Struct('<II')
+
+    # Index entry: byte offset of a record within its segment
+    index_entry = struct.Struct('<Q')
+
+    def __init__(self, path: str, segment_bytes: int = 16 * 1024 * 1024):
+        """
+        Opens the segment log in the provided directory, creating it if it does not exist and recovering from any
+        partially written record at the end of the log.
+        :param path: the directory in which the segment files are stored
+        :param segment_bytes: the size in bytes at which a new segment file is started
+        """
+        if segment_bytes <= 0:
+            raise ValueError("Segment size must be a positive number of bytes.")
+
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.lock = Lock()
+
+        # Log position of the first record of each segment and the record offsets within each segment
+        self._bases: List[int] = []
+        self._offsets: List[array] = []
+        self._readers = []
+
+        os.makedirs(path, exist_ok=True)
+        for base in sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg')):
+            self._bases.append(base)
+            self._offsets.append(self._load_index(base))
+            self._readers.append(open(self._segment_path(base), 'rb'))
+
+        if not self._bases:
+            self._new_segment(0)
+        else:
+            self._recover_tail()
+
+        self._segment = open(self._segment_path(self._bases[-1]), 'ab')
+        self._index = open(self._index_path(self._bases[-1]), 'ab')
+
+    def _segment_path(self, base: int) -> str:
+        return os.path.join(self.path, f"{base:020d}.seg")
+
+    def _index_path(self, base: int) -> str:
+        return os.path.join(self.path, f"{base:020d}.idx")
+
+    def _load_index(self, base: int) -> array:
+        """
+        Loads the record offsets of the segment starting at the provided log position by memory-mapping its index.
+        :param base: the log position of the first record in the segment
+        :return: an array of the byte offsets of the records in the segment
+        """
+        offsets = array('Q')
+        try:
+            with open(self._index_path(base), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                usable = size - size % self.index_entry.size
+                if usable:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        offsets.frombytes(m[:usable])
+        except FileNotFoundError:
+            pass
+
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return offsets
+
+    def _new_segment(self, base: int):
+        """
+        Starts a new, empty segment whose first record will be at the provided log position.
+        :param base: the log position of the first record in the new segment
+        """
+        open(self._segment_path(base), 'ab').close()
+        open(self._index_path(base), 'ab').close()
+        self._bases.append(base)
+        self._offsets.append(array('Q'))
+        self._readers.append(open(self._segment_path(base), 'rb'))
+
+    def _recover_tail(self):
+        """
+        Brings the last segment and its index back into agreement after an unclean shutdown. Index entries that point
+        past the end of the segment are dropped, complete records that were written to the segment but not to the
+        index are re-indexed, and any partially written record at the end of the segment is truncated.
+        """
+        base, offsets = self._bases[-1], self._offsets[-1]
+        seg_path = self._segment_path(base)
+        seg_size = os.path.getsize(seg_path)
+
+        with open(seg_path, 'rb') as f:
+
+            # Drop index entries for records that did not make it to the segment
+            while offsets and not self._is_complete(f, offsets[-1], seg_size):
+                offsets.pop()
+
+            # Re-index complete records that are missing from the index
+            end = self._record_end(f, offsets[-1]) if offsets else 0
+            while self._is_complete(f, end, seg_size):
+                offsets.append(end)
+                end = self._record_end(f, end)
+
+        with open(seg_path, 'r+b') as f:
+            f.truncate(end)
+
+        with open(self._index_path(base), 'wb') as f:
+            f.write(self._encode_offsets(offsets))
+
+    def _encode_offsets(self, offsets: array) -> bytes:
+        if sys.byteorder == 'big':
+            offsets = array('Q', offsets)
+            offsets.byteswap()
+        return offsets.tobytes()
+
+    def _record_end(self, f, offset: int) -> int:
+        f.seek(offset)
+        length, _ = self.header.unpack(f.read(self.header.size))
+        return offset + self.header.size + length
+
+    def _is_complete(self, f, offset: int, size: int) -> bool:
+        """
+        Returns True if a complete record with a valid checksum starts at the provided offset of the segment file.
+        """
+        if offset + self.header.size > size:
+            return False
+
+        f.seek(offset)
+        length, crc = self.header.unpack(f.read(self.header.size))
+        if offset + self.header.size + length > size:
+            return False
+
+        return zlib.crc32(f.read(length)) == crc
+
+    def __len__(self) -> int:
+        return self._bases[-1] + len(self._offsets[-1])
+
+    def append(self, payload: bytes):
+        """
+        Appends a record with the provided payload to the end of this log, starting a new segment first if the current
+        one is full.
+        :param payload: the record payload
+        """
+        self.append_many([payload])
+
+    def append_many(self, payloads: List[bytes]):
+        """
+        Appends records with the provided payloads to the end of this log. Records destined for the same segment are
+        written with a single write to the segment and a single write to its index. The files are flushed to the
+        operating system but not synced to disk; call sync() for that.
+        :param payloads: the record payloads, in order
+        """
+        with self.lock:
+            i = 0
+            while i < len(payloads):
+                if self._segment.tell() >= self.segment_bytes:
+                    self._roll()
+
+                # Fill the current segment up to its size limit
+                offset = self._segment.tell()
+                records, entries = [], []
+                while i < len(payloads) and (not records or offset < self.segment_bytes):
+                    payload = payloads[i]
+                    records.append(self.header.pack(len(payload), zlib.crc32(payload)) + payload)
+                    entries.append(offset)
+                    offset += len(records[-1])
+                    i += 1
+
+                self._segment.write(b"".join(records))
+                self._segment.flush()
+
+                self._index.write(b"".join(self.index_entry.pack(entry) for entry in entries))
+                self._index.flush()
+
+                self._offsets[-1].extend(entries)
+
+    def _roll(self):
+        """Closes the current segment and starts a new one. The caller must hold this log's lock."""
+        self._sync()
+        self._segment.close()
+        self._index.close()
+        self._new_segment(len(self))
+        self._segment = open(self._segment_path(self._bases[-1]), 'ab')
+        self._index = open(self._index_path(self._bases[-1]), 'ab')
+
+    def _sync(self):
+        os.fsync(self._segment.fileno())
+        os.fsync(self._index.fileno())
+
+    def sync(self):
+        """Forces all records appended to this log to be written to disk."""
+        with self.lock:
+            self._sync()
+
+    def _read(self, position: int) -> bytes:
+        """Reads the record at the provided log position. The caller must hold this log's lock."""
+        segment = bisect_right(self._bases, position) - 1
+        f = self._readers[segment]
+        f.seek(self._offsets[segment][position - self._bases[segment]])
+
+        length, crc = self.header.unpack(f.read(self.header.size))
+        payload = f.read(length)
+        if zlib.crc32(payload) != crc:
+            raise CorruptRecordError(f"Record {position} in {self.path} is corrupt.")
+
+        return payload
+
+    def read_range(self, start: int, end: int) -> List[bytes]:
+        """
+        Returns the payloads of the records at the provided log positions, each read with a seek through the index.
+        :param start: the position of the first record to read
+        :param end: the position after the last record to read
+        :return: a list of the payloads of the records, ordered from oldest to newest
+        """
+        with self.lock:
+            return [self._read(position) for position in range(max(start, 0), min(end, len(self)))]
+
+    def tail(self, n: int) -> List[bytes]:
+        """
+        Returns the payloads of the n most recent records in this log, ordered from newest to oldest.
+        :param n: the number of records to return
+        :return: a list of the payloads of the n most recent records
+        """
+        with self.lock:
+            end = len(self)
+            return [self._read(position) for position in range(end - 1, max(end - n, 0) - 1, -1)]
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Iterates over the payloads of all records in this log, from oldest to newest."""
+        with self.lock:
+            segments = list(zip(self._bases, self._offsets))
+            count = len(self)
+
+        for base, offsets in segments:
+            with open(self._segment_path(base), 'rb') as f:
+                data = f.read()
+
+            for i in range(min(len(offsets), count - base)):
+                length, crc = self.header.unpack_from(data, offsets[i])
+                start = offsets[i] + self.header.size
+                payload = data[start:start + length]
+                if zlib.crc32(payload) != crc:
+                    raise CorruptRecordError(f"Record {base + i} in {self.path} is corrupt.")
+                yield payload
+
+    def close(self):
+        """Closes all of the files held open by this log."""
+        with self.lock:
+            self._segment.close()
+            self._index.close()
+            for reader in self._readers:
+                reader.close()
+
+
+class SegmentLogStorage:
+    """
+    This class represents a storage backend in which each entity of a user's state is stored as a SegmentLog in the
+    directory <state_dir>/<username>_<entity>.log. Records are stored as utf-8 encoded strings.
+    """
+
+    def __init__(self, username: str, state_dir: str = "state", segment_bytes: int = 16 * 1024 * 1024):
+        """
+        Instantiates a new SegmentLogStorage for the user with the provided username, recovering any existing logs.
+        :param username: the username of the user whose state to store
+        :param state_dir: the directory in which the segment logs are stored
+        :param segment_bytes: the size in bytes at which a new segment file is started
+        """
+        self.username = username
+        self.state_dir = state_dir
+        self.logs: Dict[str, SegmentLog] = {
+            entity: SegmentLog(os.path.join(state_dir, f"{username}_{entity}.log"), segment_bytes)
+            for entity in ENTITIES
+        }
+
+    @STORAGE_SECONDS.time(backend='segment', operation='read_all')
+    def read_all(self, entity: str) -> List[str]:
+        """
+        Reads all of the records of the provided entity.
+        :param entity: the entity to read: posts, likes, or reposts
+        :return: a list of the records of the entity, ordered from oldest to newest
+        """
+        return [payload.decode() for payload in self.logs[entity]]
+
+    @STORAGE_SECONDS.time(backend='segment', operation='tail')
+    def tail(self, entity: str, n: int) -> List[str]:
+        """
+        Reads the n most recent records of the provided entity.
+        :param entity: the entity to read: posts, likes, or reposts
+        :param n: the number of records to read
+        :return: a list of the n most recent records of the entity, ordered from newest to oldest
+        """
+        return [payload.decode() for payload in self.logs[entity].tail(n)]
+
+    @STORAGE_SECONDS.time(backend='segment', operation='read_range')
+    def read_range(self, entity: str, start: int, end: int) -> List[str]:
+        """
+        Reads the records of the provided entity at the provided positions.
+        :param entity: the entity to read: posts, likes, or reposts
+        :param start: the position of the first record to read
+        :param end: the position after the last record to read
+        :return: a list of the records, ordered from oldest to newest
+        """
+        return [payload.decode() for payload in self.logs[entity].read_range(start, end)]
+
+    def count(self, entity: str) -> int:
+        """
+        Returns the number of records of the provided entity, which is known from the index without reading them.
+        :param entity: the entity to count: posts, likes, or reposts
+        :return: the number of records of the entity
+        """
+        return len(self.logs[entity])
+
+    @STORAGE_SECONDS.time(backend='segment', operation='write')
+    def append(self, entity: str, record: str):
+        """
+        Appends a record to the provided entity.
+        :param entity: the entity to append to: posts, likes, or reposts
+        :param record: the record to append
+        """
+        self.logs[entity].append(record.encode())
+
+    @STORAGE_SECONDS.time(backend='segment', operation='write')
+    def append_many(self, entity: str, records: List[str]):
+        """
+        Appends records to the provided entity. The records are flushed to the operating system but not synced to disk;
+        call sync() for that.
+        :param entity: the entity to append to: posts, likes, or reposts
+        :param records: the records to append
+        """
+        self.logs[entity].append_many([record.encode() for record in records])
+
+    @STORAGE_SECONDS.time(backend='segment', operation='sync')
+    def sync(self, entity: str):
+        """
+        Forces all records appended to the provided entity to be written to disk.
+        :param entity: the entity to sync: posts, likes, or reposts
+        """
+        self.logs[entity].sync()
+
+    def close(self):
+        """Closes all of the segment logs held open by this storage backend."""
+        for log in self.logs.values():
+            log.close()
+
+
+def _sync_directory(path: str):
+    """
+    Forces the entries of the provided directory, such as newly created files, to be written to disk.
+    :param path: the directory to sync
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def migrate(username: str, state_dir: str = "state", segment_bytes: int = 16 * 1024 * 1024) -> Dict[str, int]:
+    """
+    Copies the state of the user with the provided username from text files into segment logs. The text files are
+    left in place. Entities that already have records in a segment log are skipped so that the migration can safely be
+    re-run. Each migrated log, including the directory entries of its files, is synced to disk before it is counted as
+    migrated.
+    :param username: the username of the user whose state to migrate
+    :param state_dir: the directory in which the state files are stored
+    :param segment_bytes: the size in bytes at which a new segment file is started
+    :return: a dict mapping each entity to the number of records migrated
+    """
+    source = TextFileStorage(username, state_dir)
+    target = SegmentLogStorage(username, state_dir, segment_bytes)
+    migrated = {}
+
+    try:
+        for entity in ENTITIES:
+            if len(target.logs[entity]):
+                migrated[entity] = 0
+                continue
+
+            records = source.read_all(entity)
+            target.append_many(entity, records)
+
+            # The migration only counts as done once the converted history is on disk
+            target.sync(entity)
+            _sync_directory(target.logs[entity].path)
+            migrated[entity] = len(records)
+        _sync_directory(state_dir)
+    finally:
+        target.close()
+
+    return migrated
@@ -0,0 +1,108 @@
+from threading import Lock
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+
+class Page(NamedTuple):
+    """
+    This class represents a page of consecutive entries of a Timeline, ordered from newest to oldest, along with the
+    cursors bounding the page. Positions in a timeline never change because timelines are append-only, so cursors
+    remain valid for as long as the timeline exists. Passing before as the before cursor of a later query returns older
+    entries; passing since as the since cursor of a later query returns newer entries.
+    """
+    entries: List[Any]
+    before: int
+    since: int
+
+
+class Timeline:
+    """
+    This class represents an append-only, in-memory sequence of entries (posts, liked post ids, or reposted post ids)
+    belonging to a single user. Entries are kept in the order in which they were created, so the most recent entries
+    are always found at the end of the sequence and the n most recent entries can be returned in O(n) time without
+    sorting or touching the disk.
+
+    A timeline may hold only its most recent entries in memory, starting at position start, and read older entries
+    from storage through load_range when they are asked for, so that a long history need not be loaded up front.
+    """
+
+    def __init__(self, entries: Iterable[Any] = (), start: int = 0,
+                 load_range: Optional[Callable[[int, int], List[Any]]] = None):
+        """
+        Instantiates a new Timeline containing the provided entries.
+        :param entries: the most recent entries of this timeline, ordered from oldest to newest
+        :param start: the position of the first of entries, which is 0 unless older entries are left in storage
+        :param load_range: a function returning the entries at positions start to end (exclusive), ordered from oldest
+        to newest, which is required if start is not 0
+        """
+        if start and load_range is None:
+            raise ValueError("Entries before the start of a timeline can only be left in storage with a load_range.")
+
+        self._entries: List[Any] = list(entries)
+        self._start = start
+        self._load_range = load_range
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return self._start + len(self._entries)
+
+    def __iter__(self) -> Iterator[Any]:
+        """Iterates over all entries in this timeline, from newest to oldest."""
+        with self.lock:
+            return reversed(self._slice(0, len(self)))
+
+    def _slice(self, start: int, end: int) -> List[Any]:
+        """
+        Returns the entries at positions start to end (exclusive), ordered from oldest to newest, reading those older
+        than the entries held in memory from storage. The caller must hold this timeline's lock.
+        """
+        if start >= self._start:
+            return self._entries[start - self._start:end - self._start]
+        return self._load_range(start, min(end, self._start)) + self._entries[:max(end - self._start, 0)]
+
+    def append(self, entry: Any):
+        """
+        Appends a new entry to this timeline. The entry becomes the most recent entry in the timeline.
+        :param entry: the entry to append
+        """
+        with self.lock:
+            self._entries.append(entry)
+
+    def most_recent(self, n: int) -> List[Any]:
+        """
+        Returns a list of the n most recent entries in this timeline, ordered from newest to oldest.
+        :param n: the number of entries to return
+        :return: a list of the n most recent entries in this timeline
+        """
+        if n <= 0:
+            return []
+
+        with self.lock:
+            length = len(self)
+            return self._slice(max(length - n, 0), length)[::-1]
+
+    def page(self, n: int, before: Optional[int] = None, since: Optional[int] = None) -> Page:
+        """
+        Returns a page of at most n consecutive entries of this timeline, ordered from newest to oldest. If since is
+        given, the page holds the oldest entries at or after position since, so that a poller can catch up in order. If
+        before is given, the page holds the newest entries before position before. Otherwise, the page holds the n
+        most recent entries.
+        :param n: the maximum number of entries in the page
+        :param before: the cursor before which to return entries
+        :param since: the cursor at or after which to return entries
+        :return: the page of entries and its cursors
+        """
+        if before is not None and since is not None:
+            raise ValueError("At most one of before and since may be given.")
+
+        n = max(n, 0)
+        with self.lock:
+            length = len(self)
+
+            if since is not None:
+                start = min(max(since, 0), length)
+                end = min(start + n, length)
+            else:
+                end = length if before is None else min(max(before, 0), length)
+                start = max(end - n, 0)
+
+            return Page(self._slice(start, end)[::-1], start, end)
@@ -1,79 +1,203 @@
-from .posts import Post
-from typing import Iterable, Tuple
-from threading import Lock
+from .metrics import TimedLock
+from .posts import Post, Reaction
+from .storage import TextFileStorage
+from .timeline import Page, Timeline
+from .writer import AppendWriter
+from concurrent.futures import Future
+import time
+from typing import Callable, Iterable, List, Optional
 
 
 class User:
     """
-    Represents a user of the microblogging platform. The user's data is stored on disk so that it is retrievable
-    after an application failure. Locking is used to prevent concurrent access to the individual data structures.
+    Represents a user of the microblogging platform. The user's data is stored on disk by a storage backend so that it
+    is retrievable after an application failure. The data is loaded from disk once when the user is instantiated and is
+    then kept in memory in append-only timelines, which are updated along with the storage backend whenever the user
+    posts, likes, or reposts; backends with an index only have their most recent entries loaded, and older entries are
+    read from disk when they are asked for. Writes are made through an AppendWriter, whose durability mode determines when a write
+    is acknowledged. Locking is used to prevent concurrent writes to the individual data structures.
     """
 
-    def __init__(self, username):
+    # Number of the most recent entries of each entity loaded into memory at startup from backends that can read
+    # older entries on demand
+    RESIDENT_ENTRIES = 1024
+
+    def __init__(self, username, storage=None, writer: AppendWriter = None):
         """
-        Instantiates a new User.
+        Instantiates a new User, loading any existing data for the user from disk.
         :param username: the unique username of this user
+        :param storage: the storage backend in which to store this user's data, defaults to a TextFileStorage
+        :param writer: the writer through which to append to the storage backend, defaults to an OS-buffered writer
         """
         self.username = username
+        self.storage = storage if storage is not None else TextFileStorage(username)
+        self.writer = writer if writer is not None else AppendWriter(self.storage)
+
+        # Locks for all of the data structures, which record how long writers wait for them
+        self.posts_lock = TimedLock('posts')
+        self.reposts_lock = TimedLock('reposts')
+        self.likes_lock = TimedLock('likes')
+
+        # In-memory timelines for all of the data structures
+        self._posts = self._load('posts', Post.loads)
+        self._reposts = self._load('reposts', Reaction.loads)
+        self._likes = self._load('likes', Reaction.loads)
+
+        # Functions called with the name of an entity whenever it is written to
+        self._listeners: List[Callable[[str], None]] = []
+
+    def _load(self, entity: str, parse: Callable[[str], object]) -> Timeline:
+        """
+        Loads the timeline of the provided entity from this user's storage backend. Backends which can read records by
+        position, such as SegmentLogStorage, only have their RESIDENT_ENTRIES most recent records read, with a seek
+        from the end, and older entries are read through the index when they are asked for. Other backends are read
+        in full.
+        :param entity: the entity to load: posts, likes, or reposts
+        :param parse: a function that converts a stored record into an entry
+        :return: a timeline of the entries in the storage backend
+        """
+        if not hasattr(self.storage, 'read_range'):
+            return Timeline([parse(record) for record in self.storage.read_all(entity)])
+
+        def load_range(start: int, end: int) -> List:
+            return [parse(record) for record in self.storage.read_range(entity, start, end)]
 
-        # Locks for all of the data structures
-        self.posts_lock = Lock()
-        self.reposts_lock = Lock()
-        self.likes_lock = Lock()
+        recent = [parse(record) for record in reversed(self.storage.tail(entity, self.RESIDENT_ENTRIES))]
+        return Timeline(recent, self.storage.count(entity) - len(recent), load_range)
 
     @property
     def posts(self) -> Iterable[Post]:
-        """Returns an iterable containing all of this user's posts."""
-        try:
-            with open(f"state/{self.username}_posts", "r") as f:
-                return [Post.loads(post) for post in f]
-        except FileNotFoundError:
-            return []
+        """Returns an iterable containing all of this user's posts, from newest to oldest."""
+        return list(self._posts)
 
     @property
     def reposts(self) -> Iterable[str]:
-        """Returns an iterable containing the post ids of all of this user's reposts."""
-        try:
-            with open(f"state/{self.username}_reposts", "r") as f:
-                return [post_id for post_id in f]
-        except FileNotFoundError:
-            return []
+        """Returns an iterable containing the post ids of all of this user's reposts, from newest to oldest."""
+        return [repost.post_id for repost in self._reposts]
 
     @property
     def likes(self) -> Iterable[str]:
-        """Returns an iterable containing the post ids of all of this user's likes."""
-        try:
-            with open(f"state/{self.username}_likes", "r") as f:
-                return [post_id for post_id in f]
-        except FileNotFoundError:
-            return []
+        """Returns an iterable containing the post ids of all of this user's likes, from newest to oldest."""
+        return [like.post_id for like in self._likes]
 
-    def repost(self, post_id: str):
+    def subscribe(self, listener: Callable[[str], None]):
         """
-        Adds the provided post_id to the list of posts reposted by this user.
+        Registers a function to be called with the name of the entity (posts, likes, or reposts) after every post, like,
+        or repost by this user, once the new entry is visible to readers.
+        :param listener: the function to call
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, entity: str):
+        """
+        Calls every registered listener with the provided entity.
+        :param entity: the entity which was written to
+        """
+        for listener in self._listeners:
+            listener(entity)
+
+    def _append(self, entity: str, timeline: Timeline, entry, record: str) -> Future:
+        """
+        Appends a record to the provided entity through this user's writer, and adds its entry to the in-memory timeline
+        and notifies the listeners only once the record has been written, so that an entry whose write failed is never
+        visible. Caller holds the lock of the entity, which keeps the timeline in the same order as the storage backend.
+        :param entity: the entity to append to: posts, likes, or reposts
+        :param timeline: the in-memory timeline of the entity
+        :param entry: the entry to add to the timeline
+        :param record: the stored form of the entry
+        :return: a Future which is resolved once the record has been written to storage
+        :raises OSError: if a synchronous writer failed to write the record
+        """
+        def on_written():
+            timeline.append(entry)
+            self._notify(entity)
+
+        future = self.writer.append(entity, record, on_written)
+
+        # FSYNC and BUFFERED writers have already written the record, so their failures are raised to the caller here
+        if future.done():
+            future.result()
+        return future
+
+    def close(self):
+        """Writes any pending data to disk and closes this user's writer and storage backend."""
+        self.writer.close()
+        self.storage.close()
+
+    def repost(self, post_id: str) -> Future:
+        """
+        Adds the provided post_id to the list of posts reposted by this user. The repost becomes visible to readers once
+        it has been written, by the time the returned Future is resolved; in FSYNC and BUFFERED mode, that is before
+        this method returns.
         :param post_id: the id of the post to repost
+        :return: a Future which is resolved once the repost has been written to storage
+        :raises OSError: if the repost could not be written by a synchronous writer
         """
         with self.reposts_lock:
-            with open(f"state/{self.username}_reposts", "a") as f:
-                f.write(post_id + "\n")
+            reaction = Reaction(post_id, time.time())
+            return self._append('reposts', self._reposts, reaction, reaction.dumps())
 
-    def post(self, message: str):
+    def post(self, message: str) -> Future:
         """
-        Creates a new Post with the provided message.
+        Creates a new Post with the provided message. The post becomes visible to readers once it has been written, by
+        the time the returned Future is resolved; in FSYNC and BUFFERED mode, that is before this method returns.
         :param message: the message to post
+        :return: a Future which is resolved once the post has been written to storage
+        :raises OSError: if the post could not be written by a synchronous writer
         """
+        post = Post(message, self.username)
+
         with self.posts_lock:
-            with open(f"state/{self.username}_posts", "a") as f:
-                f.write(Post(message, self.username).dumps() + "\n")
+            return self._append('posts', self._posts, post, post.dumps())
 
-    def like(self, post_id: str):
+    def like(self, post_id: str) -> Future:
         """
-        Adds the provided post_id to the list of posts liked by this user.
+        Adds the provided post_id to the list of posts liked by this user. The like becomes visible to readers once it
+        has been written, by the time the returned Future is resolved; in FSYNC and BUFFERED mode, that is before this
+        method returns.
         :param post_id: the id of the post to like
+        :return: a Future which is resolved once the like has been written to storage
+        :raises OSError: if the like could not be written by a synchronous writer
         """
         with self.likes_lock:
-            with open(f"state/{self.username}_likes", "a") as f:
-                f.write(post_id + "\n")
+            reaction = Reaction(post_id, time.time())
+            return self._append('likes', self._likes, reaction, reaction.dumps())
+
+    def version(self, entity: str) -> int:
+        """
+        Returns the version of this user's posts, likes, or reposts. The version is incremented by every post, like, or
+        repost respectively, and never decreases.
+        :param entity: the entity whose version to return: posts, likes, or reposts
+        :return: the version of the entity
+        """
+        if entity == 'posts':
+            return len(self._posts)
+        elif entity == 'likes':
+            return len(self._likes)
+        elif entity == 'reposts':
+            return len(self._reposts)
+        raise ValueError(f"Unknown entity {entity}.")
+
+    def page(self, entity: str, n: int = 10, before: Optional[int] = None, since: Optional[int] = None) -> Page:
+        """
+        Returns a page of at most n of this user's posts, likes, or reposts, ordered from newest to oldest. See
+        Timeline.page for the meaning of the cursors.
+        :param entity: the entity to page through: posts, likes, or reposts
+        :param n: the maximum number of entries to return
+        :param before: the cursor before which to return entries
+        :param since: the cursor at or after which to return entries
+        :return: a page of Post objects (for posts) or post ids (for likes and reposts) and its cursors
+        """
+        if entity == 'posts':
+            return self._posts.page(n, before, since)
+        elif entity == 'likes':
+            page = self._likes.page(n, before, since)
+        elif entity == 'reposts':
+            page = self._reposts.page(n, before, since)
+        else:
+            raise ValueError(f"Unknown entity {entity}.")
+
+        return page._replace(entries=[reaction.post_id for reaction in page.entries])
 
     def get_posts(self, n: int = 10) -> Iterable[Post]:
         """
@@ -81,8 +205,7 @@ class User:
         :param n: the number of posts to return
         :return: an iterable of the n most recent posts from this user
         """
-        with self.posts_lock:
-            return sorted(self.posts, key=lambda p: p.id)[:n]
+        return self._posts.most_recent(n)
 
     def get_likes(self, n: int = 10) -> Iterable[str]:
         """
@@ -90,8 +213,7 @@ class User:
         :param n: the number of likes to return
         :return: an iterable of the n most recent likes from this user
         """
-        with self.likes_lock:
-            return sorted(self.likes)[:n]
+        return [like.post_id for like in self._likes.most_recent(n)]
 
     def get_reposts(self, n: int = 10) -> Iterable[str]:
         """
@@ -99,5 +221,4 @@ class User:
         :param n: the number of reposts to return
         :return: an iterable of the n most recent reposts from this user
         """
-        with self.reposts_lock:
-            return sorted(self.reposts)[:n]
+        return [repost.post_id for repost in self._reposts.most_recent(n)]
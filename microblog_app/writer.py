@@ -0,0 +1,163 @@
+import time
+import traceback
+from concurrent.futures import Future
+from enum import Enum
+from queue import Queue, Empty
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Durability(Enum):
+    """
+    The durability modes supported by the AppendWriter:
+        FSYNC: every append is written and synced to disk before it is acknowledged
+        GROUP: appends are queued and written and synced to disk in batches by a background thread (group commit)
+        BUFFERED: every append is written to the operating system, which decides when it reaches the disk
+    """
+    FSYNC = 'fsync'
+    GROUP = 'group'
+    BUFFERED = 'buffered'
+
+
+class AppendWriter:
+    """
+    This class represents a write path in front of a storage backend (TextFileStorage or SegmentLogStorage) that
+    appends records to a user's posts, likes, and reposts. Each append returns a Future that is resolved once the record
+    is as durable as the configured Durability mode guarantees. In GROUP mode, appends from concurrent callers are
+    coalesced so that a single write and a single sync are issued per entity for every batch_size appends or every
+    interval seconds, whichever comes first. A failed write only fails the appends to the entity it was writing.
+    """
+
+    def __init__(self, storage, durability: Durability = Durability.BUFFERED, interval: float = 0.005,
+                 batch_size: int = 256):
+        """
+        Instantiates a new AppendWriter in front of the provided storage backend.
+        :param storage: the storage backend to write to
+        :param durability: the durability mode of this writer
+        :param interval: in GROUP mode, the maximum number of seconds an append waits for a batch to fill up
+        :param batch_size: in GROUP mode, the maximum number of appends written in a single batch
+        """
+        if interval < 0:
+            raise ValueError("Interval must not be negative.")
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1.")
+
+        self.storage = storage
+        self.durability = Durability(durability)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock = Lock()
+
+        self._queue: Queue = Queue()
+        self._closed = False
+        self._closed_lock = Lock()
+        self._thread = None
+
+        if self.durability == Durability.GROUP:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def append(self, entity: str, record: str, on_written: Optional[Callable[[], None]] = None) -> Future:
+        """
+        Appends a record to the provided entity.
+        :param entity: the entity to append to: posts, likes, or reposts
+        :param record: the record to append
+        :param on_written: a function called once the record is as durable as the mode guarantees and before the Future
+        is resolved, which is not called if the write fails; calls are made in the order of the appends to each entity
+        :return: a Future which is resolved with None once the record is durable, or with the error that prevented it;
+        in FSYNC and BUFFERED mode, the Future is already resolved when it is returned
+        """
+        future = Future()
+
+        if self.durability == Durability.GROUP:
+            with self._closed_lock:
+                if self._closed:
+                    raise RuntimeError("Cannot append to a closed AppendWriter.")
+                self._queue.put((entity, record, future, on_written))
+            return future
+
+        if self._closed:
+            raise RuntimeError("Cannot append to a closed AppendWriter.")
+
+        try:
+            with self.lock:
+                self.storage.append_many(entity, [record])
+                if self.durability == Durability.FSYNC:
+                    self.storage.sync(entity)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            self._resolve([(entity, record, future, on_written)])
+
+        return future
+
+    @staticmethod
+    def _resolve(appends: List[Tuple[str, str, Future, Optional[Callable[[], None]]]]):
+        """
+        Calls the on_written function of each written append and then resolves its Future, in order. A failing
+        on_written function does not change the outcome of the write, which has already happened.
+        :param appends: the appends which were written
+        """
+        for _, _, future, on_written in appends:
+            if on_written is not None:
+                try:
+                    on_written()
+                except Exception:
+                    traceback.print_exc()
+            future.set_result(None)
+
+    def _next_batch(self) -> List[Tuple[str, str, Future, Optional[Callable[[], None]]]]:
+        """
+        Waits for at least one queued append and then collects further appends until the batch is full or the interval
+        has elapsed since the first append was taken from the queue.
+        :return: the appends in the batch, in the order in which they were queued
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        """Writes queued appends in batches until the writer is closed."""
+        while True:
+            batch = self._next_batch()
+            closing = batch[-1] is None
+            appends = [append for append in batch if append is not None]
+
+            # Group the appends by entity, preserving their order
+            by_entity: Dict[str, List[Tuple[str, str, Future, Optional[Callable[[], None]]]]] = {}
+            for append in appends:
+                by_entity.setdefault(append[0], []).append(append)
+
+            for entity, entity_appends in by_entity.items():
+                try:
+                    with self.lock:
+                        self.storage.append_many(entity, [record for _, record, _, _ in entity_appends])
+                        self.storage.sync(entity)
+                except Exception as e:
+                    for _, _, future, _ in entity_appends:
+                        future.set_exception(e)
+                else:
+                    self._resolve(entity_appends)
+
+            if closing:
+                return
+
+    def close(self):
+        """Writes any queued appends and stops this writer. The storage backend is left open."""
+        with self._closed_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is not None:
+                self._queue.put(None)
+
+        if self._thread is not None:
+            self._thread.join()
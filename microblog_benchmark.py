@@ -0,0 +1,301 @@
+"""
+This program benchmarks the peer-to-peer microblogging application end to end. It starts a number of local peers, each
+an AppInstance serving its own user on its own port, along with an in-process stand-in for the User Directory Service
+(or uses a running UDS), seeds every user with a history of posts, and then drives a mixed workload of writes, peer
+reads, timeline merges, and UDS lookups and registrations from concurrent clients. Throughput and p50/p95/p99 latency
+are reported for each operation and written to a JSON file so that results can be compared between releases.
+
+Run with:
+
+python microblog_benchmark.py [--peers 8] [--history 1000] [--operations 5000] [--output benchmark_results.json]
+"""
+
+from microblog_app import AppInstance, User
+from microblog_app.posts import Post
+from microblog_app.storage import SegmentLogStorage, TextFileStorage
+from microblog_app.writer import AppendWriter, Durability
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from typing import Callable, Dict, List
+import argparse
+import json
+import platform
+import random
+import requests
+import shutil
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark the microblogging application end to end.')
+parser.add_argument('--peers', type=int, default=8, help='The number of local peers to start.')
+parser.add_argument('--base-port', type=int, default=9100, help='The port of the first peer; peers use consecutive ports.')
+parser.add_argument('--history', type=int, default=1000, help='The number of posts with which to seed each user.')
+parser.add_argument('--storage', choices=['text', 'segment'], default='text', help='The storage backend of each user.')
+parser.add_argument('--durability', choices=[d.value for d in Durability], default=Durability.BUFFERED.value,
+                    help='The durability mode of each user\'s writes.')
+parser.add_argument('--operations', type=int, default=5000, help='The number of operations to issue.')
+parser.add_argument('--clients', type=int, default=16, help='The number of concurrent clients issuing operations.')
+parser.add_argument('--mix', type=str, default='post=10,read=50,timeline=20,lookup=15,register=5',
+                    help='The relative weight of each operation: post, read, timeline, lookup, and register.')
+parser.add_argument('--page', type=int, default=20, help='The number of posts requested by reads and timelines.')
+parser.add_argument('--follows', type=int, default=5, help='The number of peers merged by each timeline.')
+parser.add_argument('--uds', type=str, default=None,
+                    help='The store URL of a running UDS, such as http://localhost:8080/store. By default an in-process '
+                         'stand-in is started.')
+parser.add_argument('--uds-port', type=int, default=9099, help='The port of the in-process UDS stand-in.')
+parser.add_argument('--seed', type=int, default=0, help='The seed for choosing operations and peers.')
+parser.add_argument('--output', type=str, default='benchmark_results.json', help='The file to write results to.')
+
+
+class StandInUDS(ThreadingHTTPServer):
+    """
+    This class represents an in-process stand-in for the User Directory Service. It serves the store endpoints used by
+    AppInstance (GET and PUT on /store and POST on /store/batch_get) from a single dict, without replication, so that
+    peers can be benchmarked without a UDS cluster.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int):
+        """
+        Instantiates a new, empty StandInUDS listening on the provided port. Call serve_forever() to start serving.
+        :param port: the port on which to listen
+        """
+        super().__init__(('127.0.0.1', port), StandInUDSHandler)
+        self.lock = Lock()
+        self.data: Dict[str, Dict] = {}
+        self.versions = count()
+
+
+class StandInUDSHandler(BaseHTTPRequestHandler):
+    """This class handles a single request to a StandInUDS."""
+    protocol_version = 'HTTP/1.1'
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _reply(self, response: Dict):
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        key = self._body().get('key', '')
+        with self.server.lock:
+            self._reply(self.server.data.get(key, {}))
+
+    def do_PUT(self):
+        request = self._body()
+        with self.server.lock:
+            entry = {'value': request.get('value', ''), 'version': next(self.server.versions)}
+            self.server.data[request.get('key', '')] = entry
+        self._reply({'data': entry, 'success': True, 'version': entry['version']})
+
+    def do_POST(self):
+        keys = self._body().get('keys', [])
+        with self.server.lock:
+            data = {key: self.server.data[key] for key in keys if key in self.server.data}
+        self._reply({'data': data, 'missing': [key for key in keys if key not in data], 'success': True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    """
+    Returns the p-th percentile of a sorted list of latencies using the nearest-rank method.
+    :param latencies: the latencies, sorted in ascending order
+    :param p: the percentile, between 0 and 100
+    :return: the p-th percentile, or 0.0 if there are no latencies
+    """
+    if not latencies:
+        return 0.0
+    rank = max(int(-(-p * len(latencies) // 100)), 1)
+    return latencies[min(rank, len(latencies)) - 1]
+
+
+class Recorder:
+    """This class represents the latencies and errors recorded for each operation during a benchmark run."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, operation: str, seconds: float, failed: bool):
+        """
+        Records the outcome of a single operation.
+        :param operation: the name of the operation
+        :param seconds: how long the operation took
+        :param failed: whether the operation raised an error
+        """
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(seconds * 1000)
+            if failed:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Dict]:
+        """
+        Summarizes the recorded operations.
+        :param elapsed: the duration of the run in seconds
+        :return: a dict mapping each operation to its count, errors, throughput, and latency percentiles in ms
+        """
+        summary = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            summary[operation] = {
+                'count': len(latencies),
+                'errors': self.errors.get(operation, 0),
+                'throughput': round(len(latencies) / elapsed, 1),
+                'mean_ms': round(sum(latencies) / len(latencies), 3),
+                'p50_ms': round(percentile(latencies, 50), 3),
+                'p95_ms': round(percentile(latencies, 95), 3),
+                'p99_ms': round(percentile(latencies, 99), 3),
+                'max_ms': round(latencies[-1], 3),
+            }
+        return summary
+
+
+def start_peers(args, state_dir: str) -> List[AppInstance]:
+    """
+    Starts the local peers, seeding each user's storage with a history of posts before the user is loaded.
+    :param args: the parsed command line arguments
+    :param state_dir: the directory in which to store the state of every user
+    :return: the AppInstance of each peer
+    """
+    instances = []
+    for i in range(args.peers):
+        username = f"bench{i}"
+        storage = SegmentLogStorage(username, state_dir) if args.storage == 'segment' \
+            else TextFileStorage(username, state_dir)
+        storage.append_many('posts', [Post(f"Seed post {j} by {username}", username).dumps()
+                                      for j in range(args.history)])
+
+        user = User(username, storage, AppendWriter(storage, Durability(args.durability)))
+        instances.append(AppInstance(user, args.base_port + i))
+    return instances
+
+
+def workload(args, instances: List[AppInstance]) -> Dict[str, Callable[[random.Random, AppInstance], None]]:
+    """
+    Returns the operations of the workload, each of which is issued by a client through its own peer.
+    :param args: the parsed command line arguments
+    :param instances: the AppInstance of each peer
+    :return: a dict mapping the name of each operation to a function issuing it
+    """
+    usernames = [instance.user.username for instance in instances]
+    registrations = count()
+
+    def post(rng: random.Random, instance: AppInstance):
+        instance.user.post(f"Benchmark post {rng.random()}").result()
+
+    def read(rng: random.Random, instance: AppInstance):
+        instance.get_posts(rng.choice(usernames), args.page)
+
+    def timeline(rng: random.Random, instance: AppInstance):
+        _, timed_out = instance.get_timeline(rng.sample(usernames, min(args.follows, len(usernames))), args.page)
+        if timed_out:
+            raise TimeoutError(f"Timed out reading {timed_out}")
+
+    def lookup(rng: random.Random, instance: AppInstance):
+        instance._get_user_address(rng.choice(usernames))
+
+    def register(rng: random.Random, instance: AppInstance):
+        response = requests.put(instance.uds_gateway_address,
+                                json={'key': f"bench-registration-{next(registrations)}", 'value': "localhost:1"})
+        if not response.json().get('success', False):
+            raise RuntimeError("Registration failed")
+
+    return {'post': post, 'read': read, 'timeline': timeline, 'lookup': lookup, 'register': register}
+
+
+def run(args, instances: List[AppInstance]) -> Dict:
+    """
+    Issues the configured number of operations from concurrent clients and summarizes the results.
+    :param args: the parsed command line arguments
+    :param instances: the AppInstance of each peer
+    :return: the elapsed time and per-operation summary of the run
+    """
+    operations = workload(args, instances)
+    weights = {name: float(weight) for name, weight in (part.split('=') for part in args.mix.split(','))}
+    unknown = set(weights) - set(operations)
+    if unknown:
+        raise ValueError(f"Unknown operations in mix: {', '.join(sorted(unknown))}")
+    names = list(weights)
+
+    recorder = Recorder()
+    issued = count()
+
+    def client(i: int):
+        rng = random.Random(args.seed + i)
+        instance = instances[i % len(instances)]
+        while next(issued) < args.operations:
+            name = rng.choices(names, [weights[name] for name in names])[0]
+            started = time.perf_counter()
+            try:
+                operations[name](rng, instance)
+                failed = False
+            except Exception:
+                failed = True
+            recorder.record(name, time.perf_counter() - started, failed)
+
+    started = time.perf_counter()
+    clients = [Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {'elapsed_s': round(elapsed, 3), 'throughput': round(args.operations / elapsed, 1),
+            'operations': recorder.summary(elapsed)}
+
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    args = parser.parse_args()
+    state_dir = tempfile.mkdtemp(prefix='microblog-benchmark-')
+
+    # Start the UDS stand-in unless a running UDS was given
+    uds = None
+    if args.uds is None:
+        uds = StandInUDS(args.uds_port)
+        Thread(target=uds.serve_forever, daemon=True).start()
+        AppInstance.uds_gateway_address = f"http://127.0.0.1:{args.uds_port}/store"
+    else:
+        AppInstance.uds_gateway_address = args.uds
+
+    instances = []
+    try:
+        started = time.perf_counter()
+        instances = start_peers(args, state_dir)
+        setup_s = time.perf_counter() - started
+
+        results = run(args, instances)
+        results['setup_s'] = round(setup_s, 3)
+        results['config'] = {name: value for name, value in vars(args).items() if name != 'output'}
+        results['environment'] = {'python': platform.python_version(), 'platform': platform.platform()}
+        results['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print(f"{'operation':<10} {'count':>7} {'errors':>7} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, summary in results['operations'].items():
+            print(f"{name:<10} {summary['count']:>7} {summary['errors']:>7} {summary['throughput']:>9} "
+                  f"{summary['p50_ms']:>9} {summary['p95_ms']:>9} {summary['p99_ms']:>9}")
+        print(f"\n{results['throughput']} ops/s overall in {results['elapsed_s']} s; results written to {args.output}")
+    finally:
+        for instance in instances:
+            instance.server.shutdown()
+            instance.user.close()
+        if uds is not None:
+            uds.shutdown()
+        shutil.rmtree(state_dir, ignore_errors=True)
+    sys.exit(0)
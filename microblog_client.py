@@ -7,12 +7,26 @@ Run with:
 python microblog_client.py <username> <port>
 """
 
-from microblog_app import AppInstance, MicroblogCommandLineInterface, User
+from microblog_app import AddressFeed, AppInstance, MicroblogCommandLineInterface, PeerMirror, User
+from microblog_app.storage import SegmentLogStorage, TextFileStorage
+from microblog_app.writer import AppendWriter, Durability
 import argparse
+import os
 
 parser = argparse.ArgumentParser(description='Run the microblogging command line client!')
 parser.add_argument('username', metavar='u', type=str, nargs=1, help='The username to connect with.')
 parser.add_argument('port', metavar='p', type=int, nargs=1, help='The port on which to run the application.')
+parser.add_argument('--storage', choices=['text', 'segment'], default='text',
+                    help='The storage backend for user state. Use migrate_state.py to convert text to segment.')
+parser.add_argument('--durability', choices=[d.value for d in Durability], default=Durability.BUFFERED.value,
+                    help='When writes are acknowledged: after an fsync per write, after a batched group fsync, or '
+                         'once handed to the operating system.')
+parser.add_argument('--watch', action='store_true',
+                    help='Follow the UDS change feed to keep peer addresses up to date instead of looking them up, '
+                         'unless the UDS is partitioned or writes to quorums of replicas.')
+parser.add_argument('--no-mirror', action='store_true',
+                    help='Request every page from its peer instead of serving other users\' recent entries from a local '
+                         'mirror, which is refreshed in the background and remains readable while they are offline.')
 
 if __name__ == "__main__":
 
@@ -20,6 +34,12 @@ if __name__ == "__main__":
     args = parser.parse_args()
     username = args.username[0]
     port = args.port[0]
+    storage = SegmentLogStorage(username) if args.storage == 'segment' else TextFileStorage(username)
+    writer = AppendWriter(storage, Durability(args.durability))
+
+    feed = AddressFeed(AppInstance.uds_gateway_address) if args.watch else None
+    mirror = None if args.no_mirror else PeerMirror(os.path.join("state", f"{username}_mirror"))
 
     # Run the application
-    MicroblogCommandLineInterface(AppInstance(User(username), port)).run()
+    MicroblogCommandLineInterface(AppInstance(User(username, storage, writer), port, address_feed=feed,
+                                              mirror=mirror)).run()
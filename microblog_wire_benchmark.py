@@ -0,0 +1,76 @@
+"""
+This program compares the two encodings in which app servers send pages of posts to peers: JSON, and the compact
+binary encoding requested with an Accept header of application/x-microblog-posts. For each page size it measures the
+time taken to encode a page on the serving peer, the time taken to decode it back into Post objects on the requesting
+peer, and the number of bytes sent over the wire.
+
+Run with:
+
+python microblog_wire_benchmark.py [--sizes 10,100,1000,5000] [--repeat 20] [--output wire_results.json]
+"""
+
+from microblog_app.posts import Post, decode_posts, encode_posts
+import argparse
+import json
+import random
+import string
+import time
+
+parser = argparse.ArgumentParser(description='Compare the JSON and binary encodings of pages of posts.')
+parser.add_argument('--sizes', type=str, default='10,100,1000,5000', help='The page sizes to measure.')
+parser.add_argument('--repeat', type=int, default=20, help='The number of times to encode and decode each page.')
+parser.add_argument('--message-length', type=int, default=80, help='The average length of each message.')
+parser.add_argument('--seed', type=int, default=0, help='The seed for generating messages.')
+parser.add_argument('--output', type=str, default=None, help='A file to write the results to as JSON.')
+
+
+def encode_json(posts):
+    return json.dumps([post.serialize() for post in posts]).encode()
+
+
+def decode_json(data):
+    return [Post.deserialize(post) for post in json.loads(data)]
+
+
+def best_time(function, argument, repeat: int) -> float:
+    """
+    Returns the shortest time taken by repeated calls of the provided function, which is the least noisy estimate.
+    :param function: the function to call
+    :param argument: the argument with which to call the function
+    :param repeat: the number of times to call the function
+    :return: the shortest time taken by a call, in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    alphabet = string.ascii_letters + string.digits + "     éü"
+
+    results = []
+    print(f"{'posts':>6} {'format':<7} {'bytes':>9} {'encode ms':>10} {'decode ms':>10}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        posts = [Post("".join(rng.choice(alphabet) for _ in range(rng.randint(1, min(2 * args.message_length, 160)))),
+                      "alice") for _ in range(size)]
+
+        for name, encode, decode in (('json', encode_json, decode_json), ('binary', encode_posts, decode_posts)):
+            data = encode(posts)
+            assert decode(data) == posts
+
+            result = {'posts': size, 'format': name, 'bytes': len(data),
+                      'encode_ms': round(best_time(encode, posts, args.repeat) * 1000, 3),
+                      'decode_ms': round(best_time(decode, data, args.repeat) * 1000, 3)}
+            results.append(result)
+            print(f"{size:>6} {name:<7} {result['bytes']:>9} {result['encode_ms']:>10} {result['decode_ms']:>10}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
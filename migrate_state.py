@@ -0,0 +1,26 @@
+"""
+This program migrates the state of one or more users of the peer-to-peer microblogging application from the original
+newline-delimited text files to binary segment logs. The text files are left in place and users whose state has already
+been migrated are skipped.
+
+Run with:
+
+python migrate_state.py <username> [<username> ...]
+"""
+
+from microblog_app.storage import migrate
+import argparse
+
+parser = argparse.ArgumentParser(description='Migrate microblogging user state from text files to segment logs.')
+parser.add_argument('usernames', metavar='u', type=str, nargs='+', help='The usernames of the users to migrate.')
+parser.add_argument('--state-dir', type=str, default='state', help='The directory in which user state is stored.')
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    args = parser.parse_args()
+
+    # Migrate each user
+    for username in args.usernames:
+        migrated = migrate(username, args.state_dir)
+        print(f"{username}: " + ", ".join(f"{count} {entity}" for entity, count in migrated.items()))
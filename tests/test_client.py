@@ -0,0 +1,36 @@
+import pytest
+
+from microblog_app.address_cache import AddressCache
+from microblog_app.client import AppRequestServer
+
+
+@pytest.mark.parametrize('if_none_match, matches', [
+    ('', False),
+    ('"e-1"', True),
+    ('W/"e-1"', True),
+    ('"e-0", "e-1"', True),
+    (' "e-0" ,W/"e-1" ', True),
+    ('*', True),
+    ('"e-0"', False),
+    ('"e-1-b"', False),
+])
+def test_etag_matches(if_none_match, matches):
+    assert AppRequestServer._etag_matches(if_none_match, '"e-1"') == matches
+
+
+def test_address_cache_membership_is_not_counted():
+    cache = AddressCache(max_size=2)
+    cache.put("alice", "127.0.0.1:8000")
+    cache.put("ghost", None)
+    cache.put("bob", "127.0.0.1:8001")
+
+    assert "alice" not in cache
+    assert "ghost" in cache
+    assert "bob" in cache
+    assert cache.stats() == {'size': 2, 'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 1,
+                             'invalidations': 0}
+
+    # Checking membership does not make ghost the most recently used user
+    cache.put("carol", "127.0.0.1:8002")
+    assert cache.get("ghost") == (False, None)
+    assert cache.get("bob") == (True, "127.0.0.1:8001")
@@ -0,0 +1,35 @@
+import pytest
+
+from microblog_app.posts import Post, decode_posts, encode_posts
+
+
+def test_encoded_posts_decode_to_the_same_posts():
+    posts = [Post("hello", "alice"), Post("héllo wörld", "bob"), Post("", "alice")]
+
+    decoded = decode_posts(encode_posts(posts))
+
+    assert decoded == posts
+    assert [(post.message, post.username, post.hex) for post in decoded] == \
+           [(post.message, post.username, post.hex) for post in posts]
+
+
+def test_decoding_rejects_malformed_batches():
+    data = encode_posts([Post("hello", "alice")])
+
+    with pytest.raises(ValueError):
+        decode_posts(b"junk" + data)
+    with pytest.raises(ValueError):
+        decode_posts(data[:-3])
+
+
+def test_posts_reject_long_messages():
+    with pytest.raises(ValueError):
+        Post("x" * 161, "alice")
+
+
+def test_posts_reject_malformed_ids():
+    post = Post("hello", "alice")
+    assert Post("hello", "alice", post.hex) == post
+
+    with pytest.raises(ValueError):
+        Post("hello", "alice", "z" * 32)
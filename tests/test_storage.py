@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from microblog_app.storage import SegmentLog, SegmentLogStorage, TextFileStorage, migrate
+
+
+def payloads(n):
+    return [f"record {i}".encode() for i in range(n)]
+
+
+def test_segment_log_reads_back_across_segments(tmp_path):
+    log = SegmentLog(str(tmp_path / "log"), segment_bytes=64)
+    log.append_many(payloads(20))
+
+    assert len(log) == 20
+    assert len([name for name in os.listdir(log.path) if name.endswith('.seg')]) > 1
+    assert list(log) == payloads(20)
+    assert log.read_range(5, 12) == payloads(20)[5:12]
+    assert log.tail(3) == payloads(20)[:-4:-1]
+    log.close()
+
+
+def test_segment_log_recovers_after_reopening(tmp_path):
+    log = SegmentLog(str(tmp_path / "log"), segment_bytes=64)
+    log.append_many(payloads(20))
+    log.sync()
+    log.close()
+
+    log = SegmentLog(str(tmp_path / "log"), segment_bytes=64)
+    assert list(log) == payloads(20)
+    log.append(b"after")
+    assert log.tail(1) == [b"after"]
+    log.close()
+
+
+def test_segment_log_truncates_torn_record(tmp_path):
+    log = SegmentLog(str(tmp_path / "log"))
+    log.append_many(payloads(3))
+    log.close()
+
+    # A record whose header promises more bytes than were written
+    segment = os.path.join(log.path, f"{0:020d}.seg")
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(SegmentLog.header.pack(100, 0) + b"partial")
+
+    log = SegmentLog(str(tmp_path / "log"))
+    assert list(log) == payloads(3)
+    assert os.path.getsize(segment) == size
+    log.append(b"next")
+    assert list(log) == payloads(3) + [b"next"]
+    log.close()
+
+
+def test_segment_log_reindexes_records_missing_from_index(tmp_path):
+    log = SegmentLog(str(tmp_path / "log"))
+    log.append_many(payloads(5))
+    log.close()
+
+    # The records reached the segment but only the first two reached the index
+    index = os.path.join(log.path, f"{0:020d}.idx")
+    with open(index, 'r+b') as f:
+        f.truncate(2 * SegmentLog.index_entry.size)
+
+    log = SegmentLog(str(tmp_path / "log"))
+    assert len(log) == 5
+    assert list(log) == payloads(5)
+    log.close()
+
+
+def test_segment_log_drops_index_entries_past_segment_end(tmp_path):
+    log = SegmentLog(str(tmp_path / "log"))
+    log.append_many(payloads(5))
+    log.close()
+
+    # The index reached the disk but the last record of the segment did not
+    segment = os.path.join(log.path, f"{0:020d}.seg")
+    with open(segment, 'r+b') as f:
+        f.truncate(os.path.getsize(segment) - 1)
+
+    log = SegmentLog(str(tmp_path / "log"))
+    assert list(log) == payloads(4)
+    log.close()
+
+
+def test_segment_log_rejects_non_positive_segment_size(tmp_path):
+    with pytest.raises(ValueError):
+        SegmentLog(str(tmp_path / "log"), segment_bytes=0)
+
+
+def test_segment_log_storage_reads_ranges(tmp_path):
+    storage = SegmentLogStorage("alice", str(tmp_path), segment_bytes=128)
+    records = [f"post {i}" for i in range(30)]
+    storage.append_many("posts", records)
+
+    assert storage.count("posts") == 30
+    assert storage.count("likes") == 0
+    assert storage.read_all("posts") == records
+    assert storage.read_range("posts", 10, 20) == records[10:20]
+    assert storage.tail("posts", 2) == ["post 29", "post 28"]
+    storage.close()
+
+
+def test_migrate_copies_text_files_once(tmp_path):
+    source = TextFileStorage("alice", str(tmp_path))
+    source.append_many("posts", ["first", "second"])
+    source.append_many("likes", ["liked"])
+    source.close()
+
+    assert migrate("alice", str(tmp_path)) == {'posts': 2, 'likes': 1, 'reposts': 0}
+
+    # Re-running the migration leaves the migrated logs alone
+    assert migrate("alice", str(tmp_path)) == {'posts': 0, 'likes': 0, 'reposts': 0}
+
+    target = SegmentLogStorage("alice", str(tmp_path))
+    assert target.read_all("posts") == ["first", "second"]
+    assert target.read_all("likes") == ["liked"]
+    assert target.read_all("reposts") == []
+    target.close()
@@ -0,0 +1,61 @@
+import pytest
+
+from microblog_app.storage import TextFileStorage
+from microblog_app.writer import AppendWriter, Durability
+
+
+class FailingStorage(TextFileStorage):
+    """A TextFileStorage whose appends to one entity always fail."""
+
+    def __init__(self, failing: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failing = failing
+
+    def append_many(self, entity, records):
+        if entity == self.failing:
+            raise OSError("disk full")
+        super().append_many(entity, records)
+
+
+@pytest.mark.parametrize('durability', list(Durability))
+def test_appends_are_written_in_order(tmp_path, durability):
+    storage = TextFileStorage("alice", str(tmp_path))
+    writer = AppendWriter(storage, durability, interval=0.01)
+    written = []
+
+    futures = [writer.append("posts", f"post {i}", on_written=lambda i=i: written.append(i)) for i in range(50)]
+    for future in futures:
+        assert future.result(timeout=5) is None
+    writer.close()
+
+    assert written == list(range(50))
+    assert storage.read_all("posts") == [f"post {i}" for i in range(50)]
+    storage.close()
+
+
+def test_group_failure_only_fails_the_failing_entity(tmp_path):
+    storage = FailingStorage("likes", "alice", str(tmp_path))
+    writer = AppendWriter(storage, Durability.GROUP, interval=0.05)
+    written = []
+
+    post = writer.append("posts", "post", on_written=lambda: written.append("post"))
+    like = writer.append("likes", "like", on_written=lambda: written.append("like"))
+
+    assert post.result(timeout=5) is None
+    with pytest.raises(OSError):
+        like.result(timeout=5)
+    writer.close()
+
+    assert written == ["post"]
+    assert storage.read_all("posts") == ["post"]
+    storage.close()
+
+
+def test_closed_writer_rejects_appends(tmp_path):
+    storage = TextFileStorage("alice", str(tmp_path))
+    writer = AppendWriter(storage, Durability.GROUP)
+    writer.close()
+
+    with pytest.raises(RuntimeError):
+        writer.append("posts", "post")
+    storage.close()
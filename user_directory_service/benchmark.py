@@ -0,0 +1,64 @@
+"""
+Load benchmark for the UDS store endpoints. Start the UDS under the serving
+mode to measure (SERVER=dev or SERVER=waitress), then run:
+
+python benchmark.py --target http://localhost:8080/store
+
+Registers --keys users with PUT, then looks them up with GET, each from
+--concurrency threads holding keep-alive sessions, and prints requests/sec
+for each phase.
+"""
+
+import argparse
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+parser = argparse.ArgumentParser(description='Benchmark the UDS store endpoints.')
+parser.add_argument('--target', default='http://localhost:8080/store', help='The store endpoint to load.')
+parser.add_argument('--keys', type=int, default=2000, help='The number of users to register.')
+parser.add_argument('--gets', type=int, default=10000, help='The number of lookups to issue.')
+parser.add_argument('--concurrency', type=int, default=32, help='The number of concurrent clients.')
+
+local: threading.local = threading.local()
+
+def session() -> requests.Session:
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+def run(name: str, count: int, concurrency: int, call: Callable[[int], bool]) -> Dict:
+    """Issues count calls from concurrency threads and reports their throughput."""
+    started: float = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results: List[bool] = list(executor.map(call, range(count)))
+    elapsed: float = time.perf_counter() - started
+
+    report: Dict = {
+        'phase': name,
+        'requests': count,
+        'failed': results.count(False),
+        'seconds': round(elapsed, 3),
+        'rps': round(count / elapsed, 1)
+        }
+    print(f"{name:>4}: {report['rps']:>9} req/s  ({count} requests, {report['failed']} failed, "
+          f"{report['seconds']} s)")
+    return report
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    prefix: str = f'bench-{int(time.time())}-'
+
+    def put(i: int) -> bool:
+        res: Dict = session().put(args.target, json={'key': f'{prefix}{i}', 'value': f'10.0.0.1:{i}'}).json()
+        return res.get('success', False)
+
+    def get(i: int) -> bool:
+        res: Dict = session().get(args.target, json={'key': f'{prefix}{i % args.keys}'}).json()
+        return res.get('value') is not None
+
+    run('PUT', args.keys, args.concurrency, put)
+    run('GET', args.gets, args.concurrency, get)
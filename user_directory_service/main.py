@@ -3,12 +3,25 @@ import sys
 
 from src import create_app
 
+# Serving configuration: 'dev' runs Flask's development server, 'waitress' runs
+#   the waitress production WSGI server with SERVER_THREADS request threads.
+#   Each node keeps its state in memory, so it is always served by a single
+#   process with many threads rather than by pre-forked worker processes.
+#   Every open /store/watch long poll holds a thread for up to WATCH_TIMEOUT.
+SERVER = os.environ.get('SERVER', 'dev')
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 64))
+SERVER_CONNECTIONS = int(os.environ.get('SERVER_CONNECTIONS', 1000))
+
 # Instance configuration
 if __name__ == "__main__":
     node_type = os.environ.get('NODE_TYPE', None)
-    print(f'Node type: {node_type}')
-    if node_type not in ('COORDINATOR', 'WORKER'):
+    print(f'Node type: {node_type}, server: {SERVER}')
+    if node_type not in ('COORDINATOR', 'WORKER') or SERVER not in ('dev', 'waitress'):
         sys.exit(1)
 
     app = create_app(coordinator=(node_type == 'COORDINATOR'))
-    app.run(host='0.0.0.0', port=8080)
+    if SERVER == 'waitress':
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=8080, threads=SERVER_THREADS, connection_limit=SERVER_CONNECTIONS)
+    else:
+        app.run(host='0.0.0.0', port=8080, threaded=True)
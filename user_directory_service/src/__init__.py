@@ -1,30 +1,39 @@
-import os
-import requests
-import sys
-
 from typing import Dict
 from flask import Flask
 
 d: Dict = {}
 d['data'] = {}
 
+# In partitioned mode, the consistent-hash ring of the cluster and the address
+#   of this worker as seen by the coordinator
+d['ring'] = None
+d['self'] = None
+
+# Highest version of any entry this worker holds
+d['version'] = -1
+
 def create_app(coordinator=False) -> Flask:
     app = Flask(__name__)
 
+    from .metrics import instrument
+    instrument(app)
+
     if coordinator:
         from .coordinator import coordinator
         app.register_blueprint(coordinator, url_prefix='/coordinator')
     else:
         from .store import store
-        from .worker import worker
+        from .worker import recover, start_heartbeats, worker
         app.register_blueprint(store, url_prefix='/store')
         app.register_blueprint(worker, url_prefix='/worker')
 
-        # Attempt to join the cluster by making a request to the coordinator
-        c_host: str = os.environ['COORDINATOR']
-        res: Dict = requests.post(f'http://{c_host}/coordinator/join').json()
-        if not res.get('success', False):
-            print('Failed to join UDS cluster!')
-            sys.exit(1)
+        # Restore local state before joining so that lookups are served from
+        #   the first request
+        recover()
+
+        # Join the cluster in the background once the worker is serving,
+        #   since rounds include it as soon as the coordinator has accepted
+        #   the join; reads wait until it has caught up
+        start_heartbeats()
 
     return app
@@ -1,9 +1,85 @@
+import os
 import requests
 
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, Iterable
+from urllib3.util.retry import Retry
 
-def mb_post(*args, **kwargs) -> Dict:
-    return requests.post(*args, **kwargs, timeout=(3.05, 5)).json()
+# RPC configuration: keep-alive connections kept per node, nodes with pooled
+#   connections, connect retries with exponential backoff (a request that
+#   never reached the node is always safe to resend), default timeouts, and
+#   threads available for fan-out
+RPC_POOL_SIZE: int = int(os.environ.get('RPC_POOL_SIZE', 32))
+RPC_POOL_NODES: int = int(os.environ.get('RPC_POOL_NODES', 64))
+RPC_RETRIES: int = int(os.environ.get('RPC_RETRIES', 3))
+RPC_BACKOFF: float = float(os.environ.get('RPC_BACKOFF', 0.05))
+RPC_CONNECT_TIMEOUT: float = float(os.environ.get('RPC_CONNECT_TIMEOUT', 3.05))
+RPC_READ_TIMEOUT: float = float(os.environ.get('RPC_READ_TIMEOUT', 5))
+RPC_FANOUT_THREADS: int = int(os.environ.get('RPC_FANOUT_THREADS', 32))
+
+# Shared session for all RPCs between the nodes of the cluster, which reuses
+#   connections to each node instead of opening one per request
+_session: requests.Session = requests.Session()
+_session.mount('http://', HTTPAdapter(
+    pool_connections=RPC_POOL_NODES,
+    pool_maxsize=RPC_POOL_SIZE,
+    max_retries=Retry(total=None, connect=RPC_RETRIES, read=0, redirect=0, status=0, other=0,
+            backoff_factor=RPC_BACKOFF)))
+
+# Shared pool for fanning out RPCs to the nodes of the cluster
+_fanout_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=RPC_FANOUT_THREADS)
+
+def mb_post(url: str, **kwargs) -> Dict:
+    kwargs.setdefault('timeout', (RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT))
+    return _session.post(url, **kwargs).json()
+
+def mb_get(url: str, **kwargs) -> Dict:
+    kwargs.setdefault('timeout', (RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT))
+    return _session.get(url, **kwargs).json()
+
+def mb_fanout(nodes: Iterable[str], path: str, payload: Dict, deadline: float) -> Dict[str, Dict]:
+    """
+    POSTs the same JSON payload to path on every node concurrently and waits at
+    most deadline seconds for all of the responses.
+
+    Returns a dict mapping each node to its response. Nodes that failed or did
+    not respond before the deadline are mapped to an unsuccessful response.
+    """
+    return mb_fanout_each({node: payload for node in nodes}, path, deadline)
+
+def mb_fanout_each(payloads: Dict[str, Dict], path: str, deadline: float,
+        until: Callable[[Dict[str, Dict]], bool] = None) -> Dict[str, Dict]:
+    """
+    Like mb_fanout, but POSTs a different JSON payload to each node, given as
+    a dict mapping each node to its payload.
+
+    If until is given, it is called with the responses received so far after
+    each response arrives, and the fan-out returns as soon as it returns True.
+    Nodes that have not responded by then are left out of the result and
+    their requests complete in the background.
+    """
+    futures = {_fanout_pool.submit(mb_post, f'http://{node}{path}', json=payload): node
+            for node, payload in payloads.items()}
+
+    results: Dict[str, Dict] = {}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            node: str = futures[future]
+            if future.exception() is not None:
+                results[node] = {'success': False, 'msg': str(future.exception())}
+            else:
+                results[node] = future.result()
+            if until is not None and until(results):
+                return results
+    except TimeoutError:
+        pass
+
+    for future, node in futures.items():
+        if node not in results:
+            future.cancel()
+            results[node] = {'success': False, 'msg': 'Deadline exceeded'}
+    return results
 
 def validate_trans(transaction: Dict) -> bool:
     return transaction.get('key', False) and transaction.get('value', False)
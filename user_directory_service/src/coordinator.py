@@ -1,85 +1,460 @@
 import json
+import os
+import sys
 import threading
+import time
+import traceback
 import flask
 
-from typing import Dict, Set
-from requests.exceptions import ConnectTimeout
+from typing import Dict, List, Set, Tuple
 from flask import Blueprint, jsonify, request
 
-from .common import mb_post, validate_trans
+from .common import mb_fanout, mb_fanout_each, validate_trans
+from .metrics import Counter, Histogram, TimedLock
+from .ring import HashRing
 
 coordinator: Blueprint = Blueprint('coordinator', __name__)
-lock: threading.Lock = threading.Lock()
+lock: TimedLock = TimedLock('coordinator')
 
 tid: int = 0
 n_replica = 0
 nodes: Set[str] = set()
 
+# Batching configuration: maximum queued requests per round, how long to wait for
+#   a round to fill up, and how long to wait for all workers in each phase
+BATCH_MAX_SIZE: int = int(os.environ.get('BATCH_MAX_SIZE', 256))
+BATCH_WINDOW: float = float(os.environ.get('BATCH_WINDOW', 0.002))
+ROUND_DEADLINE: float = float(os.environ.get('ROUND_DEADLINE', 5.0))
+
+# Partitioning configuration: when enabled, each key is stored only on the
+#   REPLICATION_FACTOR workers that own it on a consistent-hash ring
+PARTITIONED: bool = os.environ.get('PARTITIONED', '0') == '1'
+REPLICATION_FACTOR: int = int(os.environ.get('REPLICATION_FACTOR', 3))
+VIRTUAL_NODES: int = int(os.environ.get('VIRTUAL_NODES', 64))
+
+# Workers writing in quorum mode find the replicas of a key on the ring, so
+#   it is distributed in that mode too; unpartitioned, every worker owns every key
+WRITE_MODE: str = os.environ.get('WRITE_MODE', '2pc')
+DISTRIBUTE_RING: bool = PARTITIONED or WRITE_MODE == 'quorum'
+ring: HashRing = HashRing(vnodes=VIRTUAL_NODES,
+        replication_factor=REPLICATION_FACTOR if PARTITIONED else sys.maxsize)
+
+# Failure detection: workers send a heartbeat every HEARTBEAT_INTERVAL seconds
+#   and become suspect after SUSPECT_AFTER and dead after DEAD_AFTER seconds
+#   without one. Only live workers take part in rounds, and a round only runs
+#   if enough replicas are live under QUORUM: 'majority', 'all' or a number.
+#   Workers silent for REMOVE_AFTER seconds leave the cluster and the ring,
+#   so that the quorum is not counted over every address that ever joined.
+HEARTBEAT_INTERVAL: float = float(os.environ.get('HEARTBEAT_INTERVAL', 1.0))
+SUSPECT_AFTER: float = float(os.environ.get('SUSPECT_AFTER', 3 * HEARTBEAT_INTERVAL))
+DEAD_AFTER: float = float(os.environ.get('DEAD_AFTER', 10 * HEARTBEAT_INTERVAL))
+REMOVE_AFTER: float = float(os.environ.get('REMOVE_AFTER', 60 * HEARTBEAT_INTERVAL))
+QUORUM: str = os.environ.get('QUORUM', 'majority')
+
+# Failure detector state of every worker in nodes. A worker is 'joining'
+#   from the moment it joins until it has caught up: it takes part in rounds
+#   so that it misses none, but does not count towards their quorum.
+members: Dict[str, Dict] = {}
+detector: threading.Thread = None
+
+# Requests waiting for the next two-phase commit round
+pending: List[Dict] = []
+pending_cond: threading.Condition = threading.Condition(TimedLock('pending'))
+committer: threading.Thread = None
+
+# Held for the whole of every round, so that a joining worker waits out the
+#   round in flight, which was routed without it, before it catches up
+round_lock: TimedLock = TimedLock('round')
+
+# Round statistics
+stats: Dict = {
+    'rounds': 0,
+    'transactions': 0,
+    'committed': 0,
+    'rolled_back': 0,
+    'last_batch_size': 0,
+    'last_round_ms': 0.0,
+    'total_round_ms': 0.0,
+}
+
+# Round metrics exposed on /metrics
+PHASE_SECONDS: Histogram = Histogram('uds_2pc_phase_duration_seconds',
+        'Time spent in each two-phase commit phase, by phase.')
+ROUND_SECONDS: Histogram = Histogram('uds_2pc_round_duration_seconds',
+        'Time spent in each two-phase commit round, by outcome.')
+ROUND_TRANSACTIONS: Histogram = Histogram('uds_2pc_round_transactions', 'Transactions committed together per round.',
+        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+TRANSACTIONS: Counter = Counter('uds_2pc_transactions_total', 'Transactions handled, by outcome.')
+
 @coordinator.route('/join', methods=['POST'])
 def join() -> flask.Response:
-    global n_replica, nodes
+    global n_replica, nodes, tid
 
-    replica_address:str = request.remote_addr
-    n_replica += 1
-    nodes.add(f'{replica_address}:8080')
+    body: Dict = json.loads(request.data) if request.data else {}
+    address: str = body.get('address') or f'{request.remote_addr}:8080'
+
+    # Every round from now on includes the new worker, and every earlier one
+    #   has finished on its peers, so catching up to the returned tid from
+    #   them leaves no gap
+    with round_lock, lock:
+        n_replica += 1
+        nodes.add(address)
+        members[address] = {'state': 'joining', 'last_seen': time.monotonic(), 'rtt_ms': None,
+                'version': body.get('version', -1)}
+        ensure_detector()
+        tid = max(tid, int(body.get('version', -1)) + 1)
+        joined_at: int = tid
+        changed: bool = DISTRIBUTE_RING and ring.add(address)
+        current: Dict = ring.to_dict()
+        peers: List[str] = sorted(node for node in live_nodes() if node != address)
+
+    # Hand the new ring to the existing workers, which stream the keys the new
+    #   worker now owns to it; the new worker receives the ring in the response
+    if changed:
+        distribute_ring(current, [node for node in current['nodes'] if node != address])
 
     return jsonify({
         'success': True,
-         'msg': f''           
+        'address': address,
+        'ring': current if DISTRIBUTE_RING else None,
+        'nodes': peers,
+        'tid': joined_at,
+         'msg': f''
         })
 
-@coordinator.route('/start', methods=['POST'])
-def start() -> flask.Response:
-    global tid, nodes
+@coordinator.route('/ready', methods=['POST'])
+def ready() -> flask.Response:
+    body: Dict = json.loads(request.data)
+    address: str = body.get('address', '')
+
+    # A joining worker that has caught up starts counting towards quorums; one
+    #   suspended while catching up must join again
     with lock:
-        transaction: Dict = json.loads(request.data)
-        if not validate_trans(transaction):
+        member: Dict = members.get(address)
+        if member is None or member['state'] not in ('joining', 'live'):
             return jsonify({
                 'success': False,
-                'msg': 'Invalid transaction'
+                'rejoin': True,
+                'msg': f'{address} must rejoin'
                 })
+        member['state'] = 'live'
 
-        # add transaction id to transaction object and increment global id
-        transaction['id'] = tid
-        tid += 1
-
-        # Prepare Phase
-        doCommit: bool = True
-        for w in nodes:
-            # res:Dict = requests.post(f'http://{w}/worker/prepare',
-            #         json=transaction).json()
-            try:
-                res:Dict = mb_post(f'http://{w}/worker/prepare', json=transaction)
-            except ConnectTimeout:
-                # worker node down or unresponsive
-                doCommit = False
-                break
-            
-            # if any worker node is unable to prepare, rollback transaction
-            if not res.get('success', False):
-                doCommit = False
-                break
+    return jsonify({
+        'success': True,
+        'rejoin': False,
+        'msg': f'{address} is live'
+        })
 
-        # Commit/Rollback Phase
-        if doCommit:
-            for w in nodes:
-                # requests.post(f'http://{w}/worker/commit', json=transaction)
-                try:
-                    mb_post(f'http://{w}/worker/commit', json=transaction)
-                except ConnectTimeout:
-                    pass
+@coordinator.route('/heartbeat', methods=['POST'])
+def heartbeat() -> flask.Response:
+    body: Dict = json.loads(request.data)
+    address: str = body.get('address', '')
+    with lock:
+        member: Dict = members.get(address)
 
+        # A worker this coordinator does not know (after a restart) or has
+        #   suspended may have missed commits, so it must catch up and rejoin
+        if member is None or member['state'] not in ('joining', 'live'):
             return jsonify({
                 'success': True,
-                'msg': f'Commited transaction {transaction["id"]}'})
+                'rejoin': True,
+                'msg': f'{address} must rejoin'
+                })
+
+        member['last_seen'] = time.monotonic()
+        member['rtt_ms'] = body.get('rtt_ms')
+        member['version'] = body.get('version', member['version'])
+
+    return jsonify({
+        'success': True,
+        'rejoin': False,
+        'msg': ''
+        })
+
+@coordinator.route('/members', methods=['GET'])
+def get_members() -> flask.Response:
+    now: float = time.monotonic()
+    with lock:
+        return jsonify({
+            'members': {address: {
+                'state': member['state'],
+                'last_seen_ms': round((now - member['last_seen']) * 1000, 1),
+                'rtt_ms': member['rtt_ms'],
+                'version': member['version']
+                } for address, member in members.items()},
+            'live': len(live_nodes()),
+            'quorum': QUORUM,
+            'success': True
+            })
+
+@coordinator.route('/ring', methods=['GET'])
+def get_ring() -> flask.Response:
+    with lock:
+        return jsonify({
+            'ring': ring.to_dict() if DISTRIBUTE_RING else None,
+            'success': True
+            })
+
+@coordinator.route('/start', methods=['POST'])
+def start() -> flask.Response:
+    # The request holds either a single transaction or a list of transactions
+    #   under 'transactions' which must be committed together
+    body: Dict = json.loads(request.data)
+    transactions: List[Dict] = body.get('transactions', [body])
+    if not transactions or not all(validate_trans(t) for t in transactions):
+        return jsonify({
+            'success': False,
+            'msg': 'Invalid transaction'
+            })
+
+    # Queue the transactions for the next round and wait for their outcome
+    entry: Dict = {'transactions': transactions, 'done': threading.Event()}
+    with pending_cond:
+        ensure_committer()
+        pending.append(entry)
+        pending_cond.notify()
+    entry['done'].wait()
+
+    return jsonify(entry['result'])
+
+@coordinator.route('/stats', methods=['GET'])
+def get_stats() -> flask.Response:
+    with lock:
+        rounds: int = stats['rounds']
+        return jsonify({
+            **stats,
+            'avg_batch_size': stats['transactions'] / rounds if rounds else 0.0,
+            'avg_round_ms': stats['total_round_ms'] / rounds if rounds else 0.0,
+            'success': True
+            })
+
+def ensure_committer() -> None:
+    """Starts the committer thread if it is not running. Caller holds pending_cond."""
+    global committer
+    if committer is None or not committer.is_alive():
+        committer = threading.Thread(target=run_committer, daemon=True)
+        committer.start()
+
+def run_committer() -> None:
+    """Runs two-phase commit rounds over batches of pending requests forever."""
+    while True:
+        with pending_cond:
+            while not pending:
+                pending_cond.wait()
+
+            # Give concurrent registrations a brief window to join the round
+            deadline: float = time.monotonic() + BATCH_WINDOW
+            while len(pending) < BATCH_MAX_SIZE and time.monotonic() < deadline:
+                pending_cond.wait(deadline - time.monotonic())
+
+            batch: List[Dict] = pending[:BATCH_MAX_SIZE]
+            del pending[:BATCH_MAX_SIZE]
+
+        try:
+            with round_lock:
+                run_round(batch)
+        except Exception as e:
+            # Requests wait on their round without a timeout, so a round that
+            #   failed unexpectedly must still answer every one of them
+            traceback.print_exc()
+            TRANSACTIONS.inc(sum(len(entry['transactions']) for entry in batch), outcome='failed')
+            for entry in batch:
+                if not entry['done'].is_set():
+                    entry['result'] = {
+                        'success': False,
+                        'msg': f'Round failed: {type(e).__name__}: {e}'
+                        }
+                    entry['done'].set()
+
+def ensure_detector() -> None:
+    """Starts the failure detector thread if it is not running. Caller holds lock."""
+    global detector
+    if detector is None or not detector.is_alive():
+        detector = threading.Thread(target=run_detector, daemon=True)
+        detector.start()
+
+def run_detector() -> None:
+    """
+    Marks workers suspect or dead as their heartbeats stop, and removes dead
+    workers from the cluster once they have been silent for REMOVE_AFTER,
+    forever.
+    """
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        now: float = time.monotonic()
+        with lock:
+            removed: List[str] = []
+            for address, member in members.items():
+                silent: float = now - member['last_seen']
+                if silent > REMOVE_AFTER and member['state'] == 'dead':
+                    removed.append(address)
+                elif silent > DEAD_AFTER and member['state'] != 'dead':
+                    member['state'] = 'dead'
+                    print(f'Worker {address} is dead')
+                elif silent > SUSPECT_AFTER and member['state'] in ('joining', 'live'):
+                    member['state'] = 'suspect'
+                    print(f'Worker {address} is suspect')
+
+            changed: bool = False
+            for address in removed:
+                del members[address]
+                nodes.discard(address)
+                changed = ring.remove(address) or changed
+                print(f'Worker {address} was removed from the cluster')
+            current: Dict = ring.to_dict()
+
+        # The remaining owners of the removed workers' keys stream them to the
+        #   workers which now own them in their place; a removed worker that
+        #   comes back is told to rejoin
+        if changed and DISTRIBUTE_RING:
+            distribute_ring(current, current['nodes'])
+
+def distribute_ring(current: Dict, targets: List[str]) -> None:
+    """Sends the ring to targets in the background, which rebalance their keys under it."""
+    threading.Thread(target=mb_fanout, args=(targets, '/worker/ring', current, ROUND_DEADLINE),
+            daemon=True).start()
+
+def suspect(addresses: List[str]) -> None:
+    """Suspends workers that failed to answer an RPC until they rejoin. Caller holds lock."""
+    for address in addresses:
+        if address in members and members[address]['state'] in ('joining', 'live'):
+            members[address]['state'] = 'suspect'
+            print(f'Worker {address} is suspect')
+
+def live_nodes() -> Set[str]:
+    """Returns the workers counted towards the quorum of rounds. Caller holds lock."""
+    return {node for node in nodes if members.get(node, {}).get('state') == 'live'}
+
+def participants() -> Set[str]:
+    """Returns the workers taking part in rounds, including joining ones. Caller holds lock."""
+    return {node for node in nodes if members.get(node, {}).get('state') in ('joining', 'live')}
+
+def quorum_size(replicas: int) -> int:
+    """Returns how many of replicas must be live for a round to run."""
+    if QUORUM == 'all':
+        return replicas
+    if QUORUM == 'majority':
+        return replicas // 2 + 1
+    return min(int(QUORUM), replicas)
+
+def route_transactions(batch: List[Dict]) -> Tuple[Dict[str, Dict], List[Dict]]:
+    """
+    Returns the prepare/commit payload for each worker taking part in a
+    round, and the queued requests it covers. Every live or joining worker
+    receives every transaction, unless the cluster is partitioned, in which
+    case each worker receives only the transactions for keys it owns. A
+    request is left out of the round if too few replicas of any of its keys
+    are live to meet the quorum, so that it fails without failing the rest of
+    the batch; its transactions still go together. Caller holds lock.
+    """
+    live: Set[str] = live_nodes()
+    taking_part: Set[str] = participants()
+    if not PARTITIONED:
+        if len(live) < max(quorum_size(len(nodes)), 1):
+            return {}, []
+        transactions: List[Dict] = [t for entry in batch for t in entry['transactions']]
+        return {node: {'transactions': transactions} for node in taking_part}, batch
+
+    routed: Dict[str, List[Dict]] = {}
+    included: List[Dict] = []
+    for entry in batch:
+        placement: List[Tuple[Dict, List[str]]] = []
+        for transaction in entry['transactions']:
+            owners: List[str] = ring.owners(transaction['key'])
+            if sum(owner in live for owner in owners) < max(quorum_size(len(owners)), 1):
+                break
+            placement.append((transaction, [owner for owner in owners if owner in taking_part]))
         else:
-            for w in nodes:
-                # requests.post(f'http://{w}/worker/rollback', json=transaction)
-                try:
-                    mb_post(f'http://{w}/worker/rollback', json=transaction)
-                except ConnectTimeout:
-                    pass
+            included.append(entry)
+            for transaction, available in placement:
+                for owner in available:
+                    routed.setdefault(owner, []).append(transaction)
+    return {node: {'transactions': owned} for node, owned in routed.items()}, included
 
-            return jsonify({
-                'success': False,
-                'msg': f'Rolled back transaction {transaction["id"]}'})
+def run_phases(payloads: Dict[str, Dict]) -> Tuple[bool, List[str]]:
+    """
+    Runs the prepare and commit/rollback phases of a round over the given
+    workers. Returns whether the round committed and the workers that did
+    not answer, which are suspended so that later rounds do not wait on them.
+    """
+    # Prepare Phase
+    with PHASE_SECONDS.time(phase='prepare'):
+        votes: Dict[str, Dict] = mb_fanout_each(payloads, '/worker/prepare', ROUND_DEADLINE)
+    doCommit: bool = all(vote.get('success', False) for vote in votes.values())
+
+    # Commit/Rollback Phase
+    with PHASE_SECONDS.time(phase='commit' if doCommit else 'rollback'):
+        outcomes: Dict[str, Dict] = mb_fanout_each(payloads, '/worker/commit' if doCommit else '/worker/rollback',
+                ROUND_DEADLINE)
+
+    unreachable: List[str] = [node for node in payloads
+            if not votes[node].get('success', False) or not outcomes[node].get('success', False)]
+    with lock:
+        suspect(unreachable)
+    return doCommit, unreachable
+
+def run_round(batch: List[Dict]) -> None:
+    """
+    Runs a single two-phase commit round for a batch of queued requests. Every
+    participating worker is asked to prepare its share of the batch in
+    parallel; the batch is committed only if every worker prepares it before
+    the round deadline, otherwise it is rolled back everywhere. Requests
+    whose keys have too few live replicas fail on their own. A round that
+    failed because workers stopped answering is retried once without them.
+    """
+    global tid
+    started: float = time.monotonic()
+
+    transactions: List[Dict] = [t for entry in batch for t in entry['transactions']]
+
+    with lock:
+        # add transaction ids to transaction objects and increment global id
+        for transaction in transactions:
+            transaction['tid'] = tid
+            tid += 1
+
+    doCommit: bool = False
+    included: List[Dict] = []
+    for attempt in range(2):
+        with lock:
+            payloads, included = route_transactions(batch)
+
+        # Without enough live workers for any request, the round fails right away
+        if not payloads:
+            included = []
+            break
+        doCommit, unreachable = run_phases(payloads)
+        if doCommit or not unreachable:
+            break
+
+    committed: Set[int] = {id(entry) for entry in included} if doCommit else set()
+    n_committed: int = sum(len(entry['transactions']) for entry in included) if doCommit else 0
+    n_rolled_back: int = len(transactions) - n_committed
+
+    round_ms: float = (time.monotonic() - started) * 1000
+    ROUND_SECONDS.observe(round_ms / 1000, outcome='committed' if doCommit else 'rolled_back')
+    ROUND_TRANSACTIONS.observe(len(transactions))
+    TRANSACTIONS.inc(n_committed, outcome='committed')
+    TRANSACTIONS.inc(n_rolled_back, outcome='rolled_back')
+    with lock:
+        stats['rounds'] += 1
+        stats['transactions'] += len(transactions)
+        stats['committed'] += n_committed
+        stats['rolled_back'] += n_rolled_back
+        stats['last_batch_size'] = len(transactions)
+        stats['last_round_ms'] = round_ms
+        stats['total_round_ms'] += round_ms
+
+    for entry in batch:
+        success: bool = id(entry) in committed
+        transaction_id: int = entry['transactions'][-1]['tid']
+        entry['result'] = {
+            'success': success,
+            'msg': f'Commited transaction {transaction_id}' if success
+                else f'Rolled back transaction {transaction_id}',
+            'tid': transaction_id,
+            'versions': [t['tid'] for t in entry['transactions']],
+            'batch_size': len(transactions),
+            'round_ms': round_ms
+            }
+        entry['done'].set()
@@ -0,0 +1,157 @@
+import bisect
+import threading
+import time
+import flask
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+from flask import Blueprint, Flask, g, request
+
+metrics: Blueprint = Blueprint('metrics', __name__)
+
+# Upper bounds in seconds of the buckets of every latency histogram
+LATENCY_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0)
+
+# Every metric, in the order it is rendered
+registry: List = []
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Formats sorted (name, value) label pairs as a Prometheus label set."""
+    if not labels:
+        return ''
+    escaped: List[str] = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for name, value in labels]
+    return '{' + ','.join(escaped) + '}'
+
+class Counter:
+    """Monotonically increasing count, kept per set of label values."""
+
+    def __init__(self, name: str, help: str):
+        self.name: str = name
+        self.help: str = help
+        self.lock: threading.Lock = threading.Lock()
+        self.values: Dict[Tuple, float] = {}
+        registry.append(self)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key: Tuple = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values: List[Tuple[Tuple, float]] = list(self.values.items())
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter'] + \
+                [f'{self.name}{format_labels(key)} {value}' for key, value in values]
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets, kept per set of label
+    values. Observing costs a bisect and a short critical section; buckets are
+    only made cumulative when the histogram is rendered.
+    """
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name: str = name
+        self.help: str = help
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self.lock: threading.Lock = threading.Lock()
+        # Per label set: the count in each bucket (the last is +Inf), the sum and the count
+        self.series: Dict[Tuple, List] = {}
+        registry.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key: Tuple = tuple(sorted(labels.items()))
+        index: int = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series: List = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the time in seconds spent in the block or decorated function."""
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            series: List[Tuple[Tuple, List]] = [(key, [list(s[0]), s[1], s[2]]) for key, s in self.series.items()]
+
+        lines: List[str] = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in series:
+            cumulative: int = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le: str = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", le),))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+REQUESTS: Counter = Counter('uds_requests_total', 'Requests handled, by endpoint, method and status.')
+REQUEST_SECONDS: Histogram = Histogram('uds_request_duration_seconds', 'Time spent handling requests, by endpoint.')
+LOCK_WAIT_SECONDS: Histogram = Histogram('uds_lock_wait_seconds', 'Time spent waiting to acquire a lock, by lock.')
+
+class TimedLock:
+    """
+    Drop-in replacement for threading.Lock that records how long each blocking
+    acquire waited in LOCK_WAIT_SECONDS. It can back a threading.Condition.
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self._lock: threading.Lock = threading.Lock()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if not blocking:
+            return self._lock.acquire(False)
+        started: float = time.perf_counter()
+        acquired: bool = self._lock.acquire(True, timeout)
+        if acquired:
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, lock=self.name)
+        return acquired
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+def render() -> str:
+    """Renders every metric in the Prometheus text exposition format."""
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+def start_timer() -> None:
+    g.request_started = time.perf_counter()
+
+def record_request(response: flask.Response) -> flask.Response:
+    endpoint: str = request.endpoint or 'unmatched'
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+    started: float = g.get('request_started')
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+def instrument(app: Flask) -> None:
+    """Counts and times every request to app and serves /metrics from it."""
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    app.register_blueprint(metrics)
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics() -> flask.Response:
+    return flask.Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
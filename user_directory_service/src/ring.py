@@ -0,0 +1,91 @@
+import hashlib
+
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Tuple
+
+def ring_hash(value: str) -> int:
+    """Maps a string to a position on the ring."""
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+class HashRing:
+    """
+    Consistent-hash ring assigning each key to replication_factor distinct
+    nodes. Every node is placed on the ring at vnodes positions so that keys
+    are spread evenly and only about 1/N of the keys move when a node joins.
+    The epoch counts membership changes so that stale rings can be discarded.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 64, replication_factor: int = 3):
+        if vnodes < 1 or replication_factor < 1:
+            raise ValueError('vnodes and replication_factor must be positive')
+
+        self.vnodes: int = vnodes
+        self.replication_factor: int = replication_factor
+        self.nodes: List[str] = []
+        self.epoch: int = 0
+        self._points: List[Tuple[int, str]] = []
+
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> bool:
+        """Adds a node to the ring. Returns False if it was already present."""
+        if node in self.nodes:
+            return False
+
+        self.nodes.append(node)
+        self.epoch += 1
+        self._points.extend((ring_hash(f'{node}#{i}'), node) for i in range(self.vnodes))
+        self._points.sort()
+        return True
+
+    def remove(self, node: str) -> bool:
+        """Removes a node from the ring. Returns False if it was not present."""
+        if node not in self.nodes:
+            return False
+
+        self.nodes.remove(node)
+        self.epoch += 1
+        self._points = [point for point in self._points if point[1] != node]
+        return True
+
+    def owners(self, key: str) -> List[str]:
+        """
+        Returns the nodes responsible for key, primary first, found by walking
+        the ring clockwise from the position of the key.
+        """
+        if not self._points:
+            return []
+        return self._owners_from(bisect_right(self._points, (ring_hash(key), '')))
+
+    def arcs(self) -> List[List[str]]:
+        """
+        Returns the owners of each arc between consecutive positions on the
+        ring. Every key falls on one arc and is owned by the owners of that arc.
+        """
+        return [self._owners_from(i) for i in range(len(self._points))]
+
+    def _owners_from(self, i: int) -> List[str]:
+        """Returns the distinct nodes found walking the ring clockwise from position i."""
+        wanted: int = min(self.replication_factor, len(self.nodes))
+        owners: List[str] = []
+        while len(owners) < wanted:
+            node: str = self._points[i % len(self._points)][1]
+            if node not in owners:
+                owners.append(node)
+            i += 1
+        return owners
+
+    def to_dict(self) -> Dict:
+        return {
+            'nodes': list(self.nodes),
+            'vnodes': self.vnodes,
+            'replication_factor': self.replication_factor,
+            'epoch': self.epoch
+            }
+
+    @classmethod
+    def from_dict(cls, ring: Dict) -> 'HashRing':
+        restored: HashRing = cls(ring['nodes'], ring['vnodes'], ring['replication_factor'])
+        restored.epoch = ring.get('epoch', restored.epoch)
+        return restored
@@ -4,27 +4,170 @@ import requests
 import threading
 import flask
 
-from typing import Dict
+from typing import Dict, List
 from flask import Blueprint, jsonify, request
 
 from . import d
+from .common import RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT, mb_fanout_each, mb_get, mb_post
+from .worker import (CATCH_UP_DEADLINE, caught_up, copy_data, next_version, wait_for_changes, wait_for_version,
+        write_local)
 
 KEY_STRING: str = 'username'
 VALUE_STRING: str = 'IP address'
 
 store: Blueprint = Blueprint('store', __name__)
-lock: threading.Lock = threading.Lock()
 
 coordinator = os.environ['COORDINATOR']
 
+# How long to wait for owners when forwarding reads in partitioned mode
+FORWARD_DEADLINE: float = float(os.environ.get('FORWARD_DEADLINE', 5.0))
+
+# How long a read with a min_version waits for that version to be committed
+MIN_VERSION_TIMEOUT: float = float(os.environ.get('MIN_VERSION_TIMEOUT', 2.0))
+
+# Longest time a watch request is held open waiting for a change
+WATCH_TIMEOUT: float = float(os.environ.get('WATCH_TIMEOUT', 30.0))
+
+# Write path: '2pc' commits every write through the coordinator, while
+#   'quorum' writes directly to the replicas of each key and succeeds once
+#   WRITE_QUORUM of them (a majority if 0) accept it. In quorum mode, reads
+#   can consult READ_QUORUM replicas and return the newest entry.
+WRITE_MODE: str = os.environ.get('WRITE_MODE', '2pc')
+WRITE_QUORUM: int = int(os.environ.get('WRITE_QUORUM', 0))
+READ_QUORUM: int = int(os.environ.get('READ_QUORUM', 1))
+QUORUM_DEADLINE: float = float(os.environ.get('QUORUM_DEADLINE', 5.0))
+
+def owners(key: str) -> List[str]:
+    """
+    Returns the workers to ask for key: none if this worker holds it (always
+    the case unless the cluster is partitioned), otherwise its owners.
+    """
+    ring = d['ring']
+    if ring is None:
+        return []
+    found: List[str] = ring.owners(key)
+    return [] if d['self'] in found else found
+
+def forward_get(key: str, min_version: int) -> Dict:
+    """Reads key from its owners in turn, returning the first entry found."""
+    for owner in owners(key):
+        try:
+            entry: Dict = mb_get(f'http://{owner}/store',
+                    json={'key': key, 'min_version': min_version, 'local': True},
+                    timeout=(RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT + MIN_VERSION_TIMEOUT))
+        except (requests.RequestException, ValueError):
+            continue
+        if 'value' in entry:
+            return entry
+    return {}
+
+def catching_up() -> flask.Response:
+    """
+    Answers a read which waited CATCH_UP_DEADLINE for this worker to catch up
+    with the cluster after joining, since serving it could miss entries.
+    """
+    res: flask.Response = jsonify({
+        'success': False,
+        'msg': 'Worker is catching up with the cluster'
+        })
+    res.status_code = 503
+    return res
+
+def replicas(key: str) -> List[str]:
+    """Returns every worker holding key, including this one if it does."""
+    ring = d['ring']
+    return ring.owners(key) if ring is not None else [d['self']]
+
+def quorum_put(entries: Dict[str, str]) -> Dict[str, Dict]:
+    """
+    Writes entries directly to all of their replicas in parallel, without the
+    coordinator, and waits until each key has been accepted by a write quorum
+    of its replicas or the deadline expires. Replicas which have not answered
+    by then still receive the write in the background. Each entry is
+    versioned here and replicas keep the entry with the highest version (last
+    writer wins).
+
+    Returns the versioned entries whose write reached a quorum.
+    """
+    versioned: Dict[str, Dict] = {key: {'value': value, 'version': next_version()}
+            for key, value in entries.items()}
+
+    needed: Dict[str, int] = {}
+    payloads: Dict[str, Dict] = {}
+    for key, entry in versioned.items():
+        nodes: List[str] = replicas(key)
+        needed[key] = min(WRITE_QUORUM, len(nodes)) if WRITE_QUORUM > 0 else len(nodes) // 2 + 1
+        for node in nodes:
+            payloads.setdefault(node, {'data': {}})['data'][key] = entry
+
+    # The local replica is written in-process rather than over HTTP
+    local: Dict = payloads.pop(d['self'], {'data': {}})['data']
+
+    def acks(results: Dict[str, Dict]) -> Dict[str, int]:
+        count: Dict[str, int] = {key: 1 if key in local else 0 for key in versioned}
+        for node, res in results.items():
+            if res.get('success', False):
+                for key in payloads[node]['data']:
+                    count[key] += 1
+        return count
+
+    def reached(results: Dict[str, Dict]) -> bool:
+        return all(n >= needed[key] for key, n in acks(results).items())
+
+    # Every replica receives the write; the quorum only decides how long to
+    #   wait, so a write the local replica alone satisfies returns at once
+    write_local(local)
+    results: Dict[str, Dict] = {}
+    if payloads and reached(results):
+        threading.Thread(target=mb_fanout_each, args=(payloads, '/worker/receive', QUORUM_DEADLINE),
+                daemon=True).start()
+    elif payloads:
+        results = mb_fanout_each(payloads, '/worker/receive', QUORUM_DEADLINE, until=reached)
+
+    count: Dict[str, int] = acks(results)
+    return {key: entry for key, entry in versioned.items() if count[key] >= needed[key]}
+
+def quorum_get(key: str) -> Dict:
+    """
+    Reads key from READ_QUORUM of its replicas and returns the entry with the
+    highest version. Replicas found to hold an older entry are repaired in
+    the background.
+    """
+    nodes: List[str] = replicas(key)
+    wanted: int = min(READ_QUORUM, len(nodes))
+    found: Dict[str, Dict] = {}
+    if d['self'] in nodes:
+        found[d['self']] = d['data'].get(key, {})
+
+    payloads: Dict[str, Dict] = {node: {'keys': [key], 'local': True} for node in nodes if node != d['self']}
+    if len(found) < wanted:
+        def reached(results: Dict[str, Dict]) -> bool:
+            return len(found) + sum(res.get('success', False) for res in results.values()) >= wanted
+
+        results: Dict[str, Dict] = mb_fanout_each(payloads, '/store/batch_get', QUORUM_DEADLINE, until=reached)
+        for node, res in results.items():
+            if res.get('success', False):
+                found[node] = res.get('data', {}).get(key, {})
+
+    newest: Dict = max(found.values(), key=lambda entry: entry.get('version', -1), default={})
+    stale: Dict[str, Dict] = {node: {'data': {key: newest}} for node, entry in found.items()
+            if entry.get('version', -1) < newest.get('version', -1)}
+    if stale.pop(d['self'], None) is not None:
+        write_local({key: newest})
+    if stale:
+        threading.Thread(target=mb_fanout_each, args=(stale, '/worker/receive', QUORUM_DEADLINE),
+                daemon=True).start()
+    return newest
+
 @store.route('/all', methods=['GET'])
 def getAll() -> flask.Response:
-    with lock:
-        return jsonify({
-            'data': d['data'],
-            'success': True,
-            'msg': f'Retrieved all {VALUE_STRING}\'s'
-            })
+    if not caught_up.wait(CATCH_UP_DEADLINE):
+        return catching_up()
+    return jsonify({
+        'data': copy_data(),
+        'success': True,
+        'msg': f'Retrieved all {VALUE_STRING}\'s'
+        })
 
 @store.route('', methods=['GET', 'PUT'])
 def get() -> flask.Response:
@@ -37,26 +180,62 @@ def get() -> flask.Response:
             })
 
     if request.method == 'GET':
-        # No need for two-phase commit
-        with lock:
-            return jsonify(d['data'].get(key, {}))
+        # No need for two-phase commit; route to an owner if this worker does
+        #   not hold the key
+        min_version: int = int(req.get('min_version', -1))
+        if not req.get('local', False) and WRITE_MODE == 'quorum' and READ_QUORUM > 1:
+            entry: Dict = quorum_get(key)
+            if entry.get('version', -1) >= min_version:
+                return jsonify(entry)
+        if not req.get('local', False) and owners(key):
+            return jsonify(forward_get(key, min_version))
+
+        # Only committed entries are ever published, and entries are replaced
+        #   rather than modified, so single-key reads need no lock. A client
+        #   that has just written the key passes the version it was given to
+        #   read its write.
+        if not caught_up.wait(CATCH_UP_DEADLINE):
+            return catching_up()
+        if min_version >= 0:
+            return jsonify(wait_for_version(key, min_version, MIN_VERSION_TIMEOUT))
+        return jsonify(d['data'].get(key, {}))
     elif request.method == 'PUT':
-        value: str = json.loads(request.data).get('value', '')
+        value: str = req.get('value', '')
         if value == '':
             return jsonify({
                 'success': False,
                 'msg': f'Empty {VALUE_STRING} on PUT request'
                 })
 
+        if WRITE_MODE == 'quorum':
+            written: Dict = quorum_put({key: value}).get(key)
+            if written is None:
+                return jsonify({
+                    'data': '',
+                    'success': False,
+                    'msg': f'Failed to update {KEY_STRING}:{key} on a quorum of replicas'
+                    })
+            return jsonify({
+                'data': written,
+                'success': True,
+                'msg': f'Updated {KEY_STRING}:{key} with {VALUE_STRING}:{value}',
+                'version': written['version']
+                })
+
         # Start two-phase commit
         transaction: Dict = {'key': key, 'value': value}
-        res:Dict = requests.post(f'http://{coordinator}/coordinator/start', json=transaction).json()
+        res:Dict = mb_post(f'http://{coordinator}/coordinator/start', json=transaction,
+                timeout=(RPC_CONNECT_TIMEOUT, None))
 
         if res.get('success', False):
             return jsonify({
-                'data': d['data'].get(key, {}),
+                'data': {'value': value, 'version': res.get('tid')},
                 'success': True,
-                'msg': f'Updated {KEY_STRING}:{key} with {VALUE_STRING}:{value}'
+                'msg': f'Updated {KEY_STRING}:{key} with {VALUE_STRING}:{value}',
+                'tid': res.get('tid'),
+                'version': res.get('tid'),
+                'batch_size': res.get('batch_size'),
+                'round_ms': res.get('round_ms')
                 })
         else:
             return jsonify({
@@ -69,3 +248,124 @@ def get() -> flask.Response:
             'success': False,
             'msg': 'Invalid action'
             })
+
+@store.route('/watch', methods=['GET'])
+def watch() -> flask.Response:
+    # Long poll: answer as soon as anything newer than since is committed, or
+    #   with no changes once the timeout expires. The returned version is the
+    #   since cursor of the next poll; since=-1 returns every entry.
+    try:
+        since: int = int(request.args.get('since', -1))
+        timeout: float = min(float(request.args.get('timeout', WATCH_TIMEOUT)), WATCH_TIMEOUT)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'msg': 'Expected integer since and numeric timeout'
+            })
+
+    # The cursor is only valid on every worker if each holds every key and
+    #   versions are the coordinator's tids, which workers commit in order.
+    #   Otherwise a poll answered by another worker (such as behind nginx)
+    #   could skip keys, so the feed is refused and clients fall back to
+    #   lookups.
+    ring = d['ring']
+    if WRITE_MODE == 'quorum' or (ring is not None and ring.replication_factor < len(ring.nodes)):
+        res: flask.Response = jsonify({
+            'success': False,
+            'msg': 'The change feed is unavailable in a partitioned or quorum cluster'
+            })
+        res.status_code = 501
+        return res
+
+    if not caught_up.wait(CATCH_UP_DEADLINE):
+        return catching_up()
+    changes: Dict[str, Dict] = wait_for_changes(since, max(timeout, 0.0))
+    return jsonify({
+        'data': changes,
+        'version': max([since] + [entry['version'] for entry in changes.values()]),
+        'success': True,
+        'msg': f'Retrieved {len(changes)} changes since version {since}'
+        })
+
+@store.route('/batch_get', methods=['POST'])
+def batch_get() -> flask.Response:
+    req: Dict = json.loads(request.data)
+    keys: List[str] = req.get('keys', [])
+    if not isinstance(keys, list):
+        return jsonify({
+            'success': False,
+            'msg': f'Expected a list of {KEY_STRING}s'
+            })
+
+    # Read local keys directly and forward the rest to their owners
+    remote: Dict[str, List[str]] = {}
+    if not req.get('local', False):
+        for key in keys:
+            found: List[str] = owners(key)
+            if found:
+                remote[key] = found
+
+    if len(remote) < len(keys) and not caught_up.wait(CATCH_UP_DEADLINE):
+        return catching_up()
+    local: Dict = d['data']
+    data: Dict = {key: local[key] for key in keys if key in local and key not in remote}
+
+    # Like forward_get, ask the next owner of every key the previous one did
+    #   not return, so that a single unavailable owner does not hide a key
+    rank: int = 0
+    while remote:
+        payloads: Dict[str, Dict] = {}
+        for key, found in remote.items():
+            payloads.setdefault(found[rank], {'keys': [], 'local': True})['keys'].append(key)
+        for res in mb_fanout_each(payloads, '/store/batch_get', FORWARD_DEADLINE).values():
+            data.update(res.get('data', {}))
+
+        rank += 1
+        remote = {key: found for key, found in remote.items() if key not in data and rank < len(found)}
+
+    return jsonify({
+        'data': data,
+        'missing': [key for key in keys if key not in data],
+        'success': True,
+        'msg': f'Retrieved {len(data)} of {len(keys)} {VALUE_STRING}\'s'
+        })
+
+@store.route('/batch_put', methods=['POST'])
+def batch_put() -> flask.Response:
+    entries: Dict = json.loads(request.data).get('data', {})
+    if not entries or not all(key and value for key, value in entries.items()):
+        return jsonify({
+            'success': False,
+            'msg': f'Empty {KEY_STRING} or {VALUE_STRING} on batch PUT request'
+            })
+
+    if WRITE_MODE == 'quorum':
+        written: Dict = quorum_put(entries)
+        return jsonify({
+            'data': written,
+            'failed': [key for key in entries if key not in written],
+            'success': len(written) == len(entries),
+            'msg': f'Updated {len(written)} of {len(entries)} {KEY_STRING}s'
+            })
+
+    # All registrations are committed in a single two-phase commit transaction
+    transactions: List[Dict] = [{'key': key, 'value': value} for key, value in entries.items()]
+    res: Dict = mb_post(f'http://{coordinator}/coordinator/start',
+            json={'transactions': transactions}, timeout=(RPC_CONNECT_TIMEOUT, None))
+
+    if res.get('success', False):
+        return jsonify({
+            'data': {key: {'value': value, 'version': version}
+                for (key, value), version in zip(entries.items(), res.get('versions', []))},
+            'success': True,
+            'msg': f'Updated {len(entries)} {KEY_STRING}s',
+            'tid': res.get('tid'),
+            'batch_size': res.get('batch_size'),
+            'round_ms': res.get('round_ms')
+            })
+    else:
+        return jsonify({
+            'data': '',
+            'success': False,
+            'msg': f'Failed to update {len(entries)} {KEY_STRING}s'
+            })
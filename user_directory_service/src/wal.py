@@ -0,0 +1,225 @@
+import os
+import struct
+import sys
+import zlib
+
+from typing import Dict, Iterator, List, Tuple
+
+from .metrics import Counter, Histogram
+
+# WAL record: crc32 of the body, then the body itself, which holds the version
+#   and the lengths of the key and value followed by their UTF-8 bytes. A
+#   tombstone, logged when a key is dropped, has no value and the length
+#   TOMBSTONE instead.
+RECORD_HEADER: struct.Struct = struct.Struct('<II')
+RECORD_BODY: struct.Struct = struct.Struct('<qII')
+TOMBSTONE: int = 0xFFFFFFFF
+
+# Snapshot: magic, number of entries, then one RECORD_BODY per entry followed
+#   by the key and value bytes, then a crc32 of everything before it
+SNAPSHOT_MAGIC: bytes = b'UDS1'
+SNAPSHOT_HEADER: struct.Struct = struct.Struct('<4sI')
+SNAPSHOT_CRC: struct.Struct = struct.Struct('<I')
+
+# Catch-up cursor: the version up to which the worker holds every committed
+#   entry, followed by its crc32
+CURSOR: struct.Struct = struct.Struct('<qI')
+
+WAL_SECONDS: Histogram = Histogram('uds_wal_duration_seconds',
+        'Time spent writing the write-ahead log and snapshots, by operation.')
+WAL_BYTES: Counter = Counter('uds_wal_bytes_total', 'Bytes written to the write-ahead log and snapshots, by file.')
+
+def encode(key: str, entry: Dict) -> bytes:
+    """Encodes a versioned entry, or a tombstone if its value is None, as a record body."""
+    k: bytes = key.encode()
+    if entry['value'] is None:
+        return RECORD_BODY.pack(entry['version'], len(k), TOMBSTONE) + k
+    v: bytes = entry['value'].encode()
+    return RECORD_BODY.pack(entry['version'], len(k), len(v)) + k + v
+
+def decode(buf: bytes, offset: int) -> Tuple[str, Dict, int]:
+    """Decodes the record body at offset, returning the key, entry and end offset."""
+    version, k_len, v_len = RECORD_BODY.unpack_from(buf, offset)
+    start: int = offset + RECORD_BODY.size
+    key: str = buf[start:start + k_len].decode()
+    if v_len == TOMBSTONE:
+        return key, {'value': None, 'version': version}, start + k_len
+    value: str = buf[start + k_len:start + k_len + v_len].decode()
+    return key, {'value': value, 'version': version}, start + k_len + v_len
+
+class WriteAheadLog:
+    """
+    Durable log of the entries committed on a worker, kept in directory as a
+    snapshot plus a sequence of WAL segments. Every committed batch is
+    appended to the current segment before it is published. A snapshot rotates
+    to a new segment, writes the whole map and then deletes the older segments,
+    so recovery replays the snapshot and only the segments written since.
+    Replaying is idempotent because an entry never replaces a newer version,
+    and a tombstone only removes the entries logged before it.
+    The catch-up cursor is kept beside them, since the highest version in the
+    log may follow rounds the worker missed.
+    """
+
+    def __init__(self, directory: str, fsync: bool = True):
+        self.directory: str = directory
+        self.fsync: bool = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        # Cleared by replay if the snapshot is corrupt, in which case the
+        #   entries it held are lost and the worker must catch up in full
+        self.complete: bool = True
+
+        segments: List[int] = self._segments()
+        self.segment: int = segments[-1] if segments else 0
+        self._file = open(self._segment_path(self.segment), 'ab')
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'wal.{segment:08d}.log')
+
+    def _sync_directory(self) -> None:
+        """Syncs the directory itself, so that renames and new files survive a crash."""
+        fd: int = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[4:-4]) for name in os.listdir(self.directory)
+                if name.startswith('wal.') and name.endswith('.log'))
+
+    def append(self, entries: Dict[str, Dict]) -> None:
+        """Appends committed entries to the log and syncs them to disk."""
+        if not entries:
+            return
+
+        records: List[bytes] = []
+        for key, entry in entries.items():
+            body: bytes = encode(key, entry)
+            records.append(RECORD_HEADER.pack(zlib.crc32(body), len(body)) + body)
+
+        buf: bytes = b''.join(records)
+        with WAL_SECONDS.time(operation='append'):
+            self._file.write(buf)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        WAL_BYTES.inc(len(buf), file='wal')
+
+    def rotate(self) -> int:
+        """
+        Starts a new segment, returning the number of the last segment that the
+        next snapshot will cover. Caller holds the lock guarding appends.
+        """
+        covered: int = self.segment
+        self._file.close()
+        self.segment += 1
+        self._file = open(self._segment_path(self.segment), 'ab')
+        return covered
+
+    def snapshot(self, data: Dict[str, Dict], covered: int) -> None:
+        """
+        Writes data as the new snapshot and deletes the segments up to and
+        including covered, whose entries the snapshot now holds.
+        """
+        parts: List[bytes] = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(data))]
+        parts.extend(encode(key, entry) for key, entry in data.items())
+        buf: bytes = b''.join(parts)
+
+        path: str = os.path.join(self.directory, 'snapshot.bin')
+        with WAL_SECONDS.time(operation='snapshot'):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(buf + SNAPSHOT_CRC.pack(zlib.crc32(buf)))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+            # The segments may only go once the rename itself is durable
+            self._sync_directory()
+        WAL_BYTES.inc(len(buf) + SNAPSHOT_CRC.size, file='snapshot')
+
+        for segment in self._segments():
+            if segment <= covered:
+                os.remove(self._segment_path(segment))
+
+    def save_cursor(self, version: int) -> None:
+        """
+        Durably records version as the catch-up cursor, once every entry up to
+        it has been appended. Syncs the current segment first, so that the
+        cursor never covers entries which are not yet on disk. Caller holds
+        the lock guarding appends.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        path: str = os.path.join(self.directory, 'cursor')
+        buf: bytes = struct.pack('<q', version)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(CURSOR.pack(version, zlib.crc32(buf)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._sync_directory()
+
+    def load_cursor(self) -> int:
+        """Returns the saved catch-up cursor, or -1 if there is none or it is corrupt."""
+        path: str = os.path.join(self.directory, 'cursor')
+        if not os.path.exists(path):
+            return -1
+        with open(path, 'rb') as f:
+            buf: bytes = f.read()
+
+        if len(buf) != CURSOR.size:
+            return -1
+        version, crc = CURSOR.unpack(buf)
+        return version if zlib.crc32(struct.pack('<q', version)) == crc else -1
+
+    def replay(self) -> Iterator[Tuple[str, Dict]]:
+        """
+        Yields the entries of the snapshot and then of every WAL segment, oldest
+        first. A torn or corrupt record ends its segment, which is truncated so
+        that later appends follow the last good record. A corrupt snapshot
+        cannot be recovered from the segments, which it replaced, so it is
+        reported and complete is cleared.
+        """
+        path: str = os.path.join(self.directory, 'snapshot.bin')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                buf: bytes = f.read()
+
+            body: bytes = buf[:-SNAPSHOT_CRC.size]
+            valid: bool = len(buf) >= SNAPSHOT_HEADER.size + SNAPSHOT_CRC.size and \
+                    SNAPSHOT_CRC.unpack_from(buf, len(body))[0] == zlib.crc32(body) and \
+                    SNAPSHOT_HEADER.unpack_from(body)[0] == SNAPSHOT_MAGIC
+            if valid:
+                count: int = SNAPSHOT_HEADER.unpack_from(body)[1]
+                offset: int = SNAPSHOT_HEADER.size
+                for _ in range(count):
+                    key, entry, offset = decode(body, offset)
+                    yield key, entry
+            else:
+                self.complete = False
+                print(f'ERROR: snapshot {path} is corrupt; its entries are lost and must be caught up from peers',
+                        file=sys.stderr)
+
+        for segment in self._segments():
+            with open(self._segment_path(segment), 'rb') as f:
+                buf = f.read()
+
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(buf):
+                crc, length = RECORD_HEADER.unpack_from(buf, offset)
+                start: int = offset + RECORD_HEADER.size
+                record: bytes = buf[start:start + length]
+                if len(record) < length or zlib.crc32(record) != crc:
+                    break
+                key, entry, _ = decode(record, 0)
+                yield key, entry
+                offset = start + length
+
+            if offset < len(buf):
+                with open(self._segment_path(segment), 'r+b') as f:
+                    f.truncate(offset)
+
+    def close(self) -> None:
+        self._file.close()
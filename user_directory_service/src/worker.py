@@ -1,70 +1,530 @@
 import json
+import os
+import requests
 import threading
+import time
 import flask
 
-from typing import Any, Dict
+from collections import deque
+from typing import Deque, Dict, List, Set, Tuple
 from flask import Blueprint, jsonify, request
 
 from . import d
+from .common import RPC_CONNECT_TIMEOUT, mb_fanout, mb_post
+from .metrics import TimedLock
+from .ring import HashRing
+from .wal import WAL_SECONDS, WriteAheadLog
 
 worker: Blueprint = Blueprint('worker', __name__)
-lock: threading.Lock = threading.Lock()
+lock: TimedLock = TimedLock('worker')
 
+# Transactions prepared but not yet committed, by tid; their values are not
+#   visible to readers until they are committed
 history: Dict = {}
 
+# Notified whenever committed entries are published, so that readers waiting
+#   for a minimum version can wake up
+published: threading.Condition = threading.Condition(lock)
+
+# Number of keys sent per request when streaming keys to a new owner
+TRANSFER_CHUNK: int = 500
+
+# Recently published entries as (version, key, entry), oldest first, from
+#   which the change feed is served; changes at or below changelog_floor may
+#   have been evicted, in which case the feed falls back to scanning the map
+CHANGELOG_SIZE: int = int(os.environ.get('CHANGELOG_SIZE', 10000))
+changelog: Deque[Tuple[int, str, Dict]] = deque()
+changelog_floor: int = -1
+latest_change: int = -1
+
+# Cluster configuration: the coordinator, the address other nodes should use
+#   to reach this worker (the coordinator guesses it if empty), how often to
+#   send the coordinator a heartbeat, and after how long without an answer the
+#   coordinator suspects this worker, which then stops serving reads
+COORDINATOR: str = os.environ.get('COORDINATOR', '')
+ADVERTISE_ADDRESS: str = os.environ.get('ADVERTISE_ADDRESS', '')
+HEARTBEAT_INTERVAL: float = float(os.environ.get('HEARTBEAT_INTERVAL', 1.0))
+SUSPECT_AFTER: float = float(os.environ.get('SUSPECT_AFTER', 3 * HEARTBEAT_INTERVAL))
+
+# Durability configuration: the directory holding this worker's WAL and
+#   snapshots (disabled if empty), whether every commit is fsynced, and how
+#   many entries are committed between snapshots
+WAL_DIR: str = os.environ.get('WAL_DIR', '')
+WAL_FSYNC: bool = os.environ.get('WAL_FSYNC', '1') == '1'
+SNAPSHOT_EVERY: int = int(os.environ.get('SNAPSHOT_EVERY', 10000))
+CATCH_UP_DEADLINE: float = float(os.environ.get('CATCH_UP_DEADLINE', 30.0))
+
+# Write path, as in the store: in quorum mode versions come from the clock of
+#   each writer rather than from the coordinator
+WRITE_MODE: str = os.environ.get('WRITE_MODE', '2pc')
+
+wal: WriteAheadLog = None
+logged_since_snapshot: int = 0
+snapshotting: bool = False
+
+# Version up to which this worker is known to hold every committed entry: the
+#   tid before the last completed join, saved in the WAL directory. Unlike
+#   d['version'], it never skips over rounds this worker missed (such as ones
+#   it took part in while joining before a crash), so it is the cursor to
+#   catch up from.
+synced: int = -1
+
+# Set while this worker is caught up with the cluster; reads wait for it
+caught_up: threading.Event = threading.Event()
+
+# Set when the worker must join the cluster again, and while it is joining;
+#   joins run on their own thread so that heartbeats continue during catch-up
+must_join: threading.Event = threading.Event()
+joining: threading.Event = threading.Event()
+
+def get_transactions() -> List[Dict]:
+    """
+    Returns the transactions in the request, which holds either a single
+    transaction or a batch of transactions under the 'transactions' key.
+    """
+    body: Dict = json.loads(request.data)
+    return body.get('transactions', [body])
+
+def publish(entries: Dict[str, Dict], log: bool = True) -> int:
+    """
+    Publishes entries into the map, keeping for each key whichever entry has
+    the highest version. Entries are written to the WAL first, if enabled and
+    log is set. The map is updated in place, which keeps each commit
+    proportional to its own entries: single-key readers may use d['data']
+    without the lock, while readers iterating over it must hold the lock or
+    use copy_data(). Caller holds lock.
+    Returns the number of entries published.
+    """
+    global logged_since_snapshot, changelog_floor, latest_change
+
+    newer: Dict = {key: entry for key, entry in entries.items()
+            if entry.get('version', -1) > d['data'].get(key, {}).get('version', -1)}
+    if not newer:
+        return 0
+
+    if wal is not None and log:
+        wal.append(newer)
+        logged_since_snapshot += len(newer)
+
+    d['data'].update(newer)
+    d['version'] = max(d['version'], max(entry['version'] for entry in newer.values()))
+
+    for key, entry in newer.items():
+        changelog.append((entry['version'], key, entry))
+        latest_change = max(latest_change, entry['version'])
+    while len(changelog) > CHANGELOG_SIZE:
+        changelog_floor = max(changelog_floor, changelog.popleft()[0])
+    published.notify_all()
+
+    if wal is not None and logged_since_snapshot >= SNAPSHOT_EVERY:
+        start_snapshot()
+    return len(newer)
+
+def start_snapshot() -> None:
+    """
+    Snapshots the map in the background unless a snapshot is running. The map
+    is copied here, so the snapshot can be written from the copy without
+    holding the lock. Caller holds lock.
+    """
+    global logged_since_snapshot, snapshotting
+    if snapshotting:
+        return
+
+    snapshotting = True
+    logged_since_snapshot = 0
+    covered: int = wal.rotate()
+    threading.Thread(target=write_snapshot, args=(dict(d['data']), covered), daemon=True).start()
+
+def write_snapshot(data: Dict, covered: int) -> None:
+    global snapshotting
+    try:
+        wal.snapshot(data, covered)
+    finally:
+        with lock:
+            snapshotting = False
+
+def recover() -> None:
+    """
+    Restores the map from the snapshot and WAL in WAL_DIR, if enabled, and the
+    cursor to catch up from, which is reset if the snapshot was corrupt so
+    that the lost entries are fetched again. Called once at startup, before
+    the worker joins the cluster.
+    """
+    global wal, synced
+    if not WAL_DIR:
+        return
+
+    wal = WriteAheadLog(WAL_DIR, fsync=WAL_FSYNC)
+    entries: Dict[str, Dict] = {}
+    with WAL_SECONDS.time(operation='replay'):
+        for key, entry in wal.replay():
+            if entry['value'] is None:
+                if entries.get(key, {}).get('version', -1) <= entry['version']:
+                    entries.pop(key, None)
+            elif entry['version'] > entries.get(key, {}).get('version', -1):
+                entries[key] = entry
+
+    with lock:
+        publish(entries, log=False)
+        synced = wal.load_cursor() if wal.complete else -1
+    print(f'Recovered {len(entries)} keys up to version {d["version"]}, caught up to {synced}')
+
+def join_cluster() -> bool:
+    """
+    Joins the cluster through the coordinator, fetches whatever was committed
+    while this worker was away, and then tells the coordinator it is ready to
+    count towards quorums. The coordinator answers the join once the round in
+    flight has finished, with the tid from which every round includes this
+    worker, so catching up from synced leaves no gap. Reads wait until then.
+    The version this worker holds keeps a restarted coordinator from reusing
+    tids. Returns False if the join did not complete.
+    """
+    global synced
+    caught_up.clear()
+    since: int = synced
+
+    body: Dict = {'version': d['version']}
+    if ADVERTISE_ADDRESS:
+        body['address'] = ADVERTISE_ADDRESS
+    res: Dict = mb_post(f'http://{COORDINATOR}/coordinator/join', json=body, timeout=(RPC_CONNECT_TIMEOUT, None))
+    if not res.get('success', False):
+        return False
+
+    d['self'] = res.get('address')
+    if res.get('ring') is not None:
+        d['ring'] = HashRing.from_dict(res['ring'])
+
+    joined_at: int = res['tid']
+    if not catch_up(res.get('nodes', []), since):
+        return False
+    with lock:
+        synced = max(synced, joined_at - 1)
+        if wal is not None:
+            wal.save_cursor(synced)
+
+    res = mb_post(f'http://{COORDINATOR}/coordinator/ready', json={'address': d['self']})
+    if not res.get('success', False):
+        return False
+
+    caught_up.set()
+    print(f'Joined UDS cluster at tid {joined_at}')
+    return True
+
+def start_heartbeats() -> None:
+    must_join.set()
+    threading.Thread(target=run_joins, daemon=True).start()
+    threading.Thread(target=run_heartbeats, daemon=True).start()
+
+def run_joins() -> None:
+    """
+    Joins the cluster whenever the worker must, starting once it is serving,
+    and retries every HEARTBEAT_INTERVAL seconds until a join completes,
+    forever.
+    """
+    while True:
+        must_join.wait()
+        must_join.clear()
+        joining.set()
+        time.sleep(HEARTBEAT_INTERVAL)
+
+        try:
+            if join_cluster():
+                continue
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        finally:
+            joining.clear()
+        print('Failed to join UDS cluster, retrying')
+        must_join.set()
+
+def run_heartbeats() -> None:
+    """
+    Sends the coordinator a heartbeat every HEARTBEAT_INTERVAL seconds once
+    the worker has an address, including while it catches up, reporting the
+    round trip time of the previous one. If the coordinator has suspended
+    this worker or no longer knows it, the worker joins again. If no heartbeat
+    has been answered for SUSPECT_AFTER, the coordinator suspects the worker
+    by then, so it stops serving reads and joins again once it can.
+    """
+    rtt_ms: float = None
+    answered: float = time.monotonic()
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        started: float = time.monotonic()
+        if d['self'] is None:
+            answered = started
+            continue
+
+        try:
+            res: Dict = mb_post(f'http://{COORDINATOR}/coordinator/heartbeat',
+                    json={'address': d['self'], 'version': d['version'], 'rtt_ms': rtt_ms})
+            rtt_ms = round((time.monotonic() - started) * 1000, 2)
+            answered = time.monotonic()
+
+            # A join in progress finds out for itself whether it was suspended
+            if res.get('rejoin', False) and not joining.is_set():
+                print('Rejoining UDS cluster')
+                caught_up.clear()
+                must_join.set()
+        except (requests.RequestException, ValueError):
+            rtt_ms = None
+            if caught_up.is_set() and time.monotonic() - answered > SUSPECT_AFTER:
+                print('Lost contact with the UDS coordinator, rejoining')
+                caught_up.clear()
+                must_join.set()
+
+def catch_up(peers: List[str], since: int) -> bool:
+    """
+    Fetches the entries committed while this worker was away from its live
+    peers: only entries newer than since are sent, and in a partitioned
+    cluster only those for keys this worker owns. Any peer holding every key
+    will do unless the cluster is partitioned, in which case the owned keys
+    are spread over all peers and every range of them must be covered.
+
+    In quorum mode, versions are wall-clock times from each writer, so since
+    is no cursor: a writer whose clock runs behind may since have written
+    entries with lower versions. The worker then resyncs in full, merging
+    every entry from every peer, since a write may have reached only a quorum
+    of them. Returns False if catching up did not complete.
+    """
+    ring: HashRing = d['ring']
+    partitioned: bool = ring is not None and ring.replication_factor < len(ring.nodes)
+    quorum: bool = WRITE_MODE == 'quorum'
+    payload: Dict = {
+        'version': -1 if quorum else since,
+        'owner': d['self'],
+        'ring': ring.to_dict() if partitioned else None
+        }
+    candidates: List[List[str]] = [peers] if partitioned or quorum else [[peer] for peer in peers]
+
+    for nodes in candidates:
+        responses: Dict[str, Dict] = mb_fanout(nodes, '/worker/since', payload, CATCH_UP_DEADLINE)
+        entries: Dict[str, Dict] = {}
+        for res in responses.values():
+            for key, entry in res.get('data', {}).items():
+                if entry['version'] > entries.get(key, {}).get('version', -1):
+                    entries[key] = entry
+
+        with lock:
+            count: int = publish(entries)
+        answered: Set[str] = {node for node, res in responses.items() if res.get('success', False)}
+        if answered and (not partitioned or covered(ring, answered, peers)):
+            print(f'Caught up {count} keys from {sorted(answered)}')
+            return True
+    return not peers
+
+def covered(ring: HashRing, answered: Set[str], peers: List[str]) -> bool:
+    """
+    Returns whether every arc of ring this worker owns has an owner among the
+    peers that answered, unless none of its other owners is a live peer.
+    """
+    me: str = d['self']
+    for arc in ring.arcs():
+        if me in arc and not answered.intersection(arc) and any(node in peers for node in arc):
+            print(f'No owner of a range held by {arc} answered')
+            return False
+    return True
+
+def copy_data() -> Dict[str, Dict]:
+    """Returns a copy of the map, which may be iterated over without the lock."""
+    with lock:
+        return dict(d['data'])
+
+def wait_for_version(key: str, min_version: int, timeout: float) -> Dict:
+    """
+    Returns the committed entry for key once its version is at least
+    min_version, or whatever entry is committed when timeout expires.
+    """
+    entry: Dict = d['data'].get(key, {})
+    if entry.get('version', -1) >= min_version:
+        return entry
+
+    with published:
+        published.wait_for(lambda: d['data'].get(key, {}).get('version', -1) >= min_version, timeout)
+        return d['data'].get(key, {})
+
+def changes_since(since: int) -> Dict[str, Dict]:
+    """
+    Returns the latest entry of every key published with a version above
+    since, from the changelog if it reaches back that far. Caller holds lock.
+    """
+    if since < changelog_floor:
+        return {key: entry for key, entry in d['data'].items() if entry['version'] > since}
+
+    changes: Dict[str, Dict] = {}
+    for version, key, entry in reversed(changelog):
+        if version > since and key not in changes:
+            changes[key] = d['data'].get(key, entry)
+    return changes
+
+def wait_for_changes(since: int, timeout: float) -> Dict[str, Dict]:
+    """
+    Returns the changes published with a version above since, waiting up to
+    timeout for one if there are none yet.
+    """
+    with published:
+        published.wait_for(lambda: latest_change > since, timeout)
+        return changes_since(since)
+
+def next_version() -> int:
+    """
+    Returns the version for a write made without the coordinator: the current
+    time in microseconds, unless this worker has already seen that version, so
+    that versions issued by one worker always increase and concurrent writes
+    to a key on different workers resolve to the latest one.
+    """
+    with lock:
+        d['version'] = max(d['version'] + 1, time.time_ns() // 1000)
+        return d['version']
+
+def write_local(entries: Dict[str, Dict]) -> int:
+    """Publishes versioned entries written without the coordinator."""
+    with lock:
+        return publish(entries)
+
 @worker.route('/prepare', methods=['POST'])
 def prepare() -> flask.Response:
-    transaction: Dict = json.loads(request.data)
-    tid: Any = transaction.get('tid')
-    key: Any = transaction.get('key')
-    value: Any = transaction.get('value')
-    oldValue: Any = d.get('value', '')
-
-    # record history log
-    history[tid] = {'old': oldValue, 'new': value}
+    transactions: List[Dict] = get_transactions()
 
-    # prepare transaction
+    # Stage transactions until the coordinator decides their outcome
     with lock:
-        d['data'][key] = d['data'].get(key, {})
-        d['data'][key]['value'] = value
+        for transaction in transactions:
+            history[transaction.get('tid')] = {
+                'key': transaction.get('key'),
+                'value': transaction.get('value')
+                }
 
     return jsonify({
         'success': True,
-        'msg': f'Prepared transaction {tid}'})
+        'msg': f'Prepared transactions {[t.get("tid") for t in transactions]}'})
 
 @worker.route('/commit', methods=['POST'])
 def commit() -> flask.Response:
-    transaction: Dict = json.loads(request.data)
-    tid: Any = transaction.get('tid')
+    transactions: List[Dict] = get_transactions()
 
-    # No need to do any operations, transaction already completed; just delete history
-    history.pop(tid, None)
+    # Publish staged values in tid order; each key is versioned by the tid of
+    #   the transaction that last wrote it
+    with lock:
+        entries: Dict[str, Dict] = {}
+        for transaction in sorted(transactions, key=lambda t: t.get('tid')):
+            staged: Dict = history.pop(transaction.get('tid'), None)
+            if staged is not None:
+                entries[staged['key']] = {'value': staged['value'], 'version': transaction.get('tid')}
+        publish(entries)
 
     return jsonify({
         'success': True,
-        'msg': f'Committed transaction {tid}'
+        'msg': f'Committed transactions {[t.get("tid") for t in transactions]}'
         })
 
 @worker.route('/rollback', methods=['POST'])
 def rollback() -> flask.Response:
-    transaction: Dict = json.loads(request.data)
-    tid: Any = transaction.get('tid')
-    key: Any = transaction.get('key')
+    transactions: List[Dict] = get_transactions()
+
+    # Staged values were never published, so it is enough to forget them
+    with lock:
+        for transaction in transactions:
+            history.pop(transaction.get('tid'), None)
 
-    changelog:Dict = history.pop(tid, None)
+    return jsonify({
+        'success': True,
+        'msg': f'Rolled back transactions {[t.get("tid") for t in transactions]}'
+        })
 
-    if changelog is not None:
-        oldValue: str = changelog['old']
-        newValue: str = changelog['new']
+@worker.route('/ring', methods=['POST'])
+def update_ring() -> flask.Response:
+    new_ring: HashRing = HashRing.from_dict(json.loads(request.data))
 
-        with lock:
-            # Check that no newer transaction(s) have been made or prepare
-            #   request was made in the first place
-            if d['data'][key].get('value', '') == newValue:
-                # rollback change
-                d['data'][key]['value'] = oldValue
+    # Rings are pushed concurrently, so an older ring may arrive after a newer one
+    with lock:
+        old_ring: HashRing = d['ring']
+        if old_ring is not None and new_ring.epoch <= old_ring.epoch:
+            return jsonify({
+                'success': True,
+                'msg': f'Ignored stale ring {new_ring.epoch}'
+                })
+        d['ring'] = new_ring
+
+    # Stream keys in the background so that the coordinator is not kept waiting
+    threading.Thread(target=rebalance, args=(old_ring, new_ring), daemon=True).start()
 
     return jsonify({
         'success': True,
-        'msg': f'Rolled back transaction {tid}'
+        'msg': f'Updated ring to {len(new_ring.nodes)} nodes'
         })
+
+@worker.route('/receive', methods=['POST'])
+def receive() -> flask.Response:
+    data: Dict = json.loads(request.data).get('data', {})
+
+    # Versioned entries arrive here when keys are streamed to a new owner, on
+    #   quorum writes and on read repair. Whichever entry has the higher
+    #   version wins, so stale streamed copies and late writes are ignored.
+    write_local(data)
+
+    return jsonify({
+        'success': True,
+        'msg': f'Received {len(data)} keys'
+        })
+
+@worker.route('/since', methods=['POST'])
+def since() -> flask.Response:
+    body: Dict = json.loads(request.data)
+    version: int = int(body.get('version', -1))
+    owner: str = body.get('owner')
+
+    # Only send the keys the requesting worker owns under its ring when
+    #   partitioned, since this worker may not have been sent that ring yet
+    ring: HashRing = HashRing.from_dict(body['ring']) if body.get('ring') else None
+    data: Dict = {key: entry for key, entry in copy_data().items() if entry['version'] > version and
+            (ring is None or owner in ring.owners(key))}
+
+    return jsonify({
+        'data': data,
+        'success': True,
+        'msg': f'Sent {len(data)} keys newer than version {version}'
+        })
+
+def rebalance(old_ring: HashRing, new_ring: HashRing) -> None:
+    """
+    Streams the keys held by this worker to the workers that newly own them
+    under new_ring, then drops the keys this worker no longer owns. Each key is
+    sent by only one of its previous owners (the first one still in the ring).
+    """
+    me: str = d['self']
+    with lock:
+        keys: List[str] = list(d['data'])
+
+    outgoing: Dict[str, Dict] = {}
+    for key in keys:
+        new_owners: List[str] = new_ring.owners(key)
+        old_owners: List[str] = old_ring.owners(key) if old_ring else [me]
+        senders: List[str] = [node for node in old_owners if node in new_ring.nodes]
+        if senders and senders[0] != me:
+            continue
+
+        entry: Dict = d['data'].get(key)
+        for node in new_owners:
+            if node not in old_owners and entry is not None:
+                outgoing.setdefault(node, {})[key] = entry
+
+    transferred: bool = True
+    for node, data in outgoing.items():
+        items: List = list(data.items())
+        for i in range(0, len(items), TRANSFER_CHUNK):
+            try:
+                res: Dict = mb_post(f'http://{node}/worker/receive', json={'data': dict(items[i:i + TRANSFER_CHUNK])})
+                transferred = transferred and res.get('success', False)
+            except Exception:
+                transferred = False
+
+    # Only drop keys once every new owner has its copy, logging a tombstone
+    #   for each so that recovery does not bring them back
+    if transferred:
+        with lock:
+            dropped: Dict[str, Dict] = {key: {'value': None, 'version': entry['version']}
+                    for key, entry in d['data'].items() if me not in new_ring.owners(key)}
+            if wal is not None:
+                wal.append(dropped)
+            for key in dropped:
+                del d['data'][key]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service is run from its own directory, where src is a top-level package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
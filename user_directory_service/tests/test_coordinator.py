@@ -0,0 +1,99 @@
+import pytest
+
+from src import coordinator
+from src.ring import HashRing
+
+NODES = ['a:8080', 'b:8080', 'c:8080', 'd:8080', 'e:8080']
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    """Returns a function which sets up the coordinator's view of a cluster of NODES, all live by default."""
+
+    def setup(partitioned=False, quorum='majority', states=None, replication_factor=3):
+        states = states or {}
+        monkeypatch.setattr(coordinator, 'PARTITIONED', partitioned)
+        monkeypatch.setattr(coordinator, 'QUORUM', quorum)
+        monkeypatch.setattr(coordinator, 'nodes', set(NODES))
+        monkeypatch.setattr(coordinator, 'members', {node: {'state': states.get(node, 'live')} for node in NODES})
+        monkeypatch.setattr(coordinator, 'ring', HashRing(NODES, vnodes=16, replication_factor=replication_factor))
+
+    return setup
+
+
+def request(*keys):
+    return {'transactions': [{'key': key, 'value': f'{key}-address', 'tid': i} for i, key in enumerate(keys)]}
+
+
+@pytest.mark.parametrize('quorum, replicas, size', [
+    ('majority', 1, 1),
+    ('majority', 3, 2),
+    ('majority', 4, 3),
+    ('all', 3, 3),
+    ('2', 3, 2),
+    ('5', 3, 3),
+])
+def test_quorum_size(monkeypatch, quorum, replicas, size):
+    monkeypatch.setattr(coordinator, 'QUORUM', quorum)
+    assert coordinator.quorum_size(replicas) == size
+
+
+def test_unpartitioned_round_goes_to_every_participant(cluster):
+    cluster(states={'e:8080': 'joining', 'd:8080': 'dead'})
+    batch = [request('alice'), request('bob', 'carol')]
+
+    payloads, included = coordinator.route_transactions(batch)
+
+    # Joining workers receive every round, but dead ones do not
+    assert set(payloads) == {'a:8080', 'b:8080', 'c:8080', 'e:8080'}
+    assert all(len(payload['transactions']) == 3 for payload in payloads.values())
+    assert included == batch
+
+
+def test_unpartitioned_round_needs_a_live_quorum(cluster):
+    # Joining workers do not count towards the quorum
+    cluster(states={'c:8080': 'joining', 'd:8080': 'suspect', 'e:8080': 'dead'})
+
+    assert coordinator.route_transactions([request('alice')]) == ({}, [])
+
+
+def test_partitioned_round_goes_to_owners_only(cluster):
+    cluster(partitioned=True)
+    batch = [request('alice'), request('bob')]
+
+    payloads, included = coordinator.route_transactions(batch)
+
+    assert included == batch
+    for key in ('alice', 'bob'):
+        receivers = {node for node, payload in payloads.items()
+                     if any(t['key'] == key for t in payload['transactions'])}
+        assert receivers == set(coordinator.ring.owners(key))
+
+
+def test_partitioned_round_leaves_out_requests_without_quorum(cluster):
+    cluster(partitioned=True)
+    down = coordinator.ring.owners('alice')[:2]
+    for node in down:
+        coordinator.members[node]['state'] = 'dead'
+
+    # A request is left out whole if any of its keys lacks a quorum
+    keys = [key for key in (f'user{i}' for i in range(100)) if not set(down) & set(coordinator.ring.owners(key))]
+    batch = [request('alice', keys[0]), request(keys[1])]
+
+    payloads, included = coordinator.route_transactions(batch)
+
+    assert included == [batch[1]]
+    routed = [t['key'] for payload in payloads.values() for t in payload['transactions']]
+    assert set(routed) == {keys[1]}
+
+
+def test_partitioned_round_sends_to_joining_owners_without_counting_them(cluster):
+    cluster(partitioned=True)
+    owners = coordinator.ring.owners('alice')
+    coordinator.members[owners[0]]['state'] = 'joining'
+
+    payloads, included = coordinator.route_transactions([request('alice')])
+    assert included and set(payloads) == set(owners)
+
+    coordinator.members[owners[1]]['state'] = 'joining'
+    assert coordinator.route_transactions([request('alice')]) == ({}, [])
@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from src.wal import RECORD_HEADER, WriteAheadLog
+
+
+def entry(value, version):
+    return {'value': value, 'version': version}
+
+
+def replay(directory):
+    wal = WriteAheadLog(str(directory), fsync=False)
+    entries = list(wal.replay())
+    return wal, entries
+
+
+def test_replay_returns_appended_entries_in_order(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0), 'b': entry('2.2.2.2', 1)})
+    wal.append({'a': entry('3.3.3.3', 2)})
+    wal.close()
+
+    wal, entries = replay(tmp_path)
+    assert entries == [('a', entry('1.1.1.1', 0)), ('b', entry('2.2.2.2', 1)), ('a', entry('3.3.3.3', 2))]
+    assert wal.complete
+    wal.close()
+
+
+def test_replay_truncates_torn_record(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0)})
+    wal.close()
+
+    segment = os.path.join(str(tmp_path), 'wal.00000000.log')
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(RECORD_HEADER.pack(0, 64) + b'torn')
+
+    wal, entries = replay(tmp_path)
+    assert entries == [('a', entry('1.1.1.1', 0))]
+    assert os.path.getsize(segment) == size
+
+    # Later appends follow the last good record
+    wal.append({'b': entry('2.2.2.2', 1)})
+    wal.close()
+    wal, entries = replay(tmp_path)
+    assert [key for key, _ in entries] == ['a', 'b']
+    wal.close()
+
+
+def test_replay_stops_at_corrupt_record(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0)})
+    wal.append({'b': entry('2.2.2.2', 1)})
+    wal.close()
+
+    segment = os.path.join(str(tmp_path), 'wal.00000000.log')
+    with open(segment, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'X')
+
+    wal, entries = replay(tmp_path)
+    assert entries == [('a', entry('1.1.1.1', 0))]
+    wal.close()
+
+
+def test_tombstones_replay_as_missing_values(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0)})
+    wal.append({'a': entry(None, 0)})
+    wal.close()
+
+    wal, entries = replay(tmp_path)
+    assert entries == [('a', entry('1.1.1.1', 0)), ('a', entry(None, 0))]
+    wal.close()
+
+
+def test_snapshot_replaces_covered_segments(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0)})
+    covered = wal.rotate()
+    wal.append({'b': entry('2.2.2.2', 1)})
+    wal.snapshot({'a': entry('1.1.1.1', 0)}, covered)
+    wal.close()
+
+    assert not os.path.exists(os.path.join(str(tmp_path), 'wal.00000000.log'))
+    wal, entries = replay(tmp_path)
+    assert entries == [('a', entry('1.1.1.1', 0)), ('b', entry('2.2.2.2', 1))]
+    assert wal.complete
+    wal.close()
+
+
+def test_corrupt_snapshot_is_reported(tmp_path, capsys):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    wal.snapshot({'a': entry('1.1.1.1', 0)}, wal.rotate())
+    wal.append({'b': entry('2.2.2.2', 1)})
+    wal.close()
+
+    snapshot = os.path.join(str(tmp_path), 'snapshot.bin')
+    with open(snapshot, 'r+b') as f:
+        f.seek(8)
+        f.write(b'X')
+
+    wal, entries = replay(tmp_path)
+    assert entries == [('b', entry('2.2.2.2', 1))]
+    assert not wal.complete
+    assert 'corrupt' in capsys.readouterr().err
+    wal.close()
+
+
+def test_cursor_round_trip(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    assert wal.load_cursor() == -1
+
+    wal.save_cursor(42)
+    assert wal.load_cursor() == 42
+    wal.close()
+
+    with open(os.path.join(str(tmp_path), 'cursor'), 'r+b') as f:
+        f.write(b'\xff')
+    wal = WriteAheadLog(str(tmp_path), fsync=False)
+    assert wal.load_cursor() == -1
+    wal.close()
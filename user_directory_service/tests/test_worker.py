@@ -0,0 +1,92 @@
+import pytest
+
+from src import d, worker
+from src.ring import HashRing
+from src.wal import WriteAheadLog
+
+
+@pytest.fixture
+def fresh_worker(tmp_path, monkeypatch):
+    """Points the worker at an empty WAL directory and restores its state afterwards."""
+    monkeypatch.setattr(worker, 'WAL_DIR', str(tmp_path))
+    monkeypatch.setattr(worker, 'WAL_FSYNC', False)
+    monkeypatch.setattr(worker, 'wal', None)
+    monkeypatch.setattr(worker, 'synced', -1)
+    monkeypatch.setitem(d, 'data', {})
+    monkeypatch.setitem(d, 'version', -1)
+    monkeypatch.setitem(d, 'self', None)
+    yield tmp_path
+    if worker.wal is not None:
+        worker.wal.close()
+
+
+def entry(value, version):
+    return {'value': value, 'version': version}
+
+
+def test_recover_keeps_newest_entries_and_saved_cursor(fresh_worker):
+    wal = WriteAheadLog(str(fresh_worker), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0), 'b': entry('2.2.2.2', 1)})
+    wal.append({'a': entry('3.3.3.3', 5)})
+    wal.save_cursor(3)
+    wal.close()
+
+    worker.recover()
+
+    assert d['data'] == {'a': entry('3.3.3.3', 5), 'b': entry('2.2.2.2', 1)}
+    assert d['version'] == 5
+
+    # The cursor is the one saved after the last join, not the highest version
+    assert worker.synced == 3
+
+
+def test_recover_applies_tombstones_to_older_entries_only(fresh_worker):
+    wal = WriteAheadLog(str(fresh_worker), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0), 'b': entry('2.2.2.2', 1)})
+    wal.append({'a': entry(None, 0), 'b': entry(None, 1)})
+    wal.append({'b': entry('4.4.4.4', 2)})
+    wal.close()
+
+    worker.recover()
+
+    assert d['data'] == {'b': entry('4.4.4.4', 2)}
+
+
+def test_recover_from_corrupt_snapshot_catches_up_in_full(fresh_worker):
+    wal = WriteAheadLog(str(fresh_worker), fsync=False)
+    wal.append({'a': entry('1.1.1.1', 0)})
+    wal.snapshot({'a': entry('1.1.1.1', 0)}, wal.rotate())
+    wal.save_cursor(0)
+    wal.close()
+
+    with open(str(fresh_worker / 'snapshot.bin'), 'r+b') as f:
+        f.write(b'XXXX')
+
+    worker.recover()
+
+    assert d['data'] == {}
+    assert worker.synced == -1
+
+
+def test_recover_without_wal_directory_does_nothing(fresh_worker, monkeypatch):
+    monkeypatch.setattr(worker, 'WAL_DIR', '')
+
+    worker.recover()
+
+    assert worker.wal is None
+    assert d['data'] == {}
+
+
+def test_covered_requires_an_owner_of_every_held_arc(fresh_worker):
+    nodes = ['a:8080', 'b:8080', 'c:8080', 'd:8080']
+    ring = HashRing(nodes, vnodes=16, replication_factor=2)
+    d['self'] = 'a:8080'
+    peers = nodes[1:]
+
+    assert worker.covered(ring, set(peers), peers)
+
+    # a shares some arcs only with c or d, which did not answer
+    assert not worker.covered(ring, {'b:8080'}, peers)
+
+    # Arcs whose other owners are not live peers cannot be caught up and are skipped
+    assert worker.covered(ring, {'b:8080'}, ['b:8080'])